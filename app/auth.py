@@ -0,0 +1,207 @@
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import uuid
+from typing import Annotated, Union
+from fastapi import Depends, Header
+from app.cache import ttl_cache
+from app.common import USER_TYPE
+from app.config import TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL, TOKEN_MODE, TOKEN_SECRET, TOKEN_REVOCATION_REFRESH
+from app.database import db_conn
+
+from time import monotonic, time
+from datetime import datetime, timedelta, timezone
+
+token_validity = 15 # generated tokens valid for days
+# token -> (email, user_type, expiry), entries expire after TOKEN_CACHE_TTL or with the token if sooner
+# logins, logouts and user changes only evict the cache of the process that handled them,
+# the ttl bounds how long the other processes keep serving the old entry
+token_cache = ttl_cache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+# the authenticated caller of a request, resolved once from the token header
+class principal:
+    def __init__(self, email = None, user_type = USER_TYPE.INVALID, expiry = None):
+        self.email = email
+        self.user_type = user_type
+        self.expiry = expiry
+        # roll number for students, email prefix for professors
+        self.subject = email.removesuffix('@iiitr.ac.in') if email else None
+
+    def is_staff(self):
+        return self.user_type.value >= USER_TYPE.SEPARATOR.value
+
+if TOKEN_MODE == "signed" and not TOKEN_SECRET:
+    raise RuntimeError("TOKEN_SECRET must be set when TOKEN_MODE is signed")
+
+class auth_error(Exception):
+    def __init__(self, message = "Invalid token, please login again"):
+        self.message = message
+
+def _b64encode(data: bytes):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def _b64decode(data: str):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def _sign(body: str):
+    digest = hmac.new(TOKEN_SECRET.encode(), body.encode(), hashlib.sha256).digest()
+    return _b64encode(digest)
+
+# signed tokens are <payload>.<hmac>, payload carries subject, user_type and expiry
+# not_before is the revocation the token has to outlive, see login
+def issue_token(email: str, user_type: int, not_before = None):
+    if TOKEN_MODE != "signed":
+        return ''.join(str(uuid.uuid4()).split('-'))
+    now = time()
+    issued = now if not_before is None else max(now, not_before + 0.001)
+    payload = {
+        "sub" : email,
+        "typ" : int(user_type),
+        "iat" : issued,
+        "exp" : now + token_validity * 24 * 60 * 60,
+    }
+    body = _b64encode(json.dumps(payload, separators=(',', ':')).encode())
+    return f"{body}.{_sign(body)}"
+
+# emails whose tokens issued before a point in time are no longer accepted
+# bulk loaded from token_revocations and refreshed every TOKEN_REVOCATION_REFRESH seconds
+class revocation_list:
+    def __init__(self, refresh):
+        self.refresh = refresh
+        self._revoked = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def _reload(self, conn):
+        cur = conn.cursor()
+        cur.execute("""
+                    SELECT email, extract(epoch from revoked_at) FROM token_revocations
+                    WHERE revoked_at > now() - %s * interval '1 day'
+                    """,
+                    (token_validity, ))
+        revoked = {row[0] : float(row[1]) for row in cur.fetchall()}
+        cur.close()
+        self._revoked = revoked
+        self._loaded_at = monotonic()
+
+    def is_revoked(self, email, issued_at, conn):
+        if self._loaded_at is None or monotonic() - self._loaded_at >= self.refresh:
+            with self._lock:
+                if self._loaded_at is None or monotonic() - self._loaded_at >= self.refresh:
+                    self._reload(conn)
+        revoked_at = self._revoked.get(email)
+        return revoked_at is not None and issued_at <= revoked_at
+
+    # writes the revocation in the caller's transaction and returns its time,
+    # remember() it once the caller committed
+    def revoke(self, email, conn):
+        cur = conn.cursor()
+        cur.execute("""
+                    INSERT INTO token_revocations (email, revoked_at) VALUES (%s, now())
+                    ON CONFLICT (email) DO UPDATE SET revoked_at = now()
+                    RETURNING extract(epoch from revoked_at)
+                    """,
+                    (email, ))
+        revoked_at = float(cur.fetchone()[0])
+        cur.execute("DELETE FROM token_revocations WHERE revoked_at < now() - %s * interval '1 day'",
+                    (token_validity, ))
+        cur.close()
+        return revoked_at
+
+    def remember(self, email, revoked_at):
+        with self._lock:
+            if revoked_at > self._revoked.get(email, 0):
+                self._revoked[email] = revoked_at
+
+revocations = revocation_list(TOKEN_REVOCATION_REFRESH)
+
+def _lookup_signed_token(token, conn):
+    body, _, sig = token.partition('.')
+    if not sig or not hmac.compare_digest(sig, _sign(body)):
+        return None
+    try:
+        payload = json.loads(_b64decode(body))
+        email, user_type = payload["sub"], USER_TYPE(payload["typ"])
+        issued_at, expires = float(payload["iat"]), float(payload["exp"])
+    except (ValueError, KeyError, TypeError):
+        return None
+    if expires <= time() or revocations.is_revoked(email, issued_at, conn):
+        return None
+    return (email, user_type, datetime.fromtimestamp(expires, timezone.utc))
+
+# returns (email, user_type, expiry) for a valid token, None otherwise
+def _lookup_token(token, conn):
+    if TOKEN_MODE == "signed" and '.' in token:
+        return _lookup_signed_token(token, conn)
+    entry = token_cache.get(token)
+    if entry is not None:
+        return entry
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT email, token_gen_time, user_type FROM user_accounts WHERE token = %s",
+                    (token, ))
+        row = cur.fetchall()
+        if len(row) > 0:
+            email = str(row[0][0])
+            expiry = row[0][1] + timedelta(days=token_validity)
+            user_type = int(row[0][2])
+            if datetime.now(timezone.utc) < expiry:
+                entry = (email, USER_TYPE(user_type), expiry)
+                token_cache.put(token, entry, expires=min(expiry.timestamp(), time() + TOKEN_CACHE_TTL))
+            else:
+                cur.execute("""
+                            UPDATE user_accounts 
+                            SET token = NULL, token_gen_time = NULL 
+                            WHERE token = %s
+                            """,
+                            (token, ))
+                conn.commit()
+    finally:
+        cur.close()
+        return entry
+
+def _evict_tokens(email):
+    token_cache.evict_where(lambda token, entry: entry[0] == email)
+
+# invalidate every token of a user in the caller's transaction
+# the process only stops accepting them once the caller committed and passed the result to _tokens_revoked,
+# so a rolled back transaction leaves the tokens valid everywhere
+def _revoke_tokens(email, conn):
+    revoked_at = None
+    if TOKEN_MODE == "signed":
+        revoked_at = revocations.revoke(email, conn)
+    return (email, revoked_at)
+
+def _tokens_revoked(revoked):
+    email, revoked_at = revoked
+    _evict_tokens(email)
+    if revoked_at is not None:
+        revocations.remember(email, revoked_at)
+
+def get_principal(
+    conn: db_conn,
+    token: Annotated[Union[str, None], Header()] = None
+):
+    if token is None:
+        return principal()
+    entry = _lookup_token(token, conn)
+    if entry is None:
+        return principal()
+    return principal(*entry)
+
+# route dependency rejecting callers below min_type
+def require(min_type: USER_TYPE):
+    def check(user: Annotated[principal, Depends(get_principal)]):
+        if user.user_type.value < min_type.value:
+            raise auth_error()
+        return user
+    return check
+
+require_user = require(USER_TYPE.STUDENT)
+require_staff = require(USER_TYPE.SEPARATOR)
+require_admin = require(USER_TYPE.ADMIN)
+
+any_user = Annotated[principal, Depends(require_user)]
+staff_user = Annotated[principal, Depends(require_staff)]
\ No newline at end of file
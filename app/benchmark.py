@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import numpy as np
+from app.recognition import profiles, detect_scaled, detect_lecture, encode_faces, match_faces, stage_timer, _decode
+from app.encoding_store import course_encodings
+
+# latency and accuracy of every recognition profile on a local labelled image set
+# usage: python -m app.benchmark <dir> [--profiles fast,balanced] [--json]
+#
+# <dir>/people/<label>/*.jpg    enrollment photos, one face each, label plays the roll number
+# <dir>/photos/*.jpg            lecture photos
+# <dir>/photos/labels.json      {"photo.jpg" : ["label", ...]} people present in each photo
+#
+# everything runs on this process, tiled profiles detect their tiles one after the other,
+# so their latency is what a single pool worker would take
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return _decode(f.read())
+
+def load_set(root):
+    people = {}
+    people_dir = os.path.join(root, "people")
+    for label in sorted(os.listdir(people_dir)):
+        label_dir = os.path.join(people_dir, label)
+        if os.path.isdir(label_dir):
+            people[label] = [os.path.join(label_dir, name) for name in sorted(os.listdir(label_dir))
+                             if name.lower().endswith(IMAGE_EXTENSIONS)]
+    photos_dir = os.path.join(root, "photos")
+    with open(os.path.join(photos_dir, "labels.json")) as f:
+        labels = json.load(f)
+    photos = [(os.path.join(photos_dir, name), set(present)) for name, present in sorted(labels.items())]
+    return people, photos
+
+# encodings of every enrollment photo with exactly one face, as a course would hold them
+def enroll(people, profile, timer):
+    rolls = []
+    encodings = []
+    skipped = 0
+    for label in sorted(people):
+        for path in people[label]:
+            img = _read(path)
+            with timer.stage("enroll"):
+                locations = detect_scaled(img, profile.max_side_enroll, profile.upsample, profile.model)
+                if len(locations) == 1:
+                    encodings.append(encode_faces(img, locations, profile.jitters, profile.landmarks)[0])
+                    rolls.append(label)
+            if len(locations) != 1:
+                skipped += 1
+    if len(encodings) > 0:
+        matrix = np.ascontiguousarray(np.vstack(encodings), dtype=np.float32)
+    else:
+        matrix = np.empty((0, 128), dtype=np.float32)
+    return course_encodings("benchmark", np.array(rolls, dtype=str), matrix, [], set(people)), skipped
+
+def run_profile(profile, people, photos):
+    enroll_timer = stage_timer(None)
+    candidates, skipped = enroll(people, profile, enroll_timer)
+    totals = []
+    stages = {"detect" : [], "encode" : [], "match" : []}
+    faces = 0
+    true_pos, false_pos, false_neg = 0, 0, 0
+    for path, present in photos:
+        img = _read(path)
+        timer = stage_timer(None)
+        with timer.stage("detect"):
+            locations = detect_lecture(img, profile)
+        with timer.stage("encode"):
+            face_encs = encode_faces(img, locations, profile.jitters, profile.landmarks)
+        with timer.stage("match"):
+            results = match_faces(face_encs, candidates, profile.match_tolerance)
+        for name in stages:
+            stages[name].append(timer.stages.get(name, 0.0) * 1000)
+        totals.append(sum(timer.stages.values()) * 1000)
+        faces += len(locations)
+        found = set(result["student"] for result in results if result["student"] != None)
+        true_pos += len(found & present)
+        false_pos += len(found - present)
+        false_neg += len(present - found)
+    enrolled = len(candidates)
+    return {
+        "profile" : profile.name,
+        "enrolled" : enrolled,
+        "enroll_skipped" : skipped,
+        "enroll_ms" : round(enroll_timer.stages.get("enroll", 0.0) * 1000 / max(enrolled + skipped, 1), 1),
+        "photos" : len(photos),
+        "faces" : faces,
+        "precision" : round(true_pos / max(true_pos + false_pos, 1), 3),
+        "recall" : round(true_pos / max(true_pos + false_neg, 1), 3),
+        "detect_ms" : round(float(np.mean(stages["detect"])), 1) if totals else 0.0,
+        "encode_ms" : round(float(np.mean(stages["encode"])), 1) if totals else 0.0,
+        "match_ms" : round(float(np.mean(stages["match"])), 2) if totals else 0.0,
+        "total_ms" : round(float(np.mean(totals)), 1) if totals else 0.0,
+        "p95_ms" : round(float(np.percentile(totals, 95)), 1) if totals else 0.0,
+    }
+
+def print_table(rows):
+    columns = ["profile", "enrolled", "enroll_skipped", "enroll_ms", "photos", "faces", "precision", "recall",
+               "detect_ms", "encode_ms", "match_ms", "total_ms", "p95_ms"]
+    widths = [max(len(col), *(len(str(row[col])) for row in rows)) for col in columns]
+    print("  ".join(col.ljust(width) for col, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(str(row[col]).ljust(width) for col, width in zip(columns, widths)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark recognition profiles on a labelled image set")
+    parser.add_argument("root", help="directory with people/ and photos/")
+    parser.add_argument("--profiles", default=",".join(profiles), help="comma separated profile names")
+    parser.add_argument("--json", action="store_true", help="print json instead of a table")
+    args = parser.parse_args()
+    people, photos = load_set(args.root)
+    rows = [run_profile(profiles[name], people, photos) for name in args.profiles.split(",")]
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_table(rows)
@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict
+from time import time
+
+# bounded LRU cache, entries optionally expire at an absolute unix timestamp
+class ttl_cache:
+    def __init__(self, maxsize, ttl = None):
+        self.maxsize = maxsize
+        self.ttl = ttl # default lifetime in seconds when put() gets no expiry
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            "hits" : 0,
+            "misses" : 0,
+            "expired" : 0,
+            "evicted" : 0,
+        }
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self._counters["misses"] += 1
+                return None
+            value, expires = item
+            if expires is not None and expires <= time():
+                del self._data[key]
+                self._counters["expired"] += 1
+                self._counters["misses"] += 1
+                return None
+            self._data.move_to_end(key)
+            self._counters["hits"] += 1
+            return value
+
+    def put(self, key, value, expires = None):
+        if expires is None and self.ttl is not None:
+            expires = time() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last = False)
+                self._counters["evicted"] += 1
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return None if item is None else item[0]
+
+    # drop every entry for which pred(key, value) is true
+    def evict_where(self, pred):
+        with self._lock:
+            keys = [k for k, (v, _) in self._data.items() if pred(k, v)]
+            for k in keys:
+                del self._data[k]
+        return len(keys)
+
+    # replace every value with fn(key, value), expiry times are kept
+    def replace_where(self, fn):
+        with self._lock:
+            changed = 0
+            for k, (v, expires) in list(self._data.items()):
+                new = fn(k, v)
+                if new is not v:
+                    self._data[k] = (new, expires)
+                    changed += 1
+        return changed
+
+    # snapshot of (key, value) pairs, expired entries included until they are next read
+    def items(self):
+        with self._lock:
+            return [(k, v) for k, (v, _) in self._data.items()]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["size"] = len(self._data)
+        stats["maxsize"] = self.maxsize
+        return stats
\ No newline at end of file
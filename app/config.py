@@ -8,6 +8,18 @@ MAIL_HOST           = os.environ.get("MAIL_HOST")
 MAIL_PORT           = os.environ.get("MAIL_PORT")
 MAIL_USERNAME       = os.environ.get("MAIL_USERNAME")
 MAIL_PASSWORD       = os.environ.get("MAIL_PASSWORD")
+MAIL_FROM           = os.environ.get("MAIL_FROM", MAIL_USERNAME)
+MAIL_STARTTLS       = os.environ.get("MAIL_STARTTLS", "true").lower() == "true" # disable for local test servers
+MAIL_POOL_SIZE      = int(os.environ.get("MAIL_POOL_SIZE", 2)) # idle SMTP sessions kept open
+MAIL_SESSION_IDLE   = float(os.environ.get("MAIL_SESSION_IDLE", 60)) # seconds before an idle session is recycled
+MAIL_SESSION_MAX_MESSAGES = int(os.environ.get("MAIL_SESSION_MAX_MESSAGES", 100))
+MAIL_TIMEOUT        = float(os.environ.get("MAIL_TIMEOUT", 30)) # seconds a connect or command may block
+
+OUTBOX_POLL         = float(os.environ.get("OUTBOX_POLL", 5)) # seconds between outbox scans
+OUTBOX_BATCH        = int(os.environ.get("OUTBOX_BATCH", 50))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_BACKOFF      = float(os.environ.get("OUTBOX_BACKOFF", 30)) # seconds, doubled after every failure
+OUTBOX_BACKOFF_MAX  = float(os.environ.get("OUTBOX_BACKOFF_MAX", 3600))
 
 DB_URL              = os.environ.get("DB_URL")
 DB_USER             = os.environ.get("DB_USER")
@@ -15,9 +27,77 @@ DB_HOST             = os.environ.get("DB_HOST")
 DB_DATABASE         = os.environ.get("DB_DATABASE")
 DB_PASSWORD         = os.environ.get("DB_PASSWORD")
 
+DB_POOL_MIN         = int(os.environ.get("DB_POOL_MIN", 1))
+DB_POOL_MAX         = int(os.environ.get("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT     = float(os.environ.get("DB_POOL_TIMEOUT", 5)) # seconds to wait for a free connection
+DB_POOL_CHECK       = os.environ.get("DB_POOL_CHECK", "true").lower() == "true" # ping connections on borrow
+
+TOKEN_CACHE_SIZE    = int(os.environ.get("TOKEN_CACHE_SIZE", 4096))
+TOKEN_CACHE_TTL     = float(os.environ.get("TOKEN_CACHE_TTL", 60)) # seconds another process may keep serving a changed or revoked token
+TOKEN_MODE          = os.environ.get("TOKEN_MODE", "db") # "db" or "signed"
+TOKEN_SECRET        = os.environ.get("TOKEN_SECRET")
+TOKEN_REVOCATION_REFRESH = int(os.environ.get("TOKEN_REVOCATION_REFRESH", 30)) # seconds
+
+ENCODING_EXPIRY_INTERVAL   = int(os.environ.get("ENCODING_EXPIRY_INTERVAL", 10 * 60)) # seconds
+ENCODING_REMINDER_INTERVAL = int(os.environ.get("ENCODING_REMINDER_INTERVAL", 24 * 60 * 60)) # seconds
+ENCODING_CACHE_SIZE = int(os.environ.get("ENCODING_CACHE_SIZE", 64)) # courses kept in memory
+ENCODING_CACHE_TTL  = float(os.environ.get("ENCODING_CACHE_TTL", 5 * 60)) # seconds, bounds staleness across processes
+
+ENCODING_QUANTIZE   = os.environ.get("ENCODING_QUANTIZE", "none") # none, float16 or int8 form of cached course encodings
+ENCODING_SNAPSHOT   = os.environ.get("ENCODING_SNAPSHOT", "false").lower() == "true" # share course encodings between processes through mapped files
+ENCODING_SNAPSHOT_DIR = os.environ.get("ENCODING_SNAPSHOT_DIR", "/tmp/cache/encodings")
+ENCODING_SNAPSHOT_DELAY = int(os.environ.get("ENCODING_SNAPSHOT_DELAY", 30)) # min seconds between snapshot rebuilds of a process
+MATCH_TOLERANCE     = float(os.environ.get("MATCH_TOLERANCE", 0.5)) # max face distance counted as a match
+MATCH_REDUCE        = os.environ.get("MATCH_REDUCE", "min") # "min" or "mean" distance over a student's encodings
+MATCH_COARSE_MIN    = int(os.environ.get("MATCH_COARSE_MIN", 2000)) # encodings below which the prototype pass is skipped
+
+RECOGNITION_WORKERS = int(os.environ.get("RECOGNITION_WORKERS", 2)) # processes for detection/encoding, 0 runs on a thread
+RECOGNITION_QUEUE   = int(os.environ.get("RECOGNITION_QUEUE", 8)) # jobs allowed to wait for a free worker
+RECOGNITION_TIMEOUT = float(os.environ.get("RECOGNITION_TIMEOUT", 120)) # seconds per job
+RECOGNITION_PROFILE = os.environ.get("RECOGNITION_PROFILE", "balanced") # fast, balanced or accurate, see app/recognition.py
+LECTURE_MAX_PHOTOS  = int(os.environ.get("LECTURE_MAX_PHOTOS", 8)) # photos of one lecture recognized together
+ENROLL_MAX_PHOTOS   = int(os.environ.get("ENROLL_MAX_PHOTOS", 10)) # photos per batch enrollment request
+# longest side in pixels of the copy faces are detected on, 0 detects at full resolution
+DETECT_MAX_SIDE_ENROLL  = int(os.environ.get("DETECT_MAX_SIDE_ENROLL", 800)) # one large face per photo
+DETECT_MAX_SIDE_LECTURE = int(os.environ.get("DETECT_MAX_SIDE_LECTURE", 2400)) # keep back rows detectable
+# tiled lecture detection, tiles are detected at full resolution in parallel
+DETECT_TILED        = os.environ.get("DETECT_TILED", "false").lower() == "true" # used by the fast and balanced profiles
+DETECT_TILE_SIZE    = int(os.environ.get("DETECT_TILE_SIZE", 1024)) # pixels
+DETECT_TILE_OVERLAP = int(os.environ.get("DETECT_TILE_OVERLAP", 192)) # pixels, should exceed the largest far-row face
+DETECT_TILE_UPSAMPLE = int(os.environ.get("DETECT_TILE_UPSAMPLE", 1))
+DETECT_NMS_IOU      = float(os.environ.get("DETECT_NMS_IOU", 0.3))
+
+FACE_INDEX_NPROBE   = int(os.environ.get("FACE_INDEX_NPROBE", 8)) # clusters scanned per campus-wide query
+FACE_INDEX_MIN_TRAIN = int(os.environ.get("FACE_INDEX_MIN_TRAIN", 2000)) # below this many encodings every query is exact
+FACE_INDEX_REFRESH  = int(os.environ.get("FACE_INDEX_REFRESH", 600)) # seconds between full rebuilds of the campus-wide index
+
+RESULT_CACHE_SIZE   = int(os.environ.get("RESULT_CACHE_SIZE", 128)) # lecture photos whose recognition results are kept
+RESULT_CACHE_TTL    = int(os.environ.get("RESULT_CACHE_TTL", 15 * 60)) # seconds
+
+UPLOAD_MAX_BYTES    = int(os.environ.get("UPLOAD_MAX_BYTES", 10 * 1024 * 1024)) # per uploaded image
+UPLOAD_CHUNK_SIZE   = int(os.environ.get("UPLOAD_CHUNK_SIZE", 256 * 1024))
+
+VIDEO_MAX_BYTES     = int(os.environ.get("VIDEO_MAX_BYTES", 64 * 1024 * 1024)) # per uploaded lecture video
+VIDEO_MAX_SECONDS   = float(os.environ.get("VIDEO_MAX_SECONDS", 90)) # frames past this are not read
+VIDEO_MAX_SIDE      = int(os.environ.get("VIDEO_MAX_SIDE", 1280)) # longest side of the copy faces are detected on
+# seconds between sampled frames, the camera should move at most VIDEO_SAMPLE_SHIFT of the frame between two
+VIDEO_SAMPLE_MIN    = float(os.environ.get("VIDEO_SAMPLE_MIN", 0.1))
+VIDEO_SAMPLE_MAX    = float(os.environ.get("VIDEO_SAMPLE_MAX", 1.0))
+VIDEO_SAMPLE_SHIFT  = float(os.environ.get("VIDEO_SAMPLE_SHIFT", 0.2))
+VIDEO_TRACK_ENCODINGS = int(os.environ.get("VIDEO_TRACK_ENCODINGS", 3)) # encodings averaged per tracked face
+VIDEO_TRACK_PATIENCE = int(os.environ.get("VIDEO_TRACK_PATIENCE", 3)) # samples a face may be missed before its track ends
+
 img_cache_path = Path("/tmp/cache/img")
 img_cache_path.mkdir(parents=True, exist_ok=True)
 IMG_CACHE_LOCATION  = str(img_cache_path)
+IMG_CACHE_MAX_BYTES = int(os.environ.get("IMG_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024)) # uploaded photos kept on disk
+IMG_CACHE_MAX_AGE   = int(os.environ.get("IMG_CACHE_MAX_AGE", 30 * 24 * 60 * 60)) # seconds since a photo was last uploaded
+IMG_CACHE_QUEUE     = int(os.environ.get("IMG_CACHE_QUEUE", 32)) # photos waiting to be written, more are not kept
+IMG_CACHE_SWEEP_INTERVAL = int(os.environ.get("IMG_CACHE_SWEEP_INTERVAL", 60 * 60)) # seconds
+
+video_path = Path("/tmp/cache/video")
+video_path.mkdir(parents=True, exist_ok=True)
+VIDEO_LOCATION      = str(video_path) # videos while they are recognized, removed afterwards
 
 sheet_cache_path = Path("/tmp/cache/sheet")
 sheet_cache_path.mkdir(parents=True, exist_ok=True)
@@ -1,5 +1,12 @@
 import psycopg2
+import threading
+from contextlib import contextmanager
+from time import monotonic
+from typing import Annotated
+from fastapi import Depends, HTTPException, status
+from psycopg2.extensions import connection, TRANSACTION_STATUS_IDLE
 from app.config import DB_HOST, DB_DATABASE, DB_PASSWORD, DB_USER
+from app.config import DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_CHECK
 from app.common import USER_TYPE
 
 def connect():
@@ -17,6 +24,173 @@ def connect():
         if conn is not None:
             return conn
 
+class pool_timeout(Exception):
+    pass
+
+# bounded, thread-safe pool of psycopg2 connections
+# connections are opened lazily up to maxconn, callers wait up to timeout for a free one
+class connection_pool:
+    def __init__(self, minconn, maxconn, timeout, check_on_borrow):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_on_borrow = check_on_borrow
+        self._idle = []
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._counters = {
+            "borrowed" : 0,
+            "created" : 0,
+            "discarded" : 0,
+            "waits" : 0,
+            "timeouts" : 0,
+        }
+        for _ in range(minconn):
+            self._idle.append(self._open())
+
+    def _open(self):
+        conn = psycopg2.connect(
+            database = DB_DATABASE,
+            user = DB_USER,
+            password = DB_PASSWORD,
+            host = DB_HOST
+        )
+        with self._cond:
+            self._counters["created"] += 1
+        return conn
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except (Exception, psycopg2.DatabaseError):
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except (Exception, psycopg2.DatabaseError):
+            pass
+        with self._cond:
+            self._counters["discarded"] += 1
+
+    def getconn(self):
+        deadline = monotonic() + self.timeout
+        conn = None
+        with self._cond:
+            waited = False
+            while True:
+                if len(self._idle) > 0:
+                    conn = self._idle.pop()
+                    break
+                if self._in_use + len(self._idle) < self.maxconn:
+                    break
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    self._counters["timeouts"] += 1
+                    raise pool_timeout(f"no connection available after {self.timeout}s")
+                if not waited:
+                    self._counters["waits"] += 1
+                    waited = True
+                self._cond.wait(remaining)
+            self._in_use += 1
+            self._counters["borrowed"] += 1
+        try:
+            if conn is not None and self.check_on_borrow and not self._healthy(conn):
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._open()
+        except:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, discard = False):
+        if not discard and not conn.closed:
+            try:
+                # drop whatever the borrower left uncommitted
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except (Exception, psycopg2.DatabaseError):
+                discard = True
+        if discard or conn.closed:
+            self._discard(conn)
+        with self._cond:
+            self._in_use -= 1
+            if not discard and not conn.closed:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats["in_use"] = self._in_use
+            stats["idle"] = len(self._idle)
+            stats["size"] = self._in_use + len(self._idle)
+        stats["max"] = self.maxconn
+        stats["timeout"] = self.timeout
+        stats["check_on_borrow"] = self.check_on_borrow
+        return stats
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = connection_pool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_CHECK)
+    return _pool
+
+def close_pool():
+    if _pool is not None:
+        _pool.closeall()
+
+def pool_stats():
+    if _pool is None:
+        return {"size" : 0, "max" : DB_POOL_MAX}
+    return _pool.stats()
+
+# checkout a pooled connection outside of a request (background jobs, scripts)
+@contextmanager
+def borrow():
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+# fastapi dependency, one pooled connection per request
+def get_conn():
+    pool = get_pool()
+    try:
+        conn = pool.getconn()
+    except pool_timeout:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Server busy, please try again")
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+db_conn = Annotated[connection, Depends(get_conn)]
+
 def init():
     conn = connect()
     cur = conn.cursor()
@@ -58,6 +232,16 @@ def init():
     """, 
     ('jallu@iiitr.ac.in', USER_TYPE.PROFESSOR.value, USER_TYPE.PROFESSOR.value))
 
+    # revocations for signed tokens, tokens issued before revoked_at are rejected
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS public.token_revocations
+    (
+        email character varying COLLATE pg_catalog."default" NOT NULL,
+        revoked_at timestamp with time zone NOT NULL DEFAULT now(),
+        CONSTRAINT token_revocations_pkey PRIMARY KEY (email)
+    )
+    """)
+
     # create students table if not exists
     cur.execute("""
     CREATE TABLE IF NOT EXISTS public.students
@@ -108,6 +292,12 @@ def init():
     )
     """)
     
+    # recognition profile used for the course's lecture photos, null uses RECOGNITION_PROFILE
+    cur.execute("""
+    ALTER TABLE public.courses
+    ADD COLUMN IF NOT EXISTS recognition_profile character varying COLLATE pg_catalog."default"
+    """)
+
     # create profs_courses table if not exists
     cur.execute("""
     CREATE TABLE IF NOT EXISTS public.profs_courses
@@ -188,7 +378,8 @@ def init():
         encoding_id uuid NOT NULL DEFAULT uuid_generate_v4(),
         roll_num character(9) COLLATE pg_catalog."default" NOT NULL,
         creation_time timestamp with time zone NOT NULL,
-        face_encoding numeric[] NOT NULL,
+        face_encoding numeric[],
+        embedding bytea,
         CONSTRAINT face_encodings_pkey PRIMARY KEY (encoding_id),
         CONSTRAINT face_encodings_roll_num_fkey FOREIGN KEY (roll_num)
             REFERENCES public.students (roll_num) MATCH SIMPLE
@@ -197,6 +388,53 @@ def init():
     )
     """)
 
+    # encodings are stored as raw float64 bytes, the old numeric[] column is only
+    # kept for rows not yet converted by app.migrate_encodings
+    cur.execute("""
+    ALTER TABLE public.face_encodings
+    ADD COLUMN IF NOT EXISTS embedding bytea
+    """)
+    cur.execute("""
+    ALTER TABLE public.face_encodings
+    ALTER COLUMN face_encoding DROP NOT NULL
+    """)
+
+    # expiry job deletes by creation_time
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS face_encodings_creation_time_idx
+    ON public.face_encodings (creation_time)
+    """)
+
+    # last run of periodic jobs, shared by all app processes
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS public.scheduled_jobs
+    (
+        name character varying COLLATE pg_catalog."default" NOT NULL,
+        last_run timestamp with time zone NOT NULL,
+        CONSTRAINT scheduled_jobs_pkey PRIMARY KEY (name)
+    )
+    """)
+
+    # queue of outgoing emails, drained by the outbox worker
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS public.email_outbox
+    (
+        email_id uuid NOT NULL DEFAULT uuid_generate_v4(),
+        send_to character varying COLLATE pg_catalog."default" NOT NULL,
+        message text COLLATE pg_catalog."default" NOT NULL,
+        attempts integer NOT NULL DEFAULT 0,
+        next_attempt timestamp with time zone NOT NULL DEFAULT now(),
+        last_error character varying COLLATE pg_catalog."default",
+        created_at timestamp with time zone NOT NULL DEFAULT now(),
+        sent_at timestamp with time zone,
+        CONSTRAINT email_outbox_pkey PRIMARY KEY (email_id)
+    )
+    """)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS email_outbox_pending_idx
+    ON public.email_outbox (next_attempt) WHERE sent_at IS NULL
+    """)
+
     cur.close()
     conn.commit()
     conn.close()
@@ -0,0 +1,272 @@
+import fcntl
+import os
+import shutil
+import threading
+import numpy as np
+from time import monotonic, time_ns
+from app.config import ENCODING_SNAPSHOT, ENCODING_SNAPSHOT_DIR, ENCODING_SNAPSHOT_DELAY, ENCODING_QUANTIZE
+from app.database import borrow
+from app.encoding_store import ENCODING_COLUMNS, ENCODING_SIZE, decode, quantize, course_encodings
+
+# snapshot of every course's encodings in .npy files, memory mapped read-only by every server process
+# on the host, so the matrices are loaded once into the page cache instead of once per process
+#
+# <dir>/CURRENT      name of the newest snapshot directory
+# <dir>/changes      a header holding its generation, then one byte appended per encoding or registration
+#                    change; (generation, size) is the change stamp. a build that absorbed every change
+#                    replaces it with an empty file of a new generation, so it does not grow forever
+# <dir>/build.lock   flock held by the one process writing a snapshot
+# <dir>/<version>/   matrix, errors, scales (int8 only), rolls and ids, one row per course and encoding,
+#                    grouped by course and sorted by roll num inside a course, so course k owns the
+#                    zero-copy slice course_rows[k]:course_rows[k + 1]; registered[course_registered[k]:
+#                    course_registered[k + 1]] are its registered students; stamp is the change stamp
+#                    the snapshot was read at
+
+HEADER_SIZE = 20 # generation, zero padded, files written without one are generation 0
+
+# change stamp of an open changes file
+def _read_stamp(f):
+    header = f.read(HEADER_SIZE)
+    generation = int(header) if len(header) == HEADER_SIZE and header.isdigit() else 0
+    return (generation, os.fstat(f.fileno()).st_size)
+
+class encoding_snapshot:
+    def __init__(self, path):
+        def load(name):
+            return np.load(os.path.join(path, name + ".npy"), mmap_mode='r')
+        self.version = os.path.basename(path)
+        self.stamp = tuple(int(part) for part in load("stamp"))
+        self.matrix = load("matrix")
+        self.errors = load("errors")
+        self.scales = load("scales") if os.path.exists(os.path.join(path, "scales.npy")) else None
+        self.rolls = load("rolls")
+        self.ids = load("ids")
+        self.course_rows = np.array(load("course_rows"))
+        self.registered = load("registered")
+        self.course_registered = np.array(load("course_registered"))
+        self._courses = {str(course_id) : k for k, course_id in enumerate(load("courses"))}
+
+    # nothing changed since the snapshot was read
+    def fresh(self, stamp):
+        return self.stamp[0] == stamp[0] and self.stamp[1] >= stamp[1]
+
+    def __contains__(self, course_id):
+        return course_id in self._courses
+
+    # course_encodings of one course on top of the mapped arrays, None for courses without registrations
+    def course(self, course_id):
+        k = self._courses.get(course_id)
+        if k is None:
+            return None
+        lo, hi = self.course_rows[k], self.course_rows[k + 1]
+        registered = set(str(roll) for roll in self.registered[self.course_registered[k]:self.course_registered[k + 1]])
+        present = set(str(roll) for roll in np.unique(self.rolls[lo:hi]))
+        missing = [roll for roll in sorted(registered) if roll not in present]
+        entry = course_encodings(course_id, self.rolls[lo:hi], self.matrix[lo:hi], missing, registered,
+                                 self.ids[lo:hi], scales=None if self.scales is None else self.scales[lo:hi],
+                                 errors=self.errors[lo:hi])
+        entry.version = self.version
+        return entry
+
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.matrix, self.errors, self.rolls, self.ids, self.registered))
+
+# finds, maps and rebuilds snapshots under root, one per process
+# a snapshot older than the newest change is not used, courses are then loaded from the database
+# as before until one process has written a fresh snapshot in the background
+class snapshot_store:
+    def __init__(self, root, delay, quantize = "none"):
+        self.root = root
+        self.delay = delay # seconds between rebuild attempts of this process
+        self.quantize = quantize
+        os.makedirs(root, exist_ok=True)
+        self._changes = os.path.join(root, "changes")
+        self._pointer = os.path.join(root, "CURRENT")
+        self._current = None
+        self._pointer_mtime = None
+        self._lock = threading.Lock()
+        self._building = False
+        self._last_attempt = None
+        self._counters = {
+            "builds" : 0,
+            "build_time" : 0.0,
+            "maps" : 0,
+            "stale" : 0,
+        }
+
+    def stamp(self):
+        try:
+            with open(self._changes, "rb") as f:
+                return _read_stamp(f)
+        except FileNotFoundError:
+            return (0, 0)
+
+    # encodings or registrations changed somewhere, every process stops using the current snapshot
+    # the shared lock keeps build() from replacing the file between the open and the write,
+    # a file replaced before the lock was taken is reopened
+    def touch(self):
+        while True:
+            with open(self._changes, "ab") as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                try:
+                    replaced = os.fstat(f.fileno()).st_ino != os.stat(self._changes).st_ino
+                except FileNotFoundError:
+                    replaced = True
+                if not replaced:
+                    f.write(b"\0")
+                    return
+
+    # map the snapshot CURRENT points to when it changed since the last call
+    def _refresh(self):
+        try:
+            mtime = os.stat(self._pointer).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._pointer_mtime:
+            return
+        with open(self._pointer) as f:
+            version = f.read().strip()
+        with self._lock:
+            if self._current is None or self._current.version != version:
+                try:
+                    self._current = encoding_snapshot(os.path.join(self.root, version))
+                    self._counters["maps"] += 1
+                except FileNotFoundError:
+                    return # replaced again while reading, picked up on the next call
+            self._pointer_mtime = mtime
+
+    # the snapshot to use, None while there is none or it is older than the last change
+    def current(self):
+        self._refresh()
+        snapshot = self._current
+        if snapshot is None or not snapshot.fresh(self.stamp()):
+            with self._lock:
+                self._counters["stale"] += 1
+            self._schedule()
+            return None
+        return snapshot
+
+    def _schedule(self):
+        with self._lock:
+            if self._building or (self._last_attempt is not None and monotonic() - self._last_attempt < self.delay):
+                return
+            self._building = True
+            self._last_attempt = monotonic()
+        threading.Thread(target=self._background_build, name="encoding_snapshot", daemon=True).start()
+
+    def _background_build(self):
+        try:
+            with borrow() as conn:
+                self.build(conn)
+        except Exception as error:
+            print('encoding snapshot build failed: ', error)
+        finally:
+            with self._lock:
+                self._building = False
+
+    # write a fresh snapshot from the database and point CURRENT at it
+    # returns False when another process is already writing one
+    def build(self, conn):
+        with open(os.path.join(self.root, "build.lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            started = monotonic()
+            # read before the rows, a change landing in between leaves the snapshot stale, not wrong
+            stamp = self.stamp()
+            cur = conn.cursor()
+            cur.execute(f"""
+                        SELECT r.course_id, r.student_roll, {ENCODING_COLUMNS}, encoding_id
+                        FROM course_registrations r
+                        LEFT JOIN face_encodings ON face_encodings.roll_num = r.student_roll
+                        ORDER BY r.course_id, r.student_roll
+                        """)
+            rows = cur.fetchall()
+            conn.commit()
+            cur.close()
+            courses = []
+            course_rows = [0]
+            registered = []
+            course_registered = [0]
+            rolls = []
+            ids = []
+            encodings = []
+            for course_id, roll_num, embedding, legacy, encoding_id in rows:
+                course_id = str(course_id)
+                if len(courses) == 0 or courses[-1] != course_id:
+                    if len(courses) > 0:
+                        course_rows.append(len(rolls))
+                        course_registered.append(len(registered))
+                    courses.append(course_id)
+                if len(registered) == course_registered[-1] or registered[-1] != roll_num:
+                    registered.append(roll_num)
+                if embedding is not None or legacy is not None:
+                    rolls.append(roll_num)
+                    ids.append(str(encoding_id))
+                    encodings.append(decode(embedding, legacy))
+            course_rows.append(len(rolls))
+            course_registered.append(len(registered))
+            matrix = np.vstack(encodings) if len(encodings) > 0 else np.empty((0, ENCODING_SIZE), dtype=np.float32)
+            codes, scales, errors = quantize(matrix, self.quantize)
+            version = str(time_ns())
+            tmp = os.path.join(self.root, "." + version)
+            os.makedirs(tmp)
+            arrays = {
+                "matrix" : np.ascontiguousarray(codes),
+                "errors" : errors,
+                "rolls" : np.array(rolls, dtype=str),
+                "ids" : np.array(ids, dtype=str),
+                "courses" : np.array(courses, dtype=str),
+                "course_rows" : np.array(course_rows, dtype=np.int64),
+                "registered" : np.array(registered, dtype=str),
+                "course_registered" : np.array(course_registered, dtype=np.int64),
+            }
+            if scales is not None:
+                arrays["scales"] = scales
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp, name + ".npy"), array)
+            with open(self._changes, "a+b") as changes:
+                fcntl.flock(changes, fcntl.LOCK_EX)
+                changes.seek(0)
+                if _read_stamp(changes) == stamp:
+                    # nothing changed while reading, start the next generation from an empty file
+                    with open(self._changes + ".tmp", "wb") as f:
+                        f.write(f"{version:0>{HEADER_SIZE}}".encode())
+                    stamp = (int(version), HEADER_SIZE)
+                    os.replace(self._changes + ".tmp", self._changes)
+                np.save(os.path.join(tmp, "stamp.npy"), np.array(stamp, dtype=np.int64))
+                os.rename(tmp, os.path.join(self.root, version))
+                with open(self._pointer + ".tmp", "w") as f:
+                    f.write(version)
+                os.replace(self._pointer + ".tmp", self._pointer)
+            # processes still mapping an older snapshot keep reading it after it is unlinked
+            for name in os.listdir(self.root):
+                path = os.path.join(self.root, name)
+                if os.path.isdir(path) and name != version:
+                    shutil.rmtree(path, ignore_errors=True)
+            with self._lock:
+                self._counters["builds"] += 1
+                self._counters["build_time"] += monotonic() - started
+            return True
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["building"] = self._building
+            snapshot = self._current
+        stats["stamp"] = self.stamp()
+        if snapshot is not None:
+            stats["version"] = snapshot.version
+            stats["snapshot_stamp"] = snapshot.stamp
+            stats["bytes"] = int(snapshot.nbytes())
+        return stats
+
+_store = None
+
+# the process's snapshot_store, created on first use and only when ENCODING_SNAPSHOT is on, None otherwise
+def encoding_snapshots():
+    global _store
+    if _store is None and ENCODING_SNAPSHOT:
+        _store = snapshot_store(ENCODING_SNAPSHOT_DIR, ENCODING_SNAPSHOT_DELAY, ENCODING_QUANTIZE)
+    return _store
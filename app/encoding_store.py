@@ -0,0 +1,386 @@
+import copy
+import itertools
+import threading
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+from time import monotonic
+from app.cache import ttl_cache
+from app.config import ENCODING_CACHE_SIZE, ENCODING_CACHE_TTL, ENCODING_QUANTIZE
+
+# face encodings are stored as raw little-endian float64 in face_encodings.embedding
+# rows written before the migration only have the legacy numeric[] face_encoding column
+ENCODING_DTYPE = np.dtype('<f8')
+ENCODING_SIZE = 128
+
+def to_bytes(face_enc):
+    return psycopg2.Binary(np.asarray(face_enc, dtype=ENCODING_DTYPE).tobytes())
+
+def from_bytes(buf):
+    return np.frombuffer(buf, dtype=ENCODING_DTYPE)
+
+# select list that works for both migrated and legacy rows, the numeric[] is cast
+# to float8[] in postgres so psycopg2 hands back floats instead of Decimals
+ENCODING_COLUMNS = "embedding, CASE WHEN embedding IS NULL THEN face_encoding::float8[] END"
+
+# decode the two columns selected with ENCODING_COLUMNS
+def decode(embedding, legacy):
+    if embedding is not None:
+        return from_bytes(embedding)
+    return np.array(legacy, dtype=ENCODING_DTYPE)
+
+# insert new encodings of one student in a single statement, returns their encoding_ids
+def insert_encodings(cur, roll_num, face_encs, creation_time):
+    rows = execute_values(cur, """
+                          INSERT INTO face_encodings
+                          (roll_num, embedding, creation_time)
+                          VALUES %s
+                          RETURNING encoding_id
+                          """,
+                          [(roll_num, to_bytes(face_enc), creation_time) for face_enc in face_encs],
+                          fetch=True)
+    return [row[0] for row in rows]
+
+# in-memory forms of the course matrices, ENCODING_QUANTIZE picks one
+# float16 halves and int8 (one float32 scale per row) quarters the memory of float32
+QUANTIZE_DTYPES = {
+    "none" : np.float32,
+    "float16" : np.float16,
+    "int8" : np.int8,
+}
+
+# returns (codes, per-row scales or None, per-row error), error is the euclidean distance
+# between an encoding and its quantized form, so it bounds how far any distance computed
+# on the quantized form can be off
+def quantize(matrix, mode):
+    matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+    if mode == "int8":
+        scales = np.maximum(np.abs(matrix).max(axis=1, initial=0) / 127, 1e-12).astype(np.float32)
+        codes = np.round(matrix / scales[:, None]).astype(np.int8)
+        approx = codes * scales[:, None]
+    else:
+        scales = None
+        codes = matrix.astype(QUANTIZE_DTYPES[mode])
+        approx = codes.astype(np.float32)
+    diff = matrix - approx
+    return codes, scales, np.sqrt(np.einsum('ij,ij->i', diff, diff)).astype(np.float32)
+
+_serials = itertools.count()
+
+DENSE_BLOCK = 4096 # rows of a quantized matrix converted to float32 at once by course_encodings.dot
+
+# encodings of every student registered for a course, ready for matching
+# matrix is a contiguous N x 128 array, float32 or quantized with quantize(), rolls[i] owns matrix[i]
+# and ids[i] is its encoding_id
+class course_encodings:
+    def __init__(self, course_id, rolls, matrix, missing, registered, ids = None, previous = None, touched = (),
+                 scales = None, errors = None):
+        self.course_id = course_id
+        self.rolls = rolls
+        self.matrix = matrix
+        self.scales = scales
+        self.errors = np.zeros(len(rolls), dtype=np.float32) if errors is None else errors
+        self.ids = ids
+        self.version = None # snapshot the entry was mapped from
+        self.serial = next(_serials) # unique in this process, entries are never changed in place
+        self.missing = missing # registered students without any encoding
+        self.registered = registered # set of every registered roll num
+        dense = self.dense()
+        self.sq_norms = np.einsum('ij,ij->i', dense, dense)
+        # rolls are sorted, so each student's encodings are a contiguous block of rows
+        # students[k] owns rows offsets[k] up to offsets[k + 1]
+        self.students, self.offsets = np.unique(rolls, return_index=True)
+        self.counts = np.diff(np.append(self.offsets, len(rolls)))
+        self._prototypes(dense, previous, touched)
+
+    @property
+    def quantized(self):
+        return self.matrix.dtype != np.float32
+
+    # float32 form of matrix, the matrix itself when it is not quantized
+    def dense(self):
+        if self.scales is not None:
+            return self.matrix * self.scales[:, None]
+        return self.matrix.astype(np.float32, copy=False)
+
+    # faces @ dense().T without a float32 copy of the whole matrix, a quantized matrix is
+    # converted DENSE_BLOCK rows at a time, int8 rows are scaled after the product
+    def dot(self, faces):
+        if not self.quantized:
+            return faces @ self.matrix.T
+        out = np.empty((len(faces), len(self)), dtype=np.float32)
+        for lo in range(0, len(self), DENSE_BLOCK):
+            block = self.matrix[lo:lo + DENSE_BLOCK].astype(np.float32)
+            np.matmul(faces, block.T, out=out[:, lo:lo + DENSE_BLOCK])
+            if self.scales is not None:
+                out[:, lo:lo + DENSE_BLOCK] *= self.scales[None, lo:lo + DENSE_BLOCK]
+        return out
+
+    # centroid of every student's encodings and the radius around it holding all of them,
+    # copied from previous for students whose encodings are not in touched
+    # quantization errors are added on, so the radius and slack hold for the exact encodings
+    def _prototypes(self, dense, previous, touched):
+        self.centroids = np.empty((len(self.students), dense.shape[1]), dtype=np.float32)
+        self.radii = np.empty(len(self.students), dtype=np.float32)
+        self.slack = np.empty(len(self.students), dtype=np.float32) # largest quantization error
+        todo = np.ones(len(self.students), dtype=bool)
+        if previous is not None and len(previous.students) > 0 and len(self.students) > 0:
+            pos = np.minimum(np.searchsorted(previous.students, self.students), len(previous.students) - 1)
+            reuse = (previous.students[pos] == self.students) & ~np.isin(self.students, list(touched))
+            self.centroids[reuse] = previous.centroids[pos[reuse]]
+            self.radii[reuse] = previous.radii[pos[reuse]]
+            self.slack[reuse] = previous.slack[pos[reuse]]
+            todo = ~reuse
+        if todo.any():
+            counts = self.counts[todo]
+            selected = np.repeat(todo, self.counts)
+            rows = dense[selected]
+            errors = self.errors[selected]
+            offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            centroids = np.add.reduceat(rows, offsets) / counts[:, None]
+            diff = rows - np.repeat(centroids, counts, axis=0)
+            self.centroids[todo] = centroids
+            self.radii[todo] = np.maximum.reduceat(np.sqrt(np.einsum('ij,ij->i', diff, diff)) + errors, offsets)
+            self.slack[todo] = np.maximum.reduceat(errors, offsets)
+        self.centroid_sq = np.einsum('ij,ij->i', self.centroids, self.centroids)
+
+    def __len__(self):
+        return len(self.rolls)
+
+    def nbytes(self):
+        nbytes = self.matrix.nbytes + self.rolls.nbytes + self.sq_norms.nbytes + self.errors.nbytes
+        nbytes += self.centroids.nbytes + self.radii.nbytes + self.slack.nbytes
+        if self.scales is not None:
+            nbytes += self.scales.nbytes
+        return nbytes
+
+    def _take(self, rows):
+        scales = None if self.scales is None else self.scales[rows]
+        ids = None if self.ids is None else self.ids[rows]
+        return self.rolls[rows], self.matrix[rows], scales, self.errors[rows], ids
+
+    # only the students where keep (a mask over students) is true
+    # every derived array is sliced from this entry, nothing is recomputed
+    def subset(self, keep):
+        rows = np.repeat(keep, self.counts)
+        entry = copy.copy(self)
+        entry.rolls, entry.matrix, entry.scales, entry.errors, entry.ids = self._take(rows)
+        entry.serial = next(_serials)
+        entry.sq_norms = self.sq_norms[rows]
+        entry.students = self.students[keep]
+        entry.counts = self.counts[keep]
+        entry.offsets = np.cumsum(np.append(0, entry.counts))[:-1]
+        entry.centroids = self.centroids[keep]
+        entry.radii = self.radii[keep]
+        entry.slack = self.slack[keep]
+        entry.centroid_sq = self.centroid_sq[keep]
+        return entry
+
+    # float32 copy for exact re-scoring, rows are taken from load(ids) -> {encoding_id : encoding}
+    # rows it does not return, or everything without a loader, keep the dequantized value
+    def exact(self, load = None):
+        if not self.quantized:
+            return self
+        matrix = np.array(self.dense(), dtype=np.float32)
+        errors = self.errors.copy()
+        if load is not None and self.ids is not None and len(self.ids) > 0:
+            found = load(list(self.ids))
+            for k, encoding_id in enumerate(self.ids):
+                if encoding_id in found:
+                    matrix[k] = found[encoding_id]
+                    errors[k] = 0
+        return course_encodings(self.course_id, self.rolls, matrix, self.missing, self.registered, self.ids,
+                                previous=self, errors=errors)
+
+    # copy with the removed encoding_ids dropped and new encodings of roll_num added, quantized the same way,
+    # prototypes are recomputed only for the students that changed
+    def patch(self, removed, roll_num = None, ids = (), encodings = ()):
+        keep = ~np.isin(self.ids, list(removed))
+        touched = set(self.rolls[~keep])
+        rolls, matrix, scales, errors, kept_ids = self._take(keep)
+        if roll_num in self.registered and len(ids) > 0:
+            touched.add(roll_num)
+            mode = "int8" if self.scales is not None else ("float16" if self.matrix.dtype == np.float16 else "none")
+            codes, new_scales, new_errors = quantize(encodings, mode)
+            rolls = np.concatenate([rolls, np.array([roll_num] * len(ids), dtype=str)])
+            matrix = np.vstack([matrix, codes])
+            if scales is not None:
+                scales = np.concatenate([scales, new_scales])
+            errors = np.concatenate([errors, new_errors])
+            kept_ids = np.concatenate([kept_ids, np.array(ids, dtype=object)])
+        order = np.argsort(rolls, kind='stable')
+        present = set(rolls)
+        missing = [str(roll) for roll in sorted(self.registered) if roll not in present]
+        return course_encodings(self.course_id, rolls[order], np.ascontiguousarray(matrix[order]), missing,
+                                self.registered, kept_ids[order], previous=self, touched=touched,
+                                scales=None if scales is None else scales[order], errors=errors[order])
+
+# exact encodings by encoding_id, for re-scoring quantized candidates
+def load_encodings(conn, ids):
+    cur = conn.cursor()
+    cur.execute(f"SELECT encoding_id, {ENCODING_COLUMNS} FROM face_encodings WHERE encoding_id = ANY(%s::uuid[])",
+                (list(ids), ))
+    rows = cur.fetchall()
+    cur.close()
+    return {row[0] : decode(row[1], row[2]) for row in rows}
+
+# per-course cache of course_encodings
+# entries are patched when encodings are added or expired and dropped when registrations change,
+# the ttl only bounds staleness from writes made by other server processes
+class encoding_cache:
+    def __init__(self, maxsize, ttl, quantize = "none"):
+        if quantize not in QUANTIZE_DTYPES:
+            raise ValueError(f"ENCODING_QUANTIZE must be one of {', '.join(QUANTIZE_DTYPES)}, not {quantize}")
+        self._cache = ttl_cache(maxsize, ttl)
+        self.quantize = quantize
+        self.snapshots = None
+        self._lock = threading.Lock()
+        self._latency = {} # course_id -> recognition timings of its lectures
+        self._generation = 0 # bumped on every invalidation, stops racing builds from caching stale data
+        self._counters = {
+            "builds" : 0,
+            "build_time" : 0.0,
+            "invalidations" : 0,
+            "patches" : 0,
+            "mapped" : 0,
+        }
+
+    # load courses from a shared snapshot_store when it is fresh, the database otherwise
+    def use_snapshots(self, store):
+        self.snapshots = store
+
+    def get(self, course_id, conn):
+        course_id = str(course_id)
+        entry = self._cache.get(course_id)
+        snapshot = None if self.snapshots is None else self.snapshots.current()
+        if entry is not None and entry.version is not None and (snapshot is None or entry.version != snapshot.version):
+            # mapped from a snapshot a change has made stale since, remapped below or reloaded
+            self._cache.pop(course_id)
+            entry = None
+        if snapshot is not None and course_id in snapshot and (entry is None or entry.version != snapshot.version):
+            entry = snapshot.course(course_id)
+            if entry is not None:
+                with self._lock:
+                    self._counters["mapped"] += 1
+                self._cache.put(course_id, entry)
+        if entry is None:
+            with self._lock:
+                generation = self._generation
+            started = monotonic()
+            entry = self._build(course_id, conn)
+            with self._lock:
+                self._counters["builds"] += 1
+                self._counters["build_time"] += monotonic() - started
+                if generation == self._generation:
+                    self._cache.put(course_id, entry)
+        return entry
+
+    def _build(self, course_id, conn):
+        cur = conn.cursor()
+        cur.execute(f"""
+                    SELECT r.student_roll, {ENCODING_COLUMNS}, encoding_id
+                    FROM course_registrations r
+                    LEFT JOIN face_encodings ON face_encodings.roll_num = r.student_roll
+                    WHERE r.course_id = %s
+                    ORDER BY r.student_roll
+                    """,
+                    (course_id, ))
+        rows = cur.fetchall()
+        cur.close()
+        rolls = []
+        encodings = []
+        ids = []
+        missing = []
+        for row in rows:
+            if row[1] is None and row[2] is None:
+                missing.append(row[0])
+            else:
+                rolls.append(row[0])
+                encodings.append(decode(row[1], row[2]))
+                ids.append(row[3])
+        if len(encodings) > 0:
+            matrix = np.vstack(encodings)
+        else:
+            matrix = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        codes, scales, errors = quantize(matrix, self.quantize)
+        registered = set(row[0] for row in rows)
+        return course_encodings(course_id, np.array(rolls, dtype=str), np.ascontiguousarray(codes), missing,
+                                registered, np.array(ids, dtype=object), scales=scales, errors=errors)
+
+    def _bump(self):
+        with self._lock:
+            self._generation += 1
+            self._counters["invalidations"] += 1
+        if self.snapshots is not None:
+            self.snapshots.touch()
+
+    # registrations of a course changed
+    def invalidate_course(self, course_id):
+        self._bump()
+        self._cache.pop(str(course_id))
+
+    # encodings of these students changed
+    def invalidate_students(self, roll_nums):
+        roll_nums = set(roll_nums)
+        if len(roll_nums) == 0:
+            return 0
+        self._bump()
+        return self._cache.evict_where(lambda k, v: not v.registered.isdisjoint(roll_nums))
+
+    # encodings were deleted (removed encoding_ids) or added for roll_num,
+    # cached courses holding them are patched without going back to the database
+    def update(self, removed = (), roll_num = None, ids = (), encodings = ()):
+        removed = set(removed)
+        if len(removed) == 0 and len(ids) == 0:
+            return 0
+        self._bump()
+        def patch(course_id, entry):
+            if (roll_num in entry.registered and len(ids) > 0) or np.isin(entry.ids, list(removed)).any():
+                return entry.patch(removed, roll_num, ids, encodings)
+            return entry
+        with self._lock:
+            patched = self._cache.replace_where(patch)
+            self._counters["patches"] += patched
+        return patched
+
+    def clear(self):
+        self._bump()
+        self._cache.clear()
+
+    # timings of one lecture photo of the course, a stage_timer
+    def record(self, course_id, timer):
+        with self._lock:
+            latency = self._latency.setdefault(str(course_id), {"requests" : 0, "total_ms" : 0.0, "max_ms" : 0.0,
+                                                                "match_ms" : 0.0})
+            total = sum(timer.stages.values()) * 1000
+            latency["requests"] += 1
+            latency["total_ms"] += total
+            latency["max_ms"] = max(latency["max_ms"], total)
+            latency["match_ms"] += timer.stages.get("match", 0.0) * 1000
+
+    def stats(self):
+        stats = self._cache.stats()
+        with self._lock:
+            stats.update(self._counters)
+        stats["quantize"] = self.quantize
+        return stats
+
+    # memory of every cached course and recognition latency of every course seen
+    def course_stats(self):
+        with self._lock:
+            courses = {course_id : dict(latency) for course_id, latency in self._latency.items()}
+        for course in courses.values():
+            course["avg_ms"] = round(course["total_ms"] / course["requests"], 2)
+            course["avg_match_ms"] = round(course.pop("match_ms") / course["requests"], 3)
+            course["total_ms"] = round(course["total_ms"], 2)
+            course["max_ms"] = round(course["max_ms"], 2)
+        for course_id, entry in self._cache.items():
+            courses.setdefault(course_id, {}).update({
+                "encodings" : len(entry),
+                "students" : len(entry.students),
+                "dtype" : str(entry.matrix.dtype),
+                "bytes" : int(entry.nbytes()),
+            })
+        return courses
+
+course_cache = encoding_cache(ENCODING_CACHE_SIZE, ENCODING_CACHE_TTL, ENCODING_QUANTIZE)
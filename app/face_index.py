@@ -0,0 +1,304 @@
+import copy
+import threading
+import numpy as np
+from time import monotonic
+from app.config import FACE_INDEX_NPROBE, FACE_INDEX_REFRESH, FACE_INDEX_MIN_TRAIN
+from app.database import borrow
+from app.encoding_store import ENCODING_COLUMNS, ENCODING_SIZE, decode
+from app.recognition import recognition_error
+
+# inverted file index over every face encoding on campus
+# encodings are clustered around nlist k-means centroids, a query only scans the rows of its
+# nprobe closest clusters, so its cost grows with sqrt(N) instead of N
+# below FACE_INDEX_MIN_TRAIN rows there is a single cluster and every query is exact
+
+def _kmeans(data, nlist, iterations = 8, seed = 0):
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), nlist, replace=False)].copy()
+    data_sq = np.einsum('ij,ij->i', data, data)
+    for _ in range(iterations):
+        dist = data_sq[:, None] + np.einsum('ij,ij->i', centroids, centroids)[None, :] - 2 * (data @ centroids.T)
+        labels = np.argmin(dist, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, data)
+        counts = np.bincount(labels, minlength=nlist)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # an empty cluster restarts on a random point
+        empty = np.nonzero(~filled)[0]
+        if len(empty) > 0:
+            centroids[empty] = data[rng.choice(len(data), len(empty))]
+    return centroids
+
+class _ivf:
+    def __init__(self, centroids):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.centroid_sq = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        self.vectors = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        self.alive = np.zeros(0, dtype=bool)
+        self.rolls = []
+        self.ids = []
+        self.rows = {} # encoding_id -> row
+        self.lists = [np.empty(0, dtype=np.int64) for _ in range(len(self.centroids))]
+        self.size = 0 # rows used, including deleted ones
+        self.dead = 0
+
+    @classmethod
+    def train(cls, ids, rolls, encodings):
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        if len(encodings) < FACE_INDEX_MIN_TRAIN:
+            centroids = np.zeros((1, ENCODING_SIZE), dtype=np.float32)
+        else:
+            nlist = min(int(np.sqrt(len(encodings))), 1024)
+            sample = encodings
+            if len(encodings) > 50 * nlist:
+                sample = encodings[np.random.default_rng(0).choice(len(encodings), 50 * nlist, replace=False)]
+            centroids = _kmeans(sample, nlist)
+        index = cls(centroids)
+        index.add(ids, rolls, encodings)
+        return index
+
+    def _nearest_lists(self, encodings, nprobe):
+        dist = self.centroid_sq[None, :] - 2 * (encodings @ self.centroids.T)
+        nprobe = min(nprobe, len(self.centroids))
+        if nprobe == len(self.centroids):
+            return np.tile(np.arange(nprobe), (len(encodings), 1))
+        return np.argpartition(dist, nprobe - 1, axis=1)[:, :nprobe]
+
+    def _grow(self, extra):
+        needed = self.size + extra
+        if needed > len(self.vectors):
+            capacity = max(needed, 2 * len(self.vectors), 64)
+            vectors = np.empty((capacity, ENCODING_SIZE), dtype=np.float32)
+            vectors[:self.size] = self.vectors[:self.size]
+            alive = np.zeros(capacity, dtype=bool)
+            alive[:self.size] = self.alive[:self.size]
+            self.vectors, self.alive = vectors, alive
+
+    def add(self, ids, rolls, encodings):
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        fresh = [k for k, encoding_id in enumerate(ids) if encoding_id not in self.rows]
+        if len(fresh) == 0:
+            return 0
+        encodings = encodings[fresh]
+        self._grow(len(fresh))
+        rows = np.arange(self.size, self.size + len(fresh))
+        self.vectors[rows] = encodings
+        self.alive[rows] = True
+        for row, k in zip(rows, fresh):
+            self.rows[ids[k]] = int(row)
+            self.ids.append(ids[k])
+            self.rolls.append(rolls[k])
+        self.size += len(fresh)
+        labels = self._nearest_lists(encodings, 1)[:, 0]
+        for label in np.unique(labels):
+            self.lists[label] = np.concatenate([self.lists[label], rows[labels == label]])
+        return len(fresh)
+
+    def remove(self, ids):
+        removed = 0
+        for encoding_id in ids:
+            row = self.rows.pop(encoding_id, None)
+            if row is not None:
+                self.alive[row] = False
+                removed += 1
+        self.dead += removed
+        return removed
+
+    def remove_students(self, roll_nums):
+        roll_nums = set(roll_nums)
+        return self.remove([self.ids[row] for row in self.rows.values() if self.rolls[row] in roll_nums])
+
+    def remove_all(self):
+        return self.remove(list(self.rows))
+
+    # a copy to search without the lock while writes go on in the original: rows are only ever
+    # appended, so vectors and rolls are shared, the alive flags and list heads are copied
+    def snapshot(self):
+        view = copy.copy(self)
+        view.alive = self.alive.copy()
+        view.lists = list(self.lists)
+        view.rows = None
+        return view
+
+    # k closest students to every query encoding, [[(roll_num, distance)]]
+    # exclude[q] optionally names a roll num to leave out of query q
+    def search(self, encodings, k, nprobe, exclude = None):
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        if len(encodings) == 0 or not self.alive[:self.size].any():
+            return [[] for _ in range(len(encodings))]
+        probes = self._nearest_lists(encodings, nprobe)
+        results = []
+        for q, encoding in enumerate(encodings):
+            rows = np.concatenate([self.lists[label] for label in probes[q]])
+            rows = rows[self.alive[rows]]
+            diff = self.vectors[rows] - encoding
+            dist = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+            best = {}
+            for idx in np.argsort(dist):
+                roll = self.rolls[rows[idx]]
+                if roll in best or (exclude is not None and roll == exclude[q]):
+                    continue
+                best[roll] = float(dist[idx])
+                if len(best) == k:
+                    break
+            results.append(list(best.items()))
+        return results
+
+    def stats(self):
+        sizes = [len(rows) for rows in self.lists]
+        return {
+            "encodings" : len(self.rows),
+            "deleted" : self.dead,
+            "lists" : len(self.lists),
+            "largest_list" : max(sizes, default=0),
+        }
+
+def _load(conn):
+    cur = conn.cursor()
+    cur.execute(f"SELECT encoding_id, roll_num, {ENCODING_COLUMNS} FROM face_encodings")
+    rows = cur.fetchall()
+    conn.commit()
+    cur.close()
+    ids = [row[0] for row in rows]
+    rolls = [row[1] for row in rows]
+    encodings = [decode(row[2], row[3]) for row in rows]
+    return ids, rolls, encodings
+
+# campus-wide index kept up to date by the write paths, fully rebuilt from the table in the
+# background every FACE_INDEX_REFRESH seconds (other server processes only reach it that way),
+# or when too many rows were deleted; writes made during a rebuild are replayed on the new index
+# the first build starts with the server, searches are refused with a 503 until it is done
+class face_index:
+    def __init__(self, nprobe, refresh):
+        self.nprobe = nprobe
+        self.refresh = refresh
+        self._index = None
+        self._built = 0.0
+        self._lock = threading.RLock()
+        self._journal = None # writes seen while a rebuild is running
+        self._rebuilding = False
+        self._counters = {
+            "rebuilds" : 0,
+            "rebuild_time" : 0.0,
+            "queries" : 0,
+            "inserted" : 0,
+            "removed" : 0,
+        }
+
+    # build in the background unless one is running already
+    def start(self):
+        with self._lock:
+            if self._rebuilding:
+                return
+        threading.Thread(target=self._background_rebuild, name="face_index", daemon=True).start()
+
+    def rebuild(self, conn = None):
+        with self._lock:
+            if self._rebuilding:
+                return False
+            self._rebuilding = True
+            self._journal = []
+        started = monotonic()
+        try:
+            if conn is None:
+                with borrow() as conn:
+                    index = _ivf.train(*_load(conn))
+            else:
+                index = _ivf.train(*_load(conn))
+            with self._lock:
+                for op, args in self._journal:
+                    getattr(index, op)(*args)
+                self._index = index
+                self._built = monotonic()
+                self._counters["rebuilds"] += 1
+                self._counters["rebuild_time"] += monotonic() - started
+        finally:
+            with self._lock:
+                self._rebuilding = False
+                self._journal = None
+        return True
+
+    # snapshot of the index to query, a stale index is still used while its rebuild runs
+    def _current(self):
+        with self._lock:
+            index = self._index
+            stale = index is None or (monotonic() - self._built > self.refresh
+                                      or index.dead > max(len(index.rows), 1000))
+            rebuilding = self._rebuilding
+            view = None if index is None else index.snapshot()
+        if stale and not rebuilding:
+            self.start()
+        if view is None:
+            raise recognition_error("Face index is still being built, please try again shortly", 503)
+        return view
+
+    def _background_rebuild(self):
+        try:
+            self.rebuild()
+        except Exception as error:
+            print('face index rebuild failed: ', error)
+
+    def _apply(self, op, *args):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append((op, args))
+            if self._index is None:
+                return 0
+            return getattr(self._index, op)(*args)
+
+    def add(self, ids, roll_num, encodings):
+        count = self._apply("add", list(ids), [roll_num] * len(ids), np.asarray(encodings))
+        self._counters["inserted"] += count or 0
+        return count
+
+    def remove(self, ids):
+        count = self._apply("remove", list(ids))
+        self._counters["removed"] += count or 0
+        return count
+
+    def remove_students(self, roll_nums):
+        count = self._apply("remove_students", list(roll_nums))
+        self._counters["removed"] += count or 0
+        return count
+
+    def clear(self):
+        count = self._apply("remove_all")
+        self._counters["removed"] += count or 0
+        return count
+
+    def search(self, encodings, k = 3, exclude = None):
+        index = self._current()
+        with self._lock:
+            self._counters["queries"] += len(encodings)
+        return index.search(encodings, k, self.nprobe, exclude)
+
+    # every stored encoding whose closest other student is within tolerance,
+    # the same face enrolled under two roll numbers or a photo uploaded for the wrong student
+    def suspicious(self, tolerance):
+        index = self._current()
+        rows = np.nonzero(index.alive[:index.size])[0]
+        encodings = index.vectors[rows]
+        rolls = [index.rolls[row] for row in rows]
+        ids = [index.ids[row] for row in rows]
+        found = index.search(encodings, 1, self.nprobe, rolls)
+        pairs = {}
+        for encoding_id, roll, neighbours in zip(ids, rolls, found):
+            if len(neighbours) > 0 and neighbours[0][1] <= tolerance:
+                other, dist = neighbours[0]
+                key = tuple(sorted((roll, other)))
+                if key not in pairs or dist < pairs[key]["distance"]:
+                    pairs[key] = {"students" : list(key), "distance" : round(dist, 4), "encoding_id" : encoding_id}
+        return sorted(pairs.values(), key=lambda pair: pair["distance"])
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["rebuilding"] = self._rebuilding
+            if self._index is not None:
+                stats.update(self._index.stats())
+                stats["age"] = round(monotonic() - self._built, 1)
+        stats["nprobe"] = self.nprobe
+        return stats
+
+campus_index = face_index(FACE_INDEX_NPROBE, FACE_INDEX_REFRESH)
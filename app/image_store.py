@@ -0,0 +1,164 @@
+import os
+import queue
+import threading
+from time import time, monotonic
+from app.config import IMG_CACHE_LOCATION, IMG_CACHE_MAX_BYTES, IMG_CACHE_MAX_AGE, IMG_CACHE_QUEUE
+from app.config import IMG_CACHE_SWEEP_INTERVAL
+
+# content-addressed store of uploaded photos under IMG_CACHE_LOCATION
+# a photo is kept as the bytes that were uploaded, at <root>/<first 2 hex digits>/<sha256>.<kind>,
+# so uploading the same photo twice stores it once
+# writes happen on a background thread, a hit only refreshes the file's mtime, which is what the
+# sweep evicts by: files older than max_age go first, then least recently used ones until the
+# directory is back under max_bytes; the writer thread also sweeps every sweep_interval seconds, the sweep
+# works from the directory itself, so it is correct with several server processes sharing it
+
+EXTENSIONS = {
+    "jpeg" : ".jpg",
+    "png" : ".png",
+    "webp" : ".webp",
+    "bmp" : ".bmp",
+}
+
+class image_store(threading.Thread):
+    def __init__(self, root, max_bytes, max_age, queue_size, sweep_interval):
+        super().__init__(name="image-store", daemon=True)
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age # seconds
+        self.sweep_interval = sweep_interval # seconds
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._bytes = None # disk usage, from the last sweep plus writes since
+        self._files = None
+        self._counters = {
+            "hits" : 0,
+            "misses" : 0,
+            "writes" : 0,
+            "write_errors" : 0,
+            "dropped" : 0,
+            "expired" : 0,
+            "evicted" : 0,
+            "sweeps" : 0,
+            "sweep_time" : 0.0,
+        }
+
+    def path(self, sha256, kind):
+        return os.path.join(self.root, sha256[:2], sha256 + EXTENSIONS.get(kind, ""))
+
+    def _count(self, name, amount = 1):
+        with self._lock:
+            self._counters[name] += amount
+
+    # store an uploads.upload, returns its path, which exists once the write has gone through
+    def put(self, upload):
+        path = self.path(upload.sha256, upload.kind)
+        try:
+            os.utime(path)
+            self._count("hits")
+            return path
+        except FileNotFoundError:
+            pass
+        self._count("misses")
+        try:
+            self._queue.put_nowait((path, upload.data))
+        except queue.Full:
+            # never hold up a request for the cache, the photo is just not kept
+            self._count("dropped")
+        return path
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._counters["writes"] += 1
+            if self._bytes is not None:
+                self._bytes += len(data)
+                self._files += 1
+            over = self._bytes is None or self._bytes > self.max_bytes
+        if over:
+            self.sweep()
+
+    def run(self):
+        next_sweep = monotonic()
+        while True:
+            if monotonic() >= next_sweep:
+                try:
+                    self.sweep()
+                except Exception as error:
+                    print('image store sweep failed: ', error)
+                next_sweep = monotonic() + self.sweep_interval
+            try:
+                item = self._queue.get(timeout=max(next_sweep - monotonic(), 0))
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            try:
+                self._write(*item)
+            except Exception as error:
+                self._count("write_errors")
+                print('image store write failed: ', error)
+
+    # writes still queued are finished first
+    def stop(self):
+        if self.is_alive():
+            self._queue.put(None)
+            self.join(timeout=10)
+
+    # enforce max_age and max_bytes, returns the number of files removed
+    def sweep(self):
+        started = monotonic()
+        files = []
+        # timestamp named photos written before the store sit directly in root and age out the same way
+        entries = list(os.scandir(self.root))
+        for shard in [entry for entry in entries if entry.is_dir()]:
+            entries += list(os.scandir(shard.path))
+        for entry in entries:
+            if entry.is_dir() or entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        now = time()
+        removed = {"expired" : 0, "evicted" : 0}
+        total = sum(size for _, size, _ in files)
+        kept = len(files)
+        # oldest mtime first, expired files lead the list
+        for mtime, size, path in sorted(files):
+            expired = now - mtime > self.max_age
+            if not expired and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            removed["expired" if expired else "evicted"] += 1
+            total -= size
+            kept -= 1
+        with self._lock:
+            self._bytes = total
+            self._files = kept
+            self._counters["expired"] += removed["expired"]
+            self._counters["evicted"] += removed["evicted"]
+            self._counters["sweeps"] += 1
+            self._counters["sweep_time"] += monotonic() - started
+        return removed["expired"] + removed["evicted"]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["bytes"] = self._bytes
+            stats["files"] = self._files
+        stats["queued"] = self._queue.qsize()
+        stats["max_bytes"] = self.max_bytes
+        stats["max_age"] = self.max_age
+        return stats
+
+image_cache = image_store(IMG_CACHE_LOCATION, IMG_CACHE_MAX_BYTES, IMG_CACHE_MAX_AGE, IMG_CACHE_QUEUE,
+                          IMG_CACHE_SWEEP_INTERVAL)
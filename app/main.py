@@ -1,5 +1,19 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, status
+from fastapi.responses import JSONResponse
 
+from app.auth import auth_error, token_cache
+from app.database import close_pool, pool_stats
+from app.send_email import smtp_mailer
+from app.encoding_store import course_cache
+from app.encoding_snapshot import encoding_snapshots
+from app.face_index import campus_index
+from app.recognition import recognition_stats, recognition_workers, recognition_error, detections, lecture_results
+from app import outbox
+from app.config import ENCODING_EXPIRY_INTERVAL, ENCODING_REMINDER_INTERVAL, ENCODING_SNAPSHOT
+from app.config import UPLOAD_MAX_BYTES, ENROLL_MAX_PHOTOS, VIDEO_MAX_BYTES
+from app.image_store import image_cache
+from app.uploads import upload_error, PAYLOAD_TOO_LARGE
+from app.scheduler import jobs
 from app.routers import users, students, encodings, professors, courses, lectures, registrations, attendances
 
 
@@ -14,6 +28,86 @@ app.include_router(lectures.router)
 app.include_router(registrations.router)
 app.include_router(attendances.router)
 
+@app.exception_handler(auth_error)
+async def auth_error_handler(request: Request, exc: auth_error):
+    return JSONResponse(status_code=status.HTTP_401_UNAUTHORIZED,
+                        content={"message" : exc.message})
+
+@app.exception_handler(recognition_error)
+async def recognition_error_handler(request: Request, exc: recognition_error):
+    return JSONResponse(status_code=exc.status_code,
+                        content={"message" : exc.message})
+
+@app.exception_handler(upload_error)
+async def upload_error_handler(request: Request, exc: upload_error):
+    return JSONResponse(status_code=exc.status_code,
+                        content={"message" : exc.message})
+
+# refuse bodies that can not fit the largest allowed upload before starlette spools them
+MAX_BODY_BYTES = max(UPLOAD_MAX_BYTES * ENROLL_MAX_PHOTOS, VIDEO_MAX_BYTES) + 1024 * 1024
+
+@app.middleware("http")
+async def limit_body_size(request: Request, call_next):
+    length = request.headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) > MAX_BODY_BYTES:
+        return JSONResponse(status_code=PAYLOAD_TOO_LARGE,
+                            content={"message" : "Request body is too large"})
+    return await call_next(request)
+
+@app.on_event("startup")
+def startup():
+    outbox.start()
+    jobs.every(ENCODING_EXPIRY_INTERVAL, encodings.expire_encodings)
+    jobs.every(ENCODING_REMINDER_INTERVAL, encodings.queue_encoding_reminders)
+    jobs.start()
+    image_cache.start()
+    recognition_workers.start()
+    campus_index.start()
+    if ENCODING_SNAPSHOT:
+        course_cache.use_snapshots(encoding_snapshots())
+        encoding_snapshots().current() # maps the newest snapshot, or starts writing one
+
+@app.on_event("shutdown")
+def shutdown():
+    jobs.stop()
+    recognition_workers.stop()
+    image_cache.stop()
+    outbox.stop()
+    smtp_mailer.closeall()
+    close_pool()
+
 @app.get("/")
 async def root():
-    return {"message" : "Welcome to the IIITR Connect API"}
\ No newline at end of file
+    return {"message" : "Welcome to the IIITR Connect API"}
+
+@app.get("/stats/pool")
+def get_pool_stats():
+    return pool_stats()
+
+@app.get("/stats/cache")
+def get_cache_stats():
+    return {
+        "tokens" : token_cache.stats(),
+        "smtp" : smtp_mailer.stats(),
+        "encodings" : course_cache.stats(),
+        "campus_index" : campus_index.stats(),
+        "snapshot" : encoding_snapshots().stats() if ENCODING_SNAPSHOT else None,
+        "images" : image_cache.stats(),
+        "detections" : detections.stats(),
+        "lecture_results" : lecture_results.stats(),
+    }
+
+@app.get("/stats/courses")
+def get_course_stats():
+    return course_cache.course_stats()
+
+@app.get("/stats/recognition")
+def get_recognition_stats():
+    return {
+        "stages" : recognition_stats.stats(),
+        "pool" : recognition_workers.stats(),
+    }
+
+@app.get("/stats/jobs")
+def get_job_stats():
+    return jobs.stats()
\ No newline at end of file
@@ -0,0 +1,90 @@
+import argparse
+from time import sleep, monotonic
+from psycopg2.extras import execute_values
+from app.database import borrow
+from app.encoding_store import to_bytes, ENCODING_DTYPE
+import numpy as np
+
+# online conversion of legacy numeric[] encodings into the bytea embedding column
+# every batch is its own short transaction and skips rows locked by the app,
+# so it can run while the server keeps serving requests
+# usage: python -m app.migrate_encodings [--batch 500] [--pause 0.1] [--clear-legacy]
+
+# convert one batch, returns number of rows converted
+def migrate_batch(conn, batch, clear_legacy = False):
+    cur = conn.cursor()
+    cur.execute("""
+                SELECT encoding_id, face_encoding::float8[] FROM face_encodings
+                WHERE embedding IS NULL AND face_encoding IS NOT NULL
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+                """,
+                (batch, ))
+    rows = cur.fetchall()
+    if len(rows) > 0:
+        values = [(row[0], to_bytes(np.array(row[1], dtype=ENCODING_DTYPE))) for row in rows]
+        execute_values(cur, f"""
+                       UPDATE face_encodings f
+                       SET embedding = v.embedding
+                       {", face_encoding = NULL" if clear_legacy else ""}
+                       FROM (VALUES %s) AS v (encoding_id, embedding)
+                       WHERE f.encoding_id = v.encoding_id::uuid
+                       """,
+                       values)
+    conn.commit()
+    cur.close()
+    return len(rows)
+
+# drop the numeric[] copy of rows that were converted earlier without --clear-legacy
+def clear_legacy_batch(conn, batch):
+    cur = conn.cursor()
+    cur.execute("""
+                UPDATE face_encodings SET face_encoding = NULL
+                WHERE encoding_id IN (
+                    SELECT encoding_id FROM face_encodings
+                    WHERE embedding IS NOT NULL AND face_encoding IS NOT NULL
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                """,
+                (batch, ))
+    count = cur.rowcount
+    conn.commit()
+    cur.close()
+    return count
+
+def remaining(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM face_encodings WHERE embedding IS NULL")
+    count = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    return count
+
+def migrate(batch = 500, pause = 0.1, clear_legacy = False):
+    started = monotonic()
+    total = 0
+    with borrow() as conn:
+        print('encodings left to convert: ', remaining(conn))
+        while True:
+            count = migrate_batch(conn, batch, clear_legacy)
+            if count == 0:
+                break
+            total += count
+            print(f'converted {total} encodings')
+            sleep(pause)
+        if clear_legacy:
+            while clear_legacy_batch(conn, batch) > 0:
+                sleep(pause)
+        left = remaining(conn)
+    print(f'done, converted {total} encodings in {monotonic() - started:.1f}s, {left} left')
+    return total
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert numeric[] face encodings to bytea")
+    parser.add_argument("--batch", type=int, default=500, help="rows per transaction")
+    parser.add_argument("--pause", type=float, default=0.1, help="seconds to sleep between batches")
+    parser.add_argument("--clear-legacy", action="store_true",
+                        help="null the numeric[] column once converted")
+    args = parser.parse_args()
+    migrate(args.batch, args.pause, args.clear_legacy)
@@ -0,0 +1,91 @@
+import threading
+from app.config import OUTBOX_POLL, OUTBOX_BATCH, OUTBOX_MAX_ATTEMPTS, OUTBOX_BACKOFF, OUTBOX_BACKOFF_MAX
+from app.database import borrow
+from app.send_email import send_messages
+from email import message_from_string
+
+_wakeup = threading.Event()
+
+# queue a built message, it is sent once the caller commits
+def enqueue(conn, message):
+    cur = conn.cursor()
+    cur.execute("INSERT INTO email_outbox (send_to, message) VALUES (%s, %s)",
+                (message["To"], message.as_string()))
+    cur.close()
+
+# nudge the worker after committing so queued mail goes out without waiting for the next poll
+def wake():
+    _wakeup.set()
+
+def _backoff(attempts):
+    return min(OUTBOX_BACKOFF * (2 ** (attempts - 1)), OUTBOX_BACKOFF_MAX)
+
+# sends one batch of due messages, returns how many were picked up
+def drain(batch = OUTBOX_BATCH):
+    with borrow() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+                    SELECT email_id, message, attempts FROM email_outbox
+                    WHERE sent_at IS NULL AND attempts < %s AND next_attempt <= now()
+                    ORDER BY next_attempt
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                    """,
+                    (OUTBOX_MAX_ATTEMPTS, batch))
+        rows = cur.fetchall()
+        try:
+            errors = send_messages([message_from_string(row[1]) for row in rows])
+        except Exception as error:
+            # recorded on every row, so they back off instead of being picked up again right away
+            errors = [error] * len(rows)
+        for (email_id, message, attempts), error in zip(rows, errors):
+            if error is None:
+                cur.execute("UPDATE email_outbox SET sent_at = now(), attempts = %s WHERE email_id = %s",
+                            (attempts + 1, email_id))
+            else:
+                print('outbox send failed: ', email_id, ' ', error)
+                cur.execute("""
+                            UPDATE email_outbox
+                            SET attempts = %s, last_error = %s,
+                            next_attempt = now() + %s * interval '1 second'
+                            WHERE email_id = %s
+                            """,
+                            (attempts + 1, str(error)[:512], _backoff(attempts + 1), email_id))
+        cur.execute("DELETE FROM email_outbox WHERE sent_at < now() - interval '1 day'")
+        conn.commit()
+        cur.close()
+    return len(rows)
+
+class outbox_worker(threading.Thread):
+    def __init__(self, poll = OUTBOX_POLL):
+        super().__init__(name="email-outbox", daemon=True)
+        self.poll = poll
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.is_set():
+            try:
+                while drain() > 0 and not self._halt.is_set():
+                    pass
+            except Exception as error:
+                print('outbox worker error: ', error)
+            _wakeup.wait(self.poll)
+            _wakeup.clear()
+
+    def stop(self):
+        self._halt.set()
+        _wakeup.set()
+
+_worker = None
+
+def start():
+    global _worker
+    if _worker is None:
+        _worker = outbox_worker()
+        _worker.start()
+
+def stop():
+    global _worker
+    if _worker is not None:
+        _worker.stop()
+        _worker = None
\ No newline at end of file
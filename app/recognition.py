@@ -0,0 +1,686 @@
+import asyncio
+import multiprocessing
+import threading
+import cv2
+import dlib
+import face_recognition
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from time import perf_counter
+from face_recognition.api import _raw_face_landmarks, face_encoder, face_detector, cnn_face_detector
+from face_recognition.api import _rect_to_css, _trim_css_to_bounds
+from app.config import MATCH_TOLERANCE, MATCH_REDUCE, MATCH_COARSE_MIN
+from app.config import RECOGNITION_WORKERS, RECOGNITION_QUEUE, RECOGNITION_TIMEOUT
+from app.config import DETECT_MAX_SIDE_ENROLL, DETECT_MAX_SIDE_LECTURE
+from app.config import DETECT_TILED, DETECT_TILE_SIZE, DETECT_TILE_OVERLAP, DETECT_TILE_UPSAMPLE, DETECT_NMS_IOU
+from app.config import RECOGNITION_PROFILE, RESULT_CACHE_SIZE, RESULT_CACHE_TTL
+from app.cache import ttl_cache
+
+# this module is imported by the pool workers, keep it free of app.database imports
+
+# running totals per pipeline stage, shown at /stats/recognition
+class stage_stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def add(self, name, seconds):
+        with self._lock:
+            stage = self._stages.setdefault(name, {"count" : 0, "total_ms" : 0.0, "max_ms" : 0.0})
+            stage["count"] += 1
+            stage["total_ms"] += seconds * 1000
+            stage["max_ms"] = max(stage["max_ms"], seconds * 1000)
+
+    def stats(self):
+        with self._lock:
+            stats = {name : dict(stage) for name, stage in self._stages.items()}
+        for stage in stats.values():
+            stage["avg_ms"] = round(stage["total_ms"] / stage["count"], 2)
+            stage["total_ms"] = round(stage["total_ms"], 2)
+            stage["max_ms"] = round(stage["max_ms"], 2)
+        return stats
+
+recognition_stats = stage_stats()
+
+# lecture photos seen recently, for re-uploads of the same photo
+# detections: (sha256, profile, tiled) -> pool job result, independent of any course
+# lecture_results: (sha256, course encoding serial, profile, tiled) -> (status code, response),
+# a change to the course's encodings or registrations gives it a new serial, old keys are never hit again
+detections = ttl_cache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+lecture_results = ttl_cache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+# times the stages of one request, with timer.stage("detect"): ...
+# pool workers use a timer without stats and hand their stages back to merge()
+class stage_timer:
+    def __init__(self, stats = recognition_stats):
+        self.stages = {}
+        self.stats = stats
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        if self.stats is not None:
+            self.stats.add(name, seconds)
+
+    def merge(self, stages):
+        for name, seconds in stages.items():
+            self.add(name, seconds)
+
+    @contextmanager
+    def stage(self, name):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - started)
+
+    def as_dict(self):
+        return {f"{name}_ms" : round(seconds * 1000, 2) for name, seconds in self.stages.items()}
+
+def detect_faces(img, upsample = 1, model = "hog"):
+    return face_recognition.face_locations(img, upsample, model)
+
+# map a (top, right, bottom, left) box found on a copy scaled by scale back onto the original
+def _remap(box, scale, height, width):
+    top, right, bottom, left = box
+    return (
+        max(int(round(top / scale)), 0),
+        min(int(round(right / scale)), width),
+        min(int(round(bottom / scale)), height),
+        max(int(round(left / scale)), 0),
+    )
+
+# detect on a copy whose longest side is at most max_side, boxes come back in img coordinates
+# HOG cost grows with pixel count, phone photos are far larger than needed to find faces
+def detect_scaled(img, max_side, upsample = 1, model = "hog"):
+    height, width = img.shape[:2]
+    if max_side <= 0 or max(height, width) <= max_side:
+        return detect_faces(img, upsample, model)
+    scale = max_side / max(height, width)
+    small = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return [_remap(box, scale, height, width) for box in detect_faces(small, upsample, model)]
+
+# like detect_faces but keeps the detector score of every box, [(box, score)]
+def detect_scored(img, upsample = 1, model = "hog"):
+    if model == "cnn":
+        return [(_trim_css_to_bounds(_rect_to_css(face.rect), img.shape), face.confidence)
+                for face in cnn_face_detector(img, upsample)]
+    rects, scores, _ = face_detector.run(img, upsample, 0.0)
+    return [(_trim_css_to_bounds(_rect_to_css(rect), img.shape), score)
+            for rect, score in zip(rects, scores)]
+
+# overlapping (top, left, bottom, right) windows covering a height x width image
+def tile_windows(height, width, size = DETECT_TILE_SIZE, overlap = DETECT_TILE_OVERLAP):
+    step = max(size - overlap, 1)
+    def starts(length):
+        if length <= size:
+            return [0]
+        points = list(range(0, length - size, step))
+        return points + [length - size]
+    return [(top, left, min(top + size, height), min(left + size, width))
+            for top in starts(height) for left in starts(width)]
+
+# non-maximum suppression over [(box, score)], best scores first
+# a box is dropped if it overlaps a kept box by more than iou, or lies mostly inside it,
+# which is what a face cut by a tile edge looks like next to the whole face
+def suppress(scored, iou = DETECT_NMS_IOU):
+    if len(scored) == 0:
+        return []
+    boxes = np.array([box for box, _ in scored], dtype=np.float64)
+    top, right, bottom, left = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (bottom - top) * (right - left)
+    order = np.argsort([-score for _, score in scored], kind='stable')
+    keep = []
+    while len(order) > 0:
+        best = order[0]
+        keep.append(best)
+        rest = order[1:]
+        h = np.clip(np.minimum(bottom[best], bottom[rest]) - np.maximum(top[best], top[rest]), 0, None)
+        w = np.clip(np.minimum(right[best], right[rest]) - np.maximum(left[best], left[rest]), 0, None)
+        inter = h * w
+        overlap = inter / (areas[best] + areas[rest] - inter)
+        inside = inter / np.minimum(areas[best], areas[rest])
+        order = rest[(overlap <= iou) & (inside <= 0.7)]
+    return [tuple(int(v) for v in scored[k][0]) for k in keep]
+
+# landmarks for every location, then all faces through the dlib encoder in one batched call
+# returns a faces x 128 array
+def encode_faces(img, locations, num_jitters = 1, model = "small"):
+    if len(locations) == 0:
+        return np.empty((0, 128))
+    detections = dlib.full_object_detections()
+    for landmarks in _raw_face_landmarks(img, locations, model):
+        detections.append(landmarks)
+    return np.array(face_encoder.compute_face_descriptor(img, detections, num_jitters))
+
+# euclidean distance of every face to every encoding, faces x encodings
+# |a - b|^2 = |a|^2 + |b|^2 - 2 a.b, so the whole matrix is one matrix product
+def distance_matrix(face_encs, candidates):
+    faces = np.asarray(face_encs, dtype=np.float32).reshape(-1, candidates.matrix.shape[1])
+    sq = np.einsum('ij,ij->i', faces, faces)[:, None] + candidates.sq_norms[None, :]
+    sq -= 2 * candidates.dot(faces)
+    np.maximum(sq, 0, out=sq)
+    return np.sqrt(sq, out=sq)
+
+# collapse encoding columns into one column per student, faces x students
+def reduce_per_student(dist, candidates, reduce = MATCH_REDUCE):
+    if reduce == "mean":
+        sums = np.add.reduceat(dist, candidates.offsets, axis=1)
+        counts = np.diff(np.append(candidates.offsets, dist.shape[1]))
+        return sums / counts
+    return np.minimum.reduceat(dist, candidates.offsets, axis=1)
+
+# lower bound of the distance from every face to every student, faces x students, from the prototypes
+# no encoding is closer than the centroid distance minus the student's radius,
+# and the mean distance is never below the centroid distance
+def prototype_bounds(face_encs, candidates, reduce = MATCH_REDUCE):
+    faces = np.asarray(face_encs, dtype=np.float32).reshape(-1, candidates.centroids.shape[1])
+    sq = np.einsum('ij,ij->i', faces, faces)[:, None] + candidates.centroid_sq[None, :]
+    sq -= 2 * (faces @ candidates.centroids.T)
+    dist = np.sqrt(np.maximum(sq, 0))
+    if reduce == "mean":
+        return dist - candidates.slack[None, :]
+    return dist - candidates.radii[None, :]
+
+# maps a distance to 0..1, 0.5 at the tolerance and rising steeply below it
+def confidence(dist, tolerance = MATCH_TOLERANCE):
+    dist = np.asarray(dist, dtype=np.float64)
+    near = 1.0 - dist / (tolerance * 2.0)
+    near = near + (1.0 - near) * np.power(np.clip((near - 0.5) * 2.0, 0, 1), 0.2)
+    far = (1.0 - dist) / ((1.0 - tolerance) * 2.0)
+    return np.clip(np.where(dist <= tolerance, near, far), 0, 1)
+
+# one-to-one assignment of faces to students
+# pairs within tolerance are taken closest first, skipping faces or students already used,
+# so no student is given to two faces and each face gets at most one student
+# returns, per face, the assigned student column or -1
+def assign(student_dist, tolerance = MATCH_TOLERANCE):
+    faces, students = np.nonzero(student_dist <= tolerance)
+    order = np.argsort(student_dist[faces, students], kind='stable')
+    assigned = np.full(student_dist.shape[0], -1)
+    taken = np.zeros(student_dist.shape[1], dtype=bool)
+    for face, student in zip(faces[order], students[order]):
+        if assigned[face] == -1 and not taken[student]:
+            assigned[face] = student
+            taken[student] = True
+    return assigned
+
+# match detected face encodings against a course's course_encodings
+# returns one dict per face: assigned student (or None), its distance and confidence,
+# and every student within tolerance with the number of their encodings that matched
+# a coarse pass on the student prototypes leaves out students no face can be within tolerance of,
+# only the rest are compared against every raw encoding, so the result is the same as comparing all,
+# courses with fewer than MATCH_COARSE_MIN encodings are compared in full straight away
+# quantized candidates are narrowed down on the quantized form, the rest is re-scored on exact
+# encodings from load_exact(ids) -> {encoding_id : encoding}
+def match_faces(face_encs, candidates, tolerance = MATCH_TOLERANCE, reduce = MATCH_REDUCE, load_exact = None):
+    if len(face_encs) == 0:
+        return []
+    if len(candidates) >= max(MATCH_COARSE_MIN, 1):
+        # small slack for float32 rounding of the bound
+        near = (prototype_bounds(face_encs, candidates, reduce) <= tolerance + 1e-4).any(axis=0)
+        if not near.all():
+            candidates = candidates.subset(near)
+    if len(candidates) > 0 and candidates.quantized:
+        # a quantized encoding is at most errors[i] away from the exact one
+        approx = reduce_per_student(distance_matrix(face_encs, candidates), candidates, reduce)
+        near = (approx - candidates.slack[None, :] <= tolerance + 1e-4).any(axis=0)
+        candidates = candidates.subset(near).exact(load_exact)
+    if len(candidates) == 0:
+        return [{"student" : None, "distance" : None, "confidence" : 0.0, "matches" : {}}
+                for _ in range(len(face_encs))]
+    dist = distance_matrix(face_encs, candidates)
+    student_dist = reduce_per_student(dist, candidates, reduce)
+    hits = np.add.reduceat((dist <= tolerance).astype(np.int32), candidates.offsets, axis=1)
+    assigned = assign(student_dist, tolerance)
+    results = []
+    for face in range(len(face_encs)):
+        matched = np.nonzero(hits[face])[0]
+        result = {
+            "student" : None,
+            "distance" : None,
+            "confidence" : 0.0,
+            "matches" : {str(candidates.students[k]) : int(hits[face, k]) for k in matched},
+        }
+        if assigned[face] != -1:
+            d = float(student_dist[face, assigned[face]])
+            result["student"] = str(candidates.students[assigned[face]])
+            result["distance"] = round(d, 4)
+            result["confidence"] = round(float(confidence(d, tolerance)), 4)
+        results.append(result)
+    return results
+
+# euclidean distances between the rows of a and b, in float64
+def pairwise_distances(a, b):
+    sq = np.einsum('ij,ij->i', a, a)[:, None] + np.einsum('ij,ij->i', b, b)[None, :]
+    sq -= 2 * (a @ b.T)
+    return np.sqrt(np.maximum(sq, 0))
+
+# merge match_faces results of several photos of the same room
+# photo_results[p] and photo_encodings[p] are the results and face encodings of photo p
+# returns
+#   best:    student -> (photo, face) of their closest match
+#   seen:    student -> every photo they were matched in
+#   unknown: groups of (photo, face) of unmatched faces, one group per person; an unmatched face
+#            within tolerance of a matched face in another photo is that student, seen there, and left out,
+#            unmatched faces of different photos within tolerance of each other are grouped
+def fuse_matches(photo_results, photo_encodings, tolerance = MATCH_TOLERANCE):
+    best = {}
+    seen = {}
+    matched = []
+    unmatched = []
+    for photo, results in enumerate(photo_results):
+        for face, result in enumerate(results):
+            student = result["student"]
+            if student == None:
+                unmatched.append((photo, face))
+                continue
+            matched.append((photo, face))
+            seen.setdefault(student, []).append(photo)
+            if student not in best or result["distance"] < photo_results[best[student][0]][best[student][1]]["distance"]:
+                best[student] = (photo, face)
+    if len(unmatched) == 0:
+        return best, seen, []
+    encs = np.array([photo_encodings[p][f] for p, f in unmatched], dtype=np.float64).reshape(-1, 128)
+    photos = np.array([p for p, _ in unmatched])
+    keep = np.ones(len(unmatched), dtype=bool)
+    if len(matched) > 0:
+        close = pairwise_distances(encs, np.array([photo_encodings[p][f] for p, f in matched], dtype=np.float64))
+        close[photos[:, None] == np.array([p for p, _ in matched])[None, :]] = np.inf
+        nearest = np.argmin(close, axis=1)
+        keep = close[np.arange(len(unmatched)), nearest] > tolerance
+        # the student is seen in that photo too
+        for i in np.nonzero(~keep)[0]:
+            p, f = matched[nearest[i]]
+            student = photo_results[p][f]["student"]
+            if photos[i] not in seen[student]:
+                seen[student].append(int(photos[i]))
+        for student in seen:
+            seen[student].sort()
+    close = (pairwise_distances(encs, encs) <= tolerance) & (photos[:, None] != photos[None, :])
+    grouped = ~keep
+    unknown = []
+    for i in range(len(unmatched)):
+        if grouped[i]:
+            continue
+        members = [i] + [j for j in np.nonzero(close[i] & ~grouped)[0] if j > i]
+        # at most one face per photo in a group
+        group = {}
+        for j in members:
+            group.setdefault(photos[j], j)
+        grouped[list(group.values())] = True
+        unknown.append([unmatched[j] for j in sorted(group.values())])
+    return best, seen, unknown
+
+# enrollment consistency check of new encodings against a student's stored ones, in one step
+# a new encoding is accepted when it is within tolerance of more than half of the stored encodings,
+# or of the new ones when nothing is stored yet
+# returns (accepted mask over new, conflicting mask over stored), a stored encoding conflicts
+# when it matches none of the accepted new encodings
+def verify_enrollment(new_encs, stored_encs, tolerance):
+    new = np.asarray(new_encs, dtype=np.float64).reshape(-1, 128)
+    stored = np.asarray(stored_encs, dtype=np.float64).reshape(-1, 128)
+    if len(stored) > 0:
+        close = pairwise_distances(new, stored) <= tolerance
+        accepted = close.sum(axis=1) * 2 > len(stored)
+        conflicting = ~close[accepted].any(axis=0)
+    else:
+        # each new encoding counts itself, so a single photo is always accepted
+        close = pairwise_distances(new, new) <= tolerance
+        accepted = close.sum(axis=1) * 2 > len(new)
+        conflicting = np.zeros(0, dtype=bool)
+    return accepted, conflicting
+
+# detector, encoder and tolerance settings of one recognition request
+# balanced matches the defaults the endpoints always used
+class recognition_profile:
+    def __init__(self, name, model = "hog", upsample = 1, jitters = 1, landmarks = "small",
+                 enroll_tolerance = 0.6, match_tolerance = MATCH_TOLERANCE,
+                 max_side_enroll = DETECT_MAX_SIDE_ENROLL, max_side_lecture = DETECT_MAX_SIDE_LECTURE,
+                 tiled = DETECT_TILED, tile_upsample = DETECT_TILE_UPSAMPLE):
+        self.name = name
+        self.model = model # "hog" or "cnn" face detector
+        self.upsample = upsample
+        self.jitters = jitters # re-samples averaged per encoding
+        self.landmarks = landmarks # "small" 5 point or "large" 68 point landmark model
+        self.enroll_tolerance = enroll_tolerance # new photo vs a student's own encodings
+        self.match_tolerance = match_tolerance # lecture faces vs course encodings
+        self.max_side_enroll = max_side_enroll
+        self.max_side_lecture = max_side_lecture
+        self.tiled = tiled
+        self.tile_upsample = tile_upsample
+
+    def as_dict(self):
+        return dict(vars(self))
+
+profiles = {
+    "fast" : recognition_profile("fast", max_side_enroll = 480, max_side_lecture = 1600),
+    "balanced" : recognition_profile("balanced"),
+    "accurate" : recognition_profile("accurate", model = "cnn", jitters = 5, landmarks = "large",
+                                     max_side_enroll = 1024, tiled = True),
+}
+
+# request profile, else the course profile, else RECOGNITION_PROFILE
+def get_profile(*names):
+    for name in names:
+        if name:
+            if name not in profiles:
+                raise recognition_error(f"Unknown recognition profile {name}, use one of {', '.join(profiles)}", 400)
+            return profiles[name]
+    return profiles[RECOGNITION_PROFILE]
+
+# uploads only had their first bytes checked, a truncated or corrupt image is refused here
+def _decode(data):
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise recognition_error("Image could not be decoded", 400)
+    return img
+
+# detect on one full resolution window of img
+def detect_window(img, window, profile):
+    top, left, bottom, right = window
+    tile = np.ascontiguousarray(img[top:bottom, left:right])
+    return [((t + top, r + left, b + top, l + left), score)
+            for (t, r, b, l), score in detect_scored(tile, profile.tile_upsample, profile.model)]
+
+# detect on a downscaled copy of the whole img, catches faces too large to fit inside a single tile
+def detect_overview(img, profile):
+    height, width = img.shape[:2]
+    scale = 1.0
+    if profile.max_side_lecture > 0:
+        scale = min(profile.max_side_lecture / max(height, width), 1.0)
+    small = img
+    if scale < 1.0:
+        small = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return [(_remap(box, scale, height, width), score)
+            for box, score in detect_scored(small, profile.upsample, profile.model)]
+
+# every lecture detection pass on the calling process, the pool spreads the same passes over workers
+def detect_lecture(img, profile):
+    if not profile.tiled:
+        return detect_scaled(img, profile.max_side_lecture, profile.upsample, profile.model)
+    height, width = img.shape[:2]
+    found = [detect_window(img, window, profile) for window in tile_windows(height, width)]
+    found.append(detect_overview(img, profile))
+    return suppress([box for boxes in found for box in boxes])
+
+# pool job for an enrollment photo, the face is only encoded if exactly one was found
+# detection runs on a downscaled copy, encoding on the full resolution image
+def enrollment_job(data, profile):
+    timer = stage_timer(None)
+    with timer.stage("decode"):
+        img = _decode(data)
+    with timer.stage("detect"):
+        locations = detect_scaled(img, profile.max_side_enroll, profile.upsample, profile.model)
+    encodings = np.empty((0, 128))
+    if len(locations) == 1:
+        with timer.stage("encode"):
+            encodings = encode_faces(img, locations, profile.jitters, profile.landmarks)
+    return {
+        "locations" : locations,
+        "encodings" : encodings,
+        "dimensions" : img.shape[:2],
+        "stages" : timer.stages,
+    }
+
+# pool job for a lecture photo, every detected face is encoded
+def lecture_job(data, profile):
+    timer = stage_timer(None)
+    with timer.stage("decode"):
+        img = _decode(data)
+    with timer.stage("detect"):
+        locations = detect_scaled(img, profile.max_side_lecture, profile.upsample, profile.model)
+    with timer.stage("encode"):
+        encodings = encode_faces(img, locations, profile.jitters, profile.landmarks)
+    return {
+        "locations" : locations,
+        "encodings" : encodings,
+        "dimensions" : img.shape[:2],
+        "stages" : timer.stages,
+    }
+
+# decoded images are handed between pool workers through shared memory
+# a reference is (name, shape, dtype), whoever asked for the image unlinks it with release()
+def _share(img):
+    block = shared_memory.SharedMemory(create=True, size=max(img.nbytes, 1))
+    np.ndarray(img.shape, dtype=img.dtype, buffer=block.buf)[...] = img
+    block.close()
+    return (block.name, img.shape, img.dtype.str)
+
+@contextmanager
+def _attach(ref):
+    name, shape, dtype = ref
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        yield np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    finally:
+        block.close()
+
+def release(ref):
+    try:
+        block = shared_memory.SharedMemory(name=ref[0])
+        block.close()
+        block.unlink()
+    except FileNotFoundError:
+        pass
+
+# pool job, decodes the upload into shared memory for the tile jobs
+def prepare_job(data):
+    timer = stage_timer(None)
+    with timer.stage("decode"):
+        img = _decode(data)
+    return {
+        "image" : _share(img),
+        "dimensions" : img.shape[:2],
+        "stages" : timer.stages,
+    }
+
+# pool job, detect_window on a shared image
+def tile_job(ref, window, profile):
+    with _attach(ref) as img:
+        return detect_window(img, window, profile)
+
+# pool job, detect_overview on a shared image
+def overview_job(ref, profile):
+    with _attach(ref) as img:
+        return detect_overview(img, profile)
+
+# pool job, encodes the given locations of a shared image
+def encode_job(ref, locations, profile):
+    timer = stage_timer(None)
+    with _attach(ref) as img:
+        with timer.stage("encode"):
+            encodings = encode_faces(img, locations, profile.jitters, profile.landmarks)
+    return {
+        "encodings" : encodings,
+        "stages" : timer.stages,
+    }
+
+# raised in pool workers too, the arguments go to Exception so it pickles back to the request
+class recognition_error(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message, status_code)
+        self.message = message
+        self.status_code = status_code
+
+def _init_worker():
+    # the dlib models load when face_recognition is imported, one tiny detection warms them up
+    detect_faces(np.zeros((32, 32, 3), dtype=np.uint8))
+
+def _ready():
+    return True
+
+# process pool running the recognition jobs so they never block the event loop
+# jobs wait for one of size workers on a semaphore, so the executor never queues work of its own
+# new callers are turned away with a 503 while size + max_queue jobs are already pending,
+# a caller that is let in queues all of its jobs, however many it fans out to
+# a job that times out is abandoned, its worker stays busy until the job finishes
+class recognition_pool:
+    def __init__(self, size, max_queue, timeout):
+        self.size = size # 0 runs jobs on a thread instead, one at a time, for development
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._workers = None
+        self._workers_loop = None
+        self._counters = {
+            "jobs" : 0,
+            "rejected" : 0,
+            "timeouts" : 0,
+            "failures" : 0,
+            "restarts" : 0,
+        }
+
+    def start(self):
+        with self._lock:
+            if self._executor is None and self.size > 0:
+                self._executor = ProcessPoolExecutor(
+                    max_workers = self.size,
+                    mp_context = multiprocessing.get_context("spawn"),
+                    initializer = _init_worker
+                )
+                # spawn every worker now instead of on the first upload
+                for _ in range(self.size):
+                    self._executor.submit(_ready)
+            return self._executor
+
+    def stop(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait = False, cancel_futures = True)
+
+    def _restart(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+                self._counters["restarts"] += 1
+        executor.shutdown(wait = False, cancel_futures = True)
+
+    # raises 503 when the pending jobs already fill size + max_queue, else counts jobs as pending
+    def _admit(self, jobs):
+        with self._lock:
+            if self._pending >= self.size + self.max_queue:
+                self._counters["rejected"] += 1
+                raise recognition_error("Server busy, please try again", 503)
+            self._pending += jobs
+            self._counters["jobs"] += jobs
+
+    def _release(self, jobs):
+        with self._lock:
+            self._pending -= jobs
+
+    # semaphore of the running event loop, one permit per worker
+    def _slots(self):
+        loop = asyncio.get_running_loop()
+        if self._workers_loop is not loop:
+            self._workers = asyncio.Semaphore(max(self.size, 1))
+            self._workers_loop = loop
+        return self._workers
+
+    # runs fn(*args) once a worker is free, on executor or on a thread when there is none
+    async def _submit(self, executor, fn, args):
+        async with self._slots():
+            if executor is None:
+                return await asyncio.to_thread(fn, *args)
+            return await asyncio.wrap_future(executor.submit(fn, *args))
+
+    # run fn(*args) on the pool, jobs return a dict whose "stages" are merged into timer
+    async def run(self, fn, *args, timer = None):
+        self._admit(1)
+        started = perf_counter()
+        executor = None
+        try:
+            if self.size > 0:
+                executor = self.start()
+            result = await asyncio.wait_for(self._submit(executor, fn, args), self.timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._counters["timeouts"] += 1
+            raise recognition_error("Face recognition timed out, please try again", 504)
+        except BrokenProcessPool:
+            with self._lock:
+                self._counters["failures"] += 1
+            self._restart(executor)
+            raise recognition_error("Face recognition failed, please try again", 503)
+        finally:
+            self._release(1)
+        if timer is not None:
+            timer.merge(result["stages"])
+            timer.add("queue", max(perf_counter() - started - sum(result["stages"].values()), 0))
+        return result
+
+    # run fn over every argument tuple in parallel as far as there are free workers, timed out together
+    # the wall time is recorded in timer under stage, results come back in order
+    async def run_many(self, fn, arg_lists, timer = None, stage = None):
+        if len(arg_lists) == 0:
+            return []
+        self._admit(len(arg_lists))
+        started = perf_counter()
+        executor = None
+        try:
+            if self.size > 0:
+                executor = self.start()
+            jobs = [self._submit(executor, fn, args) for args in arg_lists]
+            results = await asyncio.wait_for(asyncio.gather(*jobs), self.timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._counters["timeouts"] += 1
+            raise recognition_error("Face recognition timed out, please try again", 504)
+        except BrokenProcessPool:
+            with self._lock:
+                self._counters["failures"] += 1
+            self._restart(executor)
+            raise recognition_error("Face recognition failed, please try again", 503)
+        finally:
+            self._release(len(arg_lists))
+        if timer is not None and stage is not None:
+            timer.add(stage, perf_counter() - started)
+        return results
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["pending"] = self._pending
+            stats["running"] = self._executor is not None
+        stats["size"] = self.size
+        stats["max_queue"] = self.max_queue
+        stats["timeout"] = self.timeout
+        return stats
+
+recognition_workers = recognition_pool(RECOGNITION_WORKERS, RECOGNITION_QUEUE, RECOGNITION_TIMEOUT)
+
+def _call(fn, args):
+    return fn(*args)
+
+# lecture photo pipeline with tiled detection
+# the image is split into overlapping full resolution tiles detected in parallel on the pool,
+# plus one downscaled pass for large faces, the boxes are merged with non-maximum suppression
+async def tiled_lecture(data, profile, timer = None):
+    pool = recognition_workers
+    prepared = await pool.run(prepare_job, data, timer=timer)
+    ref = prepared["image"]
+    try:
+        height, width = prepared["dimensions"]
+        passes = [(tile_job, (ref, window, profile)) for window in tile_windows(height, width)]
+        passes.append((overview_job, (ref, profile)))
+        found = await pool.run_many(_call, passes, timer=timer, stage="detect")
+        locations = suppress([box for boxes in found for box in boxes])
+        encoded = await pool.run(encode_job, ref, locations, profile, timer=timer)
+    finally:
+        release(ref)
+    return {
+        "locations" : locations,
+        "encodings" : encoded["encodings"],
+        "dimensions" : prepared["dimensions"],
+        "tiles" : len(passes) - 1,
+    }
+
+# tiled_lecture of several photos, one photo at a time,
+# each photo already fans out over every worker and photos in parallel would overflow the queue
+async def tiled_lectures(datas, profile, timer = None):
+    return [await tiled_lecture(data, profile, timer=timer) for data in datas]
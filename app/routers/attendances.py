@@ -1,21 +1,20 @@
 from datetime import datetime
-from typing import Annotated, List, Union
-from fastapi import APIRouter, Header, Response, status
+from typing import List
+from fastapi import APIRouter, Depends, Response, status
 from pydantic import BaseModel
-from app.common import USER_TYPE
 from app.config import SHEET_CACHE_LOCATION
-from app.database import connect
+from app.database import db_conn
 from app.routers.lectures import _lecture_id_exists
 from app.routers.registrations import _get_reg_students_from_course_id
 from app.routers.students import _get_student_from_roll_num
-from app.routers.users import _verify_token
+from app.auth import require_user, require_staff, staff_user
 from openpyxl import Workbook
 from openpyxl.formatting.rule import ColorScaleRule
 from openpyxl.comments import Comment
 
-from app.send_email import send_attendance_sheet_email
+from app.send_email import attendance_sheet_message
+from app import outbox
 
-conn = connect()
 router = APIRouter(
     prefix="/attendances",
     tags=['attendances']
@@ -27,19 +26,14 @@ class attendanceObj(BaseModel):
     registration_ids : List[str]
 
 # mark attendance for lecture
-@router.post("/")
+@router.post("/", dependencies=[Depends(require_staff)])
 def mark_attendance(
     data: attendanceObj,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token).value < USER_TYPE.SEPARATOR.value):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
-    if (_lecture_id_exists(data.lecture_id)):
+    if (_lecture_id_exists(data.lecture_id, conn)):
         cur.execute("DELETE FROM attendances WHERE lecture_id = %s",
                     (data.lecture_id, ))
         for registration_id in data.registration_ids:
@@ -62,21 +56,15 @@ def mark_attendance(
         response.status_code = status.HTTP_404_NOT_FOUND
         resp_dict = {"message" : "Lecture not found"}
     cur.close()
-    conn.close()
     return resp_dict
 
 # get students present on a particular lecture
-@router.get("/students/{lecture_id}")
+@router.get("/students/{lecture_id}", dependencies=[Depends(require_user)])
 def get_attendance(
     lecture_id: str,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token) == USER_TYPE.INVALID):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
     cur.execute("SELECT atten_marked FROM lectures WHERE lecture_id = %s",
@@ -92,29 +80,23 @@ def get_attendance(
                         WHERE registration_id = %s
                         """,
                         (reg_id, ))
-            students.append(_get_student_from_roll_num(cur.fetchone()[0]))
+            students.append(_get_student_from_roll_num(cur.fetchone()[0], conn))
         resp_dict = {"students" : students}
         response.status_code = status.HTTP_200_OK
     else:
         resp_dict = {'message' : 'Attendance not marked yet'}
         response.status_code = status.HTTP_404_NOT_FOUND
     cur.close()
-    conn.close()
     return resp_dict
 
 # check if student was present on a certain lecture
-@router.get("/students/{lecture_id}/{student_roll}")
+@router.get("/students/{lecture_id}/{student_roll}", dependencies=[Depends(require_user)])
 def get_stud_present(
     lecture_id: str,
     student_roll: str,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token) == USER_TYPE.INVALID):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
     cur.execute("SELECT atten_marked, course_id FROM lectures WHERE lecture_id = %s",
@@ -144,21 +126,15 @@ def get_stud_present(
         resp_dict = {'present' : None, 'message' : 'Record not found'}
         response.status_code = status.HTTP_404_NOT_FOUND
     cur.close()
-    conn.close()
     return resp_dict
 
 # get attendance stats for course
-@router.get("/course/{course_id}")
+@router.get("/course/{course_id}", dependencies=[Depends(require_staff)])
 def get_course_attendance(
     course_id: str,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token).value < USER_TYPE.SEPARATOR.value):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     cur.execute("""
                 SELECT lecture_id, lecture_date, atten_marked FROM lectures WHERE course_id = %s
@@ -205,22 +181,16 @@ def get_course_attendance(
             })
         response.status_code = status.HTTP_200_OK
     cur.close()
-    conn.close()
     return resp_dict
 
 # get student attendance for course
-@router.get("/course/{course_id}/{student_roll}")
+@router.get("/course/{course_id}/{student_roll}", dependencies=[Depends(require_user)])
 def get_stud_attendance(
     course_id: str,
     student_roll: str,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token) == USER_TYPE.INVALID):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     cur.execute("SELECT lecture_id, atten_marked FROM lectures WHERE course_id = %s",
                 (course_id, ))
@@ -268,7 +238,6 @@ def get_stud_attendance(
         }
         response.status_code = status.HTTP_404_NOT_FOUND
     cur.close()
-    conn.close()
     return resp_dict
 
 # send filtered spreadsheet to email address
@@ -276,13 +245,9 @@ def get_stud_attendance(
 def send_attendance_to_email(
     course_id: str,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn,
+    user: staff_user
 ):
-    if (token is None or _verify_token(token).value < USER_TYPE.SEPARATOR.value):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     cur.execute('SELECT name, course_code FROM courses WHERE course_id = %s',
                 (course_id, ))
@@ -316,7 +281,7 @@ def send_attendance_to_email(
             sheet[f"{letter}1"].comment = Comment(lectures[idx][3], 'Lecture Description')
             sheet.column_dimensions[letter].width = 13
             lecture_col_dict[lectures[idx][0]] = letter
-    students = _get_reg_students_from_course_id(course_id)
+    students = _get_reg_students_from_course_id(course_id, conn)
     for idx in range(0, len(students)):
         row_num = idx + 2
         sheet[f'A{row_num}'] = students[idx][1]
@@ -344,12 +309,11 @@ def send_attendance_to_email(
             else:
                 sheet[f'{lecture_col_dict[lec_id]}{row_num}'] = 0
     workbook.save(filename=save_path)
-    cur.execute('SELECT email FROM user_accounts WHERE token = %s',
-                (token, ))
-    email = cur.fetchone()[0]
+    email = user.email
+    outbox.enqueue(conn, attendance_sheet_message(email, course[0], save_path))
+    conn.commit()
+    outbox.wake()
     cur.close()
-    conn.close()
-    send_attendance_sheet_email(email, course[0], save_path)
     import os
     os.remove(save_path)
     return {'message' : f'Attendance sheet sent to {email}!'}
@@ -1,14 +1,15 @@
-from fastapi import APIRouter, Header, Response, status
+from fastapi import APIRouter, Depends, Response, status
 from pydantic import BaseModel
-from app.database import connect
-from app.common import conv_to_dict, USER_TYPE
-from typing import Annotated, List, Union
+from app.database import db_conn
+from app.common import conv_to_dict
+from typing import List, Optional
 from app.routers.professors import _email_prefix_exists
-from app.routers.users import _verify_token
+from app.auth import require_user, require_staff
+from app.encoding_store import course_cache
+from app.recognition import profiles
 
 from datetime import datetime, date
 
-conn = connect()
 router = APIRouter(
     prefix="/courses",
     tags=["courses"]
@@ -25,18 +26,16 @@ class course(BaseModel):
     description: str
     profs: List[str]
 
+class profileObj(BaseModel):
+    profile: Optional[str] = None
+
 # create one
-@router.post("/create")
+@router.post("/create", dependencies=[Depends(require_staff)])
 def add_course(
     data: course,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token).value < USER_TYPE.SEPARATOR.value):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     try:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -70,11 +69,9 @@ def add_course(
         response.status_code = status.HTTP_400_BAD_REQUEST
     finally:
         cur.close()
-        conn.close()
         return resp_dict
 
-def _course_id_exists(course_id: str):
-    conn = connect()
+def _course_id_exists(course_id: str, conn):
     cur = conn.cursor()
     exists = False
     try:
@@ -86,21 +83,15 @@ def _course_id_exists(course_id: str):
             exists = False
     finally:
         cur.close()
-        conn.close()
         return exists
 
 # retrieve one/all
-@router.get("/get/{course_id}")
+@router.get("/get/{course_id}", dependencies=[Depends(require_user)])
 def get_course(
     course_id: str,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token) == USER_TYPE.INVALID):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     try:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -132,12 +123,10 @@ def get_course(
         response.status_code = status.HTTP_400_BAD_REQUEST
     finally:
         cur.close()
-        conn.close()
         return resp_dict
 
-def _get_course_from_id(course_id: str):
-    if _course_id_exists(course_id):
-        conn = connect()
+def _get_course_from_id(course_id: str, conn):
+    if _course_id_exists(course_id, conn):
         cur = conn.cursor()
         cur.execute("""
                     SELECT course_id, course_code, name, begin_date, end_date, accepting_reg, description
@@ -147,23 +136,17 @@ def _get_course_from_id(course_id: str):
         course_dict = conv_to_dict("course", cur.fetchall(), col_names)
         course = course_dict['course'][0]
         cur.close()
-        conn.close()
         return course
     else:
         return None
 
 # update one
-@router.post("/update/{course_id}")
+@router.post("/update/{course_id}", dependencies=[Depends(require_staff)])
 def update_course(
     data: course,
     course_id: str, response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token).value < USER_TYPE.SEPARATOR.value):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     # try:
     response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -201,21 +184,44 @@ def update_course(
     #     response.status_code = status.HTTP_400_BAD_REQUEST
     # finally:
     cur.close()
-    conn.close()
+    return resp_dict
+
+# set the recognition profile for a course's lecture photos, null goes back to the default
+@router.post("/profile/{course_id}", dependencies=[Depends(require_staff)])
+def set_course_profile(
+    data: profileObj,
+    course_id: str,
+    response: Response,
+    conn: db_conn
+):
+    if data.profile != None and data.profile not in profiles:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"message" : f"Unknown recognition profile {data.profile}, use one of {', '.join(profiles)}"}
+    cur = conn.cursor()
+    cur.execute("""
+                UPDATE courses SET recognition_profile = %s
+                WHERE course_id = %s
+                RETURNING course_id
+                """,
+                (data.profile, course_id))
+    row = cur.fetchone()
+    conn.commit()
+    cur.close()
+    if row != None:
+        response.status_code = status.HTTP_200_OK
+        resp_dict = {"profile" : data.profile, "message" : "Recognition profile updated!"}
+    else:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        resp_dict = {"message" : "Given course was not found!"}
     return resp_dict
 
 # delete one/all
-@router.delete("/delete/{course_id}")
+@router.delete("/delete/{course_id}", dependencies=[Depends(require_staff)])
 def delete_course(
     course_id: str,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token).value < USER_TYPE.SEPARATOR.value):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     try:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -246,30 +252,28 @@ def delete_course(
             resp_dict["message"] = "All courses deleted"
             response.status_code = status.HTTP_200_OK
         conn.commit()
+        if course_id != 'all':
+            course_cache.invalidate_course(course_id)
+        else:
+            course_cache.clear()
     except:
         resp_dict = {"message": "Bad request?"}
         response.status_code = status.HTTP_400_BAD_REQUEST
     finally:
         cur.close()
-        conn.close()
         return resp_dict
 
 # retrieve prof courses
-@router.get("/prof/{email_prefix}")
+@router.get("/prof/{email_prefix}", dependencies=[Depends(require_staff)])
 def get_prof_courses(
     email_prefix: str,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token).value < USER_TYPE.SEPARATOR.value):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     # try:
     response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
-    if _email_prefix_exists(email_prefix):
+    if _email_prefix_exists(email_prefix, conn):
         cur.execute("""
                     SELECT course_id FROM profs_courses 
                     WHERE prof_prefix = %s
@@ -306,5 +310,4 @@ def get_prof_courses(
     #     response.status_code = status.HTTP_400_BAD_REQUEST
     # finally:
     cur.close()
-    conn.close()
     return resp_dict
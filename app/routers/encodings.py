@@ -1,19 +1,30 @@
 import base64
+import copy
+import os
 import numpy as np
-from fastapi import APIRouter, Response, status, UploadFile, Header
-from typing import Annotated, Union
-from app.database import connect
-from app.routers.users import _verify_token, _get_email_from_token
+from fastapi import APIRouter, Response, status, UploadFile, Depends
+from fastapi.concurrency import run_in_threadpool
+from app.database import db_conn
+from app.auth import require_user, require_staff, any_user
 from app.routers.students import _roll_num_exists
-import face_recognition
 import cv2
 from io import BytesIO
-from app.config import IMG_CACHE_LOCATION
+from app.config import RECOGNITION_PROFILE, ENROLL_MAX_PHOTOS, LECTURE_MAX_PHOTOS, MATCH_TOLERANCE, VIDEO_LOCATION
 from app.common import conv_to_dict, USER_TYPE
-from app.send_email import send_encoding_reminder_email
+from app.send_email import encoding_reminder_message
+from app.encoding_store import ENCODING_COLUMNS, decode, insert_encodings, load_encodings, course_cache
+from app.recognition import match_faces, stage_timer, recognition_workers, enrollment_job, lecture_job, tiled_lectures
+from app.recognition import get_profile, profiles, verify_enrollment, confidence, detections, lecture_results
+from app.recognition import fuse_matches
+from app.face_index import campus_index
+from app.uploads import read_upload, read_uploads, save_upload
+from app.video import video_job
+from app.image_store import image_cache
+from app import outbox
 
 from time import time
-from datetime import datetime, timezone
+from typing import List, Optional
+from datetime import datetime
 
 encoding_validity = 7 # generated encodings valid for days
 router = APIRouter(
@@ -21,121 +32,152 @@ router = APIRouter(
     tags=["encodings"]
 )
 
+def _face_dict(location):
+    y1, x2, y2, x1 = location[0], location[1], location[2], location[3]
+    return [
+        {
+            "x" : x1,
+            "y" : y1
+        },
+        {
+            "x" : x2,
+            "y" : y2
+        },
+    ]
+
+# returns (status code, message) if roll_num can not be enrolled by user, else None
+def _enroll_error(roll_num, user, conn):
+    if (user.user_type == USER_TYPE.STUDENT and user.subject != roll_num):
+        return status.HTTP_401_UNAUTHORIZED, "You can only upload encodings for yourself"
+    if len(roll_num) != 9:
+        return status.HTTP_400_BAD_REQUEST, "Invalid roll number"
+    if not _roll_num_exists(roll_num, conn):
+        return status.HTTP_404_NOT_FOUND, "Roll number not found"
+    return None
+
+# encodes every photo on the recognition pool in parallel, checks the new faces against the
+# student's stored encodings in one vectorized step, then inserts accepted encodings and deletes
+# conflicting ones with one statement each in a single transaction
+async def _enroll(roll_num, files, profile, conn):
+    args = []
+    for upload in await read_uploads(files):
+        image_cache.put(upload)
+        args.append((upload.data, profile))
+    jobs = await recognition_workers.run_many(enrollment_job, args)
+    return await run_in_threadpool(_save_enrollment, roll_num, files, jobs, profile, conn)
+
+# checks and saves the encoded photos of _enroll, runs on the threadpool
+def _save_enrollment(roll_num, files, jobs, profile, conn):
+    photos = []
+    new_encs = []
+    candidates = []
+    for file, job in zip(files, jobs):
+        height, width = job["dimensions"]
+        photo = {
+            "filename" : file.filename,
+            "accepted" : False,
+            "dimensions" : {
+                "height" : height,
+                "width" : width
+            },
+        }
+        if len(job["locations"]) == 1:
+            photo["face"] = _face_dict(job["locations"][0])
+            new_encs.append(job["encodings"][0])
+            candidates.append(photo)
+        else:
+            photo["message"] = "None or more than one faces found"
+        photos.append(photo)
+    cur = conn.cursor()
+    cur.execute(f"SELECT encoding_id, {ENCODING_COLUMNS} FROM face_encodings WHERE roll_num = %s",
+                (roll_num, ))
+    rows = cur.fetchall()
+    accepted, conflicting = verify_enrollment(new_encs, [decode(row[1], row[2]) for row in rows],
+                                              profile.enroll_tolerance)
+    for photo, ok in zip(candidates, accepted):
+        photo["accepted"] = bool(ok)
+        if not ok:
+            photo["message"] = "Face does not match previous encodings"
+    stale = []
+    if accepted.any():
+        saved = [enc for enc, ok in zip(new_encs, accepted) if ok]
+        ids = insert_encodings(cur, roll_num, saved, datetime.utcnow())
+        stale = [rows[k][0] for k in np.nonzero(conflicting)[0]]
+        if len(stale) > 0:
+            cur.execute("DELETE FROM face_encodings WHERE encoding_id = ANY(%s::uuid[])",
+                        (stale, ))
+        conn.commit()
+        course_cache.update(stale, roll_num, ids, saved)
+        campus_index.add(ids, roll_num, saved)
+        campus_index.remove(stale)
+    cur.close()
+    return {
+        "photos" : photos,
+        "saved" : int(accepted.sum()),
+        "deleted" : len(stale),
+        "previous" : len(rows),
+        "count" : len(rows) - len(stale) + int(accepted.sum()),
+    }
+
 # upload image and save encoding if valid
 @router.post("/student/{roll_num}")
 async def upload_image(
     file: UploadFile,
     roll_num: str,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn,
+    user: any_user,
+    profile: Optional[str] = None
 ):
-    _trim_encodings(send_reminder = False)
-    user_type = _verify_token(token)
-    if (token is None or user_type == USER_TYPE.INVALID):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message" : "Invalid token, please login again"}
-        return resp_dict
-    elif (user_type == USER_TYPE.STUDENT):
-        if _get_email_from_token(token).removesuffix('@iiitr.ac.in') != roll_num:
-            response.status_code = status.HTTP_401_UNAUTHORIZED
-            resp_dict = {"message" : "You can only upload encodings for yourself"}
-    conn = connect()
-    cur = conn.cursor()
-    response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
-    valid = len(roll_num) == 9
-    exists = False
-    if valid: 
-        exists = _roll_num_exists(roll_num)
-    if valid and exists:
-        face = cv2.imdecode(np.fromstring(file.file.read(), np.uint8), cv2.IMREAD_UNCHANGED)
-        face_locations = face_recognition.face_locations(face)
-        path = IMG_CACHE_LOCATION + f"/{datetime.utcnow().timestamp()}_{roll_num}.jpg"
-        # print("will save to ", path)
-        cv2.imwrite(path, face)
-        resp_dict = {}
-        if len(face_locations) == 1:
-            face_enc = face_recognition.face_encodings(face)[0]
-            cur.execute("SELECT encoding_id, face_encoding FROM face_encodings WHERE roll_num = %s",
-                        (roll_num, ))
-            encs = cur.fetchall()
-            if len(encs) > 0:
-                matches = []
-                unmatches = []
-                for enc in encs:
-                    enc = list(enc)
-                    enc[1] = [float(x) for x in enc[1]]
-                    result = face_recognition.compare_faces([enc[1]], face_enc)
-                    if result[0]:
-                        matches.append(enc)
-                    else:
-                        unmatches.append(enc)
-                if len(matches) > len(unmatches):
-                    cur.execute("""
-                                INSERT INTO face_encodings
-                                (roll_num, face_encoding, creation_time)
-                                VALUES (%s, %s, %s)
-                                """,
-                                (roll_num, face_enc.tolist(), datetime.utcnow()))
-                    conn.commit()
-                    for un in unmatches:
-                        cur.execute("DELETE FROM face_encodings WHERE encoding_id = %s",
-                                    (un[0], ))
-                        conn.commit()
-                    response.status_code = status.HTTP_200_OK
-                    resp_dict = {
-                        "message" : f"Encoding saved, deleted {len(unmatches)} conflicting encodings",
-                        "count" : (len(matches) + 1)
-                    }
-                else:
-                    response.status_code = status.HTTP_400_BAD_REQUEST
-                    resp_dict = {
-                        "message" : "Given face does not match previous encodings, please delete all encodings and try again",
-                        "count" : len(encs)
-                    }
-            else:
-                cur.execute("""
-                            INSERT INTO face_encodings
-                            (roll_num, face_encoding, creation_time)
-                            VALUES (%s, %s, %s)
-                            """,
-                            (roll_num, face_enc.tolist(), datetime.utcnow()))
-                conn.commit()
-                response.status_code = status.HTTP_200_OK
-                resp_dict = {
-                    "message" : "Face encoding saved successfully!",
-                    "count" : 1
-                }
-            y1, x2, y2, x1 = face_locations[0][0], face_locations[0][1], face_locations[0][2], face_locations[0][3]
-            height, width = face.shape[:2]
-            resp_dict['face'] = [
-                {
-                    "x" : x1,
-                    "y" : y1
-                },
-                {
-                    "x" : x2,
-                    "y" : y2
-                },
-            ]
-            resp_dict["dimensions"] = {
-                "height" : height,
-                "width" : width
-            }
+    error = await run_in_threadpool(_enroll_error, roll_num, user, conn)
+    if error != None:
+        response.status_code = error[0]
+        return {"message" : error[1]}
+    result = await _enroll(roll_num, [file], get_profile(profile), conn)
+    photo = result["photos"][0]
+    if "face" not in photo:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"message" : "None or more than one faces found, please try again with a different photo"}
+    if photo["accepted"]:
+        response.status_code = status.HTTP_200_OK
+        if result["previous"] > 0:
+            message = f"Encoding saved, deleted {result['deleted']} conflicting encodings"
         else:
-            response.status_code = status.HTTP_400_BAD_REQUEST
-            resp_dict = {"message" : "None or more than one faces found, please try again with a different photo"}
-    elif not valid:
+            message = "Face encoding saved successfully!"
+    else:
         response.status_code = status.HTTP_400_BAD_REQUEST
-        resp_dict = {"message" : "Invalid roll number"}
-    elif not exists:
-        response.status_code = status.HTTP_404_NOT_FOUND
-        resp_dict = {"message" : "Roll number not found"}
-    # except:
-    #     resp_dict = {}
-    #     response.status_code = status.HTTP_400_BAD_REQUEST
-    # finally:
-    cur.close()
-    conn.close()
+        message = "Given face does not match previous encodings, please delete all encodings and try again"
+    return {
+        "message" : message,
+        "count" : result["count"],
+        "face" : photo["face"],
+        "dimensions" : photo["dimensions"],
+    }
+
+# upload several photos at once, each one with a single face is checked and saved
+@router.post("/student/{roll_num}/batch")
+async def upload_images(
+    files: List[UploadFile],
+    roll_num: str,
+    response: Response,
+    conn: db_conn,
+    user: any_user,
+    profile: Optional[str] = None
+):
+    error = await run_in_threadpool(_enroll_error, roll_num, user, conn)
+    if error != None:
+        response.status_code = error[0]
+        return {"message" : error[1]}
+    if len(files) > ENROLL_MAX_PHOTOS:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"message" : f"At most {ENROLL_MAX_PHOTOS} photos can be uploaded at once"}
+    resp_dict = await _enroll(roll_num, files, get_profile(profile), conn)
+    if resp_dict["saved"] > 0:
+        response.status_code = status.HTTP_200_OK
+        resp_dict["message"] = f"Saved {resp_dict['saved']} encodings, deleted {resp_dict['deleted']} conflicting encodings"
+    else:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        resp_dict["message"] = "No photo could be saved, please try again with different photos"
     return resp_dict
 
 def _img_to_base64(img, cvt_code = cv2.COLOR_RGB2BGR, compression = 50, return_str = True):
@@ -152,19 +194,21 @@ def _img_to_base64(img, cvt_code = cv2.COLOR_RGB2BGR, compression = 50, return_s
         return img_64
     return None
 
+# available recognition profiles
+@router.get("/profiles", dependencies=[Depends(require_user)])
+def get_profiles():
+    return {
+        "default" : RECOGNITION_PROFILE,
+        "profiles" : [p.as_dict() for p in profiles.values()],
+    }
+
 # get number of face encodings for student
-@router.get("/student/{roll_num}")
+@router.get("/student/{roll_num}", dependencies=[Depends(require_user)])
 def get_num_enc(
     roll_num: str,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    _trim_encodings(send_reminder = False)
-    if (token is None or _verify_token(token) == USER_TYPE.INVALID):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     cur.execute("SELECT encoding_id FROM face_encodings WHERE roll_num = %s",
                 (roll_num, ))
@@ -172,55 +216,64 @@ def get_num_enc(
     resp_dict = {'count' : len(rows)}
     return resp_dict
 
-@router.patch("/trim")
-def _trim_encodings(send_reminder : bool = True):
-    conn = connect()
+# delete every encoding older than encoding_validity days in one statement
+# runs on the scheduler, returns the roll numbers that lost encodings
+def expire_encodings(conn):
+    cur = conn.cursor()
+    cur.execute("""
+                DELETE FROM face_encodings
+                WHERE creation_time <= now() - %s * interval '1 day'
+                RETURNING encoding_id, roll_num
+                """,
+                (encoding_validity, ))
+    rows = cur.fetchall()
+    rolls = set(row[1] for row in rows)
+    conn.commit()
+    cur.close()
+    course_cache.update([row[0] for row in rows])
+    campus_index.remove([row[0] for row in rows])
+    return rolls
+
+# queue a reminder for every student with too few encodings left
+def queue_encoding_reminders(conn):
     cur = conn.cursor()
-    cur.execute("SELECT encoding_id, creation_time FROM face_encodings")
+    cur.execute("""
+                SELECT roll_num FROM face_encodings
+                GROUP BY roll_num HAVING COUNT(encoding_id) < 3
+                """)
     rows = cur.fetchall()
     for row in rows:
-        enc_id = row[0]
-        cr_time = row[1]
-        diff = (datetime.now(timezone.utc) - cr_time).days
-        if diff >= encoding_validity:
-            cur.execute("DELETE FROM face_encodings WHERE encoding_id = %s",
-                        (enc_id, ))
-            conn.commit()
-    if send_reminder:
-        cur.execute("SELECT roll_num, COUNT(encoding_id) FROM face_encodings GROUP BY roll_num")
-        rows = cur.fetchall()
-        for row in rows:
-            roll_num = row[0]
-            count = row[1]
-            if count < 3:
-                send_encoding_reminder_email(roll_num)
+        outbox.enqueue(conn, encoding_reminder_message(row[0]))
+    conn.commit()
+    outbox.wake()
     cur.close()
-    conn.close()
+    return len(rows)
+
+@router.patch("/trim", dependencies=[Depends(require_staff)])
+def _trim_encodings(conn: db_conn, send_reminder : bool = True):
+    expired = expire_encodings(conn)
+    resp_dict = {"expired_students" : len(expired)}
+    if send_reminder:
+        resp_dict["reminders"] = queue_encoding_reminders(conn)
+    return resp_dict
 
 @router.delete("/student/{roll_num}")
 def delete_encodings(
     roll_num: str, 
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn,
+    user: any_user
 ):
-    _trim_encodings(send_reminder = False)
-    user_type = _verify_token(token)
-    if (token is None or user_type == USER_TYPE.INVALID):
+    if (user.user_type == USER_TYPE.STUDENT and user.subject != roll_num):
         response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message" : "Invalid token, please login again"}
+        resp_dict = {"message" : "You can only delete your own encodings"}
         return resp_dict
-    elif (user_type == USER_TYPE.STUDENT):
-        if _get_email_from_token(token).removesuffix('@iiitr.ac.in') != roll_num:
-            response.status_code = status.HTTP_401_UNAUTHORIZED
-            resp_dict = {"message" : "You can only delete your own encodings"}
-            return resp_dict
-    conn = connect()
     cur = conn.cursor()
     try:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         col_names = ['roll_num', 'creation_time']
         if roll_num != 'all':
-            valid = len(roll_num) == 9 and _roll_num_exists(roll_num)
+            valid = len(roll_num) == 9 and _roll_num_exists(roll_num, conn)
             if valid:
                 cur.execute("SELECT roll_num, creation_time FROM face_encodings WHERE roll_num = %s",
                             (roll_num, ))
@@ -229,6 +282,8 @@ def delete_encodings(
                     cur.execute("DELETE FROM face_encodings WHERE roll_num = %s",
                                 (roll_num, ))
                     conn.commit()
+                    course_cache.invalidate_students([roll_num])
+                    campus_index.remove_students([roll_num])
                     resp_dict = row
                     resp_dict['message'] = "Encodings deleted successfully!";
                     response.status_code = status.HTTP_200_OK
@@ -243,6 +298,8 @@ def delete_encodings(
             rows = conv_to_dict("encodings", cur.fetchall(), col_names)
             cur.execute("DELETE FROM face_encodings")
             conn.commit()
+            course_cache.clear()
+            campus_index.clear()
             resp_dict = rows
             response.status_code = status.HTTP_200_OK
     except:
@@ -250,118 +307,362 @@ def delete_encodings(
         response.status_code = status.HTTP_400_BAD_REQUEST
     finally:
         cur.close()
-        conn.close()
         return resp_dict
 
-@router.post("/lecture/{lecture_id}")
+# closest students on the whole campus for every face in a photo, from the campus-wide index
+@router.post("/identify", dependencies=[Depends(require_staff)])
+async def identify_faces(
+    file: UploadFile,
+    response: Response,
+    profile: Optional[str] = None,
+    k: int = 3
+):
+    profile = get_profile(profile)
+    timer = stage_timer()
+    upload = await read_upload(file)
+    image_cache.put(upload)
+    job = await recognition_workers.run(lecture_job, upload.data, profile, timer=timer)
+    with timer.stage("search"):
+        found = await run_in_threadpool(campus_index.search, job["encodings"], max(1, min(k, 10)))
+    resp_dict = {"faces" : []}
+    for location, neighbours in zip(job["locations"], found):
+        face = {
+            "student" : None,
+            "candidates" : [{"student" : roll, "distance" : round(dist, 4)} for roll, dist in neighbours],
+            "face" : _face_dict(location),
+        }
+        if len(neighbours) > 0 and neighbours[0][1] <= profile.match_tolerance:
+            face["student"] = neighbours[0][0]
+            face["distance"] = round(neighbours[0][1], 4)
+            face["confidence"] = round(float(confidence(neighbours[0][1], profile.match_tolerance)), 4)
+        resp_dict["faces"].append(face)
+    if len(job["locations"]) > 0:
+        response.status_code = status.HTTP_200_OK
+        resp_dict["message"] = f"Identified {sum(face['student'] != None for face in resp_dict['faces'])} of {len(job['locations'])} faces"
+    else:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        resp_dict["message"] = "No faces found"
+    resp_dict["timings"] = timer.as_dict()
+    resp_dict["profile"] = profile.name
+    return resp_dict
+
+# pairs of students holding encodings of what looks like the same face,
+# usually a photo uploaded under the wrong roll number
+@router.get("/duplicates", dependencies=[Depends(require_staff)])
+def get_duplicate_encodings(tolerance: float = MATCH_TOLERANCE * 0.8):
+    pairs = campus_index.suspicious(tolerance)
+    return {"count" : len(pairs), "pairs" : pairs}
+
+# course id and course recognition profile of a lecture
+def _lecture_course(lecture_id, conn):
+    cur = conn.cursor()
+    cur.execute("""
+                SELECT lectures.course_id, courses.recognition_profile
+                FROM lectures INNER JOIN courses ON courses.course_id = lectures.course_id
+                WHERE lecture_id = %s
+                """,
+                (lecture_id, ))
+    course_id, course_profile = cur.fetchone()
+    cur.close()
+    return course_id, course_profile
+
+# decode, detection and encoding of lecture photos on the recognition pool, once per photo and profile
+# photos not seen before run in parallel, tiled ones one after another, results come back in order
+async def _detect_lectures(uploads, profile, tiled, timer):
+    keys = [(upload.sha256, profile.name, tiled) for upload in uploads]
+    jobs = [detections.get(key) for key in keys]
+    todo = [k for k, job in enumerate(jobs) if job is None]
+    if len(todo) == 0:
+        done = []
+    elif len(todo) == 1 and not tiled:
+        done = [await recognition_workers.run(lecture_job, uploads[todo[0]].data, profile, timer=timer)]
+    elif not tiled:
+        done = await recognition_workers.run_many(lecture_job, [(uploads[k].data, profile) for k in todo],
+                                                  timer=timer, stage="recognize")
+        for job in done:
+            timer.merge(job["stages"])
+    else:
+        done = await tiled_lectures([uploads[k].data for k in todo], profile, timer=timer)
+    for k, job in zip(todo, done):
+        detections.put(keys[k], job)
+        jobs[k] = job
+    return jobs
+
+# response entry of one face, in found_faces when it was given a student, else in not_found_faces
+def _lecture_face(location, result):
+    if result["student"] != None:
+        return {
+            "matches" : {result["student"] : result["matches"][result["student"]]},
+            "student" : result["student"],
+            "distance" : result["distance"],
+            "confidence" : result["confidence"],
+            "candidates" : result["matches"],
+            "face" : _face_dict(location),
+        }
+    # candidates are students within tolerance that were assigned to a closer face
+    return {
+        "candidates" : result["matches"],
+        "face" : _face_dict(location),
+    }
+
+# course, its recognition profile and its cached encodings
+# these are psycopg2 queries and possibly a course build, the async handlers run it on the threadpool
+def _lecture_candidates(lecture_id, conn, timer):
+    course_id, course_profile = _lecture_course(lecture_id, conn)
+    with timer.stage("load"):
+        candidates = course_cache.get(course_id, conn)
+    return course_id, course_profile, candidates
+
+# status code and message of a lecture response once found_faces and not_found_faces are filled in
+def _lecture_status(resp_dict, found_message):
+    if len(resp_dict["found_faces"]) > 0:
+        resp_dict["message"] = found_message
+        return status.HTTP_200_OK
+    if len(resp_dict["not_found_faces"]) > 0:
+        resp_dict["message"] = "No matches found"
+    else:
+        resp_dict["message"] = "No faces found"
+    return status.HTTP_404_NOT_FOUND
+
+# matching, and the campus-wide lookup with identify, of one photo's faces, runs on the threadpool
+def _lecture_report(job, candidates, profile, identify, conn, timer):
+    face_locations = job["locations"]
+    height, width = job["dimensions"]
+    resp_dict = {
+        "found_faces" : [],
+        "not_found_faces" : [],
+        "encodings_missing" : candidates.missing,
+        "dimensions" : {
+            "height" : height,
+            "width" : width
+        },
+    }
+    face_encs = job["encodings"]
+    # every face against every encoding at once, each student goes to at most one face
+    with timer.stage("match"):
+        results = match_faces(face_encs, candidates, profile.match_tolerance,
+                              load_exact=lambda ids: load_encodings(conn, ids))
+    for face, result in zip(face_locations, results):
+        if result["student"] != None:
+            resp_dict["found_faces"].append(_lecture_face(face, result))
+        else:
+            resp_dict["not_found_faces"].append(_lecture_face(face, result))
+    unmatched = [encoding for encoding, result in zip(face_encs, results) if result["student"] == None]
+    if identify and len(unmatched) > 0:
+        with timer.stage("identify"):
+            found = campus_index.search(unmatched, 1)
+        for face, neighbours in zip(resp_dict["not_found_faces"], found):
+            if len(neighbours) > 0 and neighbours[0][1] <= profile.match_tolerance:
+                face["identified"] = {
+                    "student" : neighbours[0][0],
+                    "distance" : round(neighbours[0][1], 4),
+                    "registered" : neighbours[0][0] in candidates.registered,
+                }
+    status_code = _lecture_status(resp_dict, "Matches found!")
+    resp_dict["profile"] = profile.name
+    return status_code, resp_dict
+
+# identify=true also looks up unmatched faces on the whole campus,
+# so students attending a course they are not registered for show up
+@router.post("/lecture/{lecture_id}", dependencies=[Depends(require_staff)])
 async def upload_lecture_image(
     file: UploadFile,
     lecture_id: str,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn,
+    profile: Optional[str] = None,
+    tiled: Optional[bool] = None,
+    identify: bool = False
 ):
-    _trim_encodings()
-    if (token is None or _verify_token(token).value < USER_TYPE.SEPARATOR.value):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
-    cur = conn.cursor()    
     response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
-    cur.execute("SELECT course_id FROM lectures WHERE lecture_id = %s",
-                (lecture_id, ))
-    course_id = cur.fetchone()[0]
-    cur.execute("SELECT student_roll FROM course_registrations WHERE course_id = %s",
-                (course_id, ))
-    rows = cur.fetchall()
-    encodings = []
-    missing_enc = []
-    for row in rows:
-        roll_num = row[0]
-        cur.execute("SELECT roll_num, face_encoding FROM face_encodings WHERE roll_num = %s",
-                    (roll_num, ))
-        stud_rows = cur.fetchall()
-        if len(stud_rows) > 0:
-            for row in stud_rows:
-                row = list(row)
-                row[1] = [float(x) for x in row[1]]
-                encodings.append(row)
-        else:
-            missing_enc.append(roll_num)
-    cur.close()
-    conn.close()
-    if len(encodings) == 0:
+    timer = stage_timer()
+    course_id, course_profile, candidates = await run_in_threadpool(_lecture_candidates, lecture_id, conn, timer)
+    profile = get_profile(profile, course_profile)
+    if tiled == None:
+        tiled = profile.tiled
+    if len(candidates) == 0:
         response.status_code = status.HTTP_404_NOT_FOUND
         resp_dict = {
             "message" : "No encodings found for registered students"
         }
         return resp_dict
 
-    img = cv2.imdecode(np.fromstring(file.file.read(), np.uint8), cv2.IMREAD_UNCHANGED)
-    path = IMG_CACHE_LOCATION + f"/{datetime.utcnow().timestamp()}_{course_id}.jpg"
-    print("will save to ", path)
-    cv2.imwrite(path, img)
-    face_locations = face_recognition.face_locations(img)
-    height, width = img.shape[:2]
+    upload = await read_upload(file)
+    image_cache.put(upload)
+    # a re-upload of the same photo against the same course encodings gets the earlier response,
+    # identify also depends on every other student's encodings, so it is not kept
+    result_key = (upload.sha256, candidates.serial, profile.name, tiled)
+    cached = None if identify else lecture_results.get(result_key)
+    if cached is not None:
+        response.status_code = cached[0]
+        resp_dict = copy.deepcopy(cached[1])
+        resp_dict["cached"] = True
+        resp_dict["timings"] = timer.as_dict()
+        course_cache.record(course_id, timer)
+        return resp_dict
+    job = (await _detect_lectures([upload], profile, tiled, timer))[0]
+    response.status_code, resp_dict = await run_in_threadpool(_lecture_report, job, candidates, profile,
+                                                              identify, conn, timer)
+    if not identify:
+        lecture_results.put(result_key, (response.status_code, copy.deepcopy(resp_dict)))
+    resp_dict["timings"] = timer.as_dict()
+    course_cache.record(course_id, timer)
+    return resp_dict
+
+# matching and fusion of several photos' faces, runs on the threadpool
+def _batch_report(uploads, jobs, candidates, profile, conn, timer):
+    with timer.stage("match"):
+        photo_results = [match_faces(job["encodings"], candidates, profile.match_tolerance,
+                                     load_exact=lambda ids: load_encodings(conn, ids))
+                         for job in jobs]
+    with timer.stage("fuse"):
+        best, seen, unknown = fuse_matches(photo_results, [job["encodings"] for job in jobs],
+                                           profile.match_tolerance)
     resp_dict = {
         "found_faces" : [],
         "not_found_faces" : [],
-        "encodings_missing" : missing_enc,
-        "dimensions" : {
-            "height" : height,
-            "width" : width
+        "absent" : [str(student) for student in candidates.students if str(student) not in best],
+        "encodings_missing" : candidates.missing,
+        "photos" : [],
+    }
+    for student in sorted(best):
+        photo, face = best[student]
+        entry = _lecture_face(jobs[photo]["locations"][face], photo_results[photo][face])
+        entry["photo"] = photo
+        entry["photos"] = seen[student]
+        resp_dict["found_faces"].append(entry)
+    for group in unknown:
+        photo, face = group[0]
+        entry = _lecture_face(jobs[photo]["locations"][face], photo_results[photo][face])
+        entry["photo"] = photo
+        entry["photos"] = [p for p, _ in group]
+        resp_dict["not_found_faces"].append(entry)
+    for upload, job, results in zip(uploads, jobs, photo_results):
+        height, width = job["dimensions"]
+        resp_dict["photos"].append({
+            "filename" : upload.filename,
+            "faces" : len(job["locations"]),
+            "found" : sum(result["student"] != None for result in results),
+            "dimensions" : {
+                "height" : height,
+                "width" : width
+            },
+        })
+    status_code = _lecture_status(resp_dict, f"Found {len(resp_dict['found_faces'])} students in {len(uploads)} photos")
+    resp_dict["profile"] = profile.name
+    return status_code, resp_dict
+
+# several photos of one lecture, e.g. one per section of the hall, recognized in parallel on the pool
+# every student is reported once, from the photo they matched best in, with every photo they were found in,
+# faces left unmatched in several photos are reported once, and registered students found in none are absent
+@router.post("/lecture/{lecture_id}/batch", dependencies=[Depends(require_staff)])
+async def upload_lecture_images(
+    files: List[UploadFile],
+    lecture_id: str,
+    response: Response,
+    conn: db_conn,
+    profile: Optional[str] = None,
+    tiled: Optional[bool] = None
+):
+    if len(files) > LECTURE_MAX_PHOTOS:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"message" : f"At most {LECTURE_MAX_PHOTOS} photos can be uploaded at once"}
+    response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+    timer = stage_timer()
+    course_id, course_profile, candidates = await run_in_threadpool(_lecture_candidates, lecture_id, conn, timer)
+    profile = get_profile(profile, course_profile)
+    if tiled == None:
+        tiled = profile.tiled
+    if len(candidates) == 0:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return {"message" : "No encodings found for registered students"}
+    uploads = await read_uploads(files)
+    for upload in uploads:
+        image_cache.put(upload)
+    jobs = await _detect_lectures(uploads, profile, tiled, timer)
+    response.status_code, resp_dict = await run_in_threadpool(_batch_report, uploads, jobs, candidates, profile,
+                                                              conn, timer)
+    resp_dict["timings"] = timer.as_dict()
+    course_cache.record(course_id, timer)
+    return resp_dict
+
+# response entry of track t, from the frame its face was largest in
+def _video_face(tracks, results, t, in_tracks):
+    track = tracks[t]
+    face = _lecture_face(track["box"], results[t])
+    face["track"] = t
+    face["tracks"] = in_tracks
+    face["frame"] = track["frame"]
+    face["seconds"] = track["seconds"]
+    return face
+
+# matching and fusion of a video's face tracks, runs on the threadpool
+def _video_report(job, candidates, profile, conn, timer):
+    tracks = job["tracks"]
+    encodings = np.array([track["encoding"] for track in tracks]).reshape(-1, 128)
+    with timer.stage("match"):
+        results = match_faces(encodings, candidates, profile.match_tolerance,
+                              load_exact=lambda ids: load_encodings(conn, ids))
+    # each track is its own photo, so the same student or stranger on several tracks is reported once
+    with timer.stage("fuse"):
+        best, seen, unknown = fuse_matches([[result] for result in results], [[encoding] for encoding in encodings],
+                                           profile.match_tolerance)
+    height, width = job["dimensions"]
+    resp_dict = {
+        "found_faces" : [_video_face(tracks, results, best[student][0], seen[student]) for student in sorted(best)],
+        "not_found_faces" : [_video_face(tracks, results, group[0][0], [t for t, _ in group]) for group in unknown],
+        "absent" : [str(student) for student in candidates.students if str(student) not in best],
+        "encodings_missing" : candidates.missing,
+        "video" : {
+            "dimensions" : {
+                "height" : height,
+                "width" : width
+            },
+            "fps" : job["fps"],
+            "seconds" : job["seconds"],
+            "truncated" : job["truncated"],
+            "frames" : job["frames"],
+            "sampled" : job["sampled"],
+            "tracks" : len(tracks),
+            "encoded" : sum(track["encodings"] for track in tracks),
         },
     }
-    for face in face_locations:
-        face_enc = face_recognition.face_encodings(img, known_face_locations=[face])[0]
-        cmp = face_recognition.compare_faces([e[1] for e in encodings], face_enc, tolerance=0.5)
-        matches = 0
-        for r in cmp:
-            if r:
-                matches += 1
-        y1, x2, y2, x1 = face[0], face[1], face[2], face[3]
-        if matches > 0:
-            match_dict = {}
-            for i in range(0, len(cmp)):
-                if cmp[i]:
-                    roll_num = encodings[i][0]
-                    if roll_num in match_dict.keys():
-                        match_dict[roll_num] += 1
-                    else:
-                        match_dict[roll_num] = 1
-            resp_dict["found_faces"].append({
-                "matches" : match_dict,
-                "face" : [
-                    {
-                        "x" : x1,
-                        "y" : y1
-                    },
-                    {
-                        "x" : x2,
-                        "y" : y2
-                    },
-                ],
-            })
-        else:
-            resp_dict["not_found_faces"].append({
-                "face" : [
-                    {
-                        "x" : x1,
-                        "y" : y1
-                    },
-                    {
-                        "x" : x2,
-                        "y" : y2
-                    },
-                ],
-            })
-    if len(resp_dict["found_faces"]) > 0:
-        response.status_code = status.HTTP_200_OK
-        resp_dict['message'] = "Matches found!"
-    else:
+    status_code = _lecture_status(resp_dict, f"Found {len(resp_dict['found_faces'])} students in the video")
+    resp_dict["profile"] = profile.name
+    return status_code, resp_dict
+
+# a clip of the camera panned across the room instead of photos, see app/video.py
+# every face track is matched on the average of its encodings, a student is reported once from the
+# track that matched best, with every track they were seen in
+@router.post("/lecture/{lecture_id}/video", dependencies=[Depends(require_staff)])
+async def upload_lecture_video(
+    file: UploadFile,
+    lecture_id: str,
+    response: Response,
+    conn: db_conn,
+    profile: Optional[str] = None
+):
+    response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+    timer = stage_timer()
+    course_id, course_profile, candidates = await run_in_threadpool(_lecture_candidates, lecture_id, conn, timer)
+    profile = get_profile(profile, course_profile)
+    if len(candidates) == 0:
         response.status_code = status.HTTP_404_NOT_FOUND
-        if len(resp_dict['not_found_faces']) > 0:
-            resp_dict["message"] = "No matches found"
-        else:
-            resp_dict["message"] = "No faces found"
+        return {"message" : "No encodings found for registered students"}
+    clip = await save_upload(file, VIDEO_LOCATION)
+    try:
+        job_key = (clip.sha256, profile.name, "video")
+        job = detections.get(job_key)
+        if job is None:
+            job = await recognition_workers.run(video_job, clip.path, profile, timer=timer)
+            if job["dimensions"] is not None:
+                detections.put(job_key, job)
+    finally:
+        os.remove(clip.path)
+    if job["dimensions"] is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"message" : "Could not read the video"}
+    response.status_code, resp_dict = await run_in_threadpool(_video_report, job, candidates, profile, conn, timer)
+    resp_dict["timings"] = timer.as_dict()
+    course_cache.record(course_id, timer)
     return resp_dict
@@ -1,14 +1,13 @@
 from datetime import date
-from typing import Annotated, List, Union
-from fastapi import APIRouter, Header, Response, status
+from typing import Annotated, Union
+from fastapi import APIRouter, Depends, Response, status
 from pydantic import BaseModel
-from app.common import USER_TYPE, conv_to_dict
-from app.database import connect
+from app.common import conv_to_dict
+from app.database import db_conn
 from app.routers.students import _get_student_from_roll_num
-from app.routers.users import _verify_token
+from app.auth import require_user, require_staff
 
 
-conn = connect()
 router = APIRouter(
     prefix="/lectures",
     tags=['lectures']
@@ -23,17 +22,12 @@ class lecture(BaseModel):
     description: str
 
 # create one
-@router.post("/create")
+@router.post("/create", dependencies=[Depends(require_staff)])
 def add_lecture(
     data: lecture,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ): 
-    if (token is None or _verify_token(token).value < USER_TYPE.SEPARATOR.value):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
     cur.execute("""
@@ -49,23 +43,17 @@ def add_lecture(
     resp_dict['message'] = "Lecture added successfully!"
     response.status_code = status.HTTP_201_CREATED
     cur.close()
-    conn.close()
     return resp_dict
 
 # get first n from course
 # 0 for all
-@router.get("/course/{course_id}/{n}")
+@router.get("/course/{course_id}/{n}", dependencies=[Depends(require_user)])
 def get_course_lectures(
     course_id: str,
     n: int,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token) == USER_TYPE.INVALID):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
     if n == 0:
@@ -89,21 +77,15 @@ def get_course_lectures(
         resp_dict = {"message" : "No lectures found for the given course"}
         response.status_code = status.HTTP_404_NOT_FOUND
     cur.close()
-    conn.close()
     return resp_dict
 
 # get one/all lecture(s) by lecture_id
-@router.get("/get/{lecture_id}")
+@router.get("/get/{lecture_id}", dependencies=[Depends(require_user)])
 def get_lectures(
     lecture_id: str,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token) == USER_TYPE.INVALID):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
     if lecture_id == 'all':
@@ -125,11 +107,9 @@ def get_lectures(
         resp_dict = {"message" : "Lecture(s) not found"}
         response.status_code = status.HTTP_404_NOT_FOUND
     cur.close()
-    conn.close()
     return resp_dict
 
-def _lecture_id_exists(lecture_id: str):
-    conn = connect()
+def _lecture_id_exists(lecture_id: str, conn):
     cur = conn.cursor()
     exists = False
     try:
@@ -141,21 +121,15 @@ def _lecture_id_exists(lecture_id: str):
             exists = False
     finally:
         cur.close()
-        conn.close()
         return exists
 
 # update one
-@router.post("/update/{lecture_id}")
+@router.post("/update/{lecture_id}", dependencies=[Depends(require_staff)])
 def update_lecture(
     data: lecture,
     lecture_id: str, response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token).value < USER_TYPE.SEPARATOR.value):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     # try:
     response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -185,21 +159,15 @@ def update_lecture(
     #     response.status_code = status.HTTP_400_BAD_REQUEST
     # finally:
     cur.close()
-    conn.close()
     return resp_dict
 
 # delete one/all
-@router.delete("/delete/{lecture_id}")
+@router.delete("/delete/{lecture_id}", dependencies=[Depends(require_staff)])
 def delete_lecture(
     lecture_id: str,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token).value < USER_TYPE.SEPARATOR.value):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     # try:
     response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -235,5 +203,4 @@ def delete_lecture(
     #     response.status_code = status.HTTP_400_BAD_REQUEST
     # finally:
     cur.close()
-    conn.close()
     return resp_dict
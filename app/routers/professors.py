@@ -1,11 +1,9 @@
-from fastapi import APIRouter, Header, Response, status
+from fastapi import APIRouter, Depends, Response, status
 from pydantic import BaseModel
-from app.database import connect
-from app.common import conv_to_dict, USER_TYPE
-from typing import Annotated, Union
-from app.routers.users import _verify_token
+from app.database import db_conn
+from app.common import conv_to_dict
+from app.auth import require_staff, any_user
 
-conn = connect()
 router = APIRouter(
     prefix="/professors",
     tags=["professors"]
@@ -16,17 +14,12 @@ class professor(BaseModel):
     name: str
 
 # create one
-@router.post("/")
+@router.post("/", dependencies=[Depends(require_staff)])
 def add_professor(
     data: professor, 
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token).value < USER_TYPE.SEPARATOR.value):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message" : "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     try:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -40,11 +33,9 @@ def add_professor(
         response.status_code = status.HTTP_400_BAD_REQUEST
     finally:
         cur.close()
-        conn.close()
         return resp_dict
 
-def _email_prefix_exists(email_prefix: str):
-    conn = connect()
+def _email_prefix_exists(email_prefix: str, conn):
     cur = conn.cursor()
     exists = False
     try:
@@ -56,7 +47,6 @@ def _email_prefix_exists(email_prefix: str):
             exists = False
     finally:
         cur.close()
-        conn.close()
         return exists
 
 # retrieve one/all
@@ -64,15 +54,13 @@ def _email_prefix_exists(email_prefix: str):
 def get_professor(
     email_prefix: str, 
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn,
+    user: any_user
 ):
-    user_type = _verify_token(token)
-    if ((token is None or user_type == USER_TYPE.INVALID) or 
-        (email_prefix == 'all' and user_type.value < USER_TYPE.SEPARATOR.value)):
+    if (email_prefix == 'all' and not user.is_staff()):
         response.status_code = status.HTTP_401_UNAUTHORIZED
         resp_dict = {"message" : "Invalid token, please login again"}
         return resp_dict
-    conn = connect()
     cur = conn.cursor()
     try:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -94,21 +82,15 @@ def get_professor(
         response.status_code = status.HTTP_400_BAD_REQUEST
     finally:
         cur.close()
-        conn.close()
         return resp_dict
 
 # update one
-@router.post("/{email_prefix}")
+@router.post("/{email_prefix}", dependencies=[Depends(require_staff)])
 def update_professor(
     data: professor, 
     email_prefix: str, response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token).value < USER_TYPE.SEPARATOR.value):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message" : "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     try:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -133,22 +115,16 @@ def update_professor(
         response.status_code = status.HTTP_400_BAD_REQUEST
     finally:
         cur.close()
-        conn.close()
         return resp_dict
 
 
 # delete one/all
-@router.delete("/{email_prefix}")
+@router.delete("/{email_prefix}", dependencies=[Depends(require_staff)])
 def delete_professor(
     email_prefix: str, 
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token).value < USER_TYPE.SEPARATOR.value):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message" : "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     try:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -177,5 +153,4 @@ def delete_professor(
         response.status_code = status.HTTP_400_BAD_REQUEST
     finally:
         cur.close()
-        conn.close()
         return resp_dict
\ No newline at end of file
@@ -1,15 +1,14 @@
 from datetime import datetime
-from fastapi import APIRouter, Header, Response, status
+from fastapi import APIRouter, Depends, Response, status
 from pydantic import BaseModel
-from app.database import connect
-from app.common import conv_to_dict, USER_TYPE
-from typing import Annotated, List, Union
+from app.database import db_conn
+from app.common import conv_to_dict
 from app.routers.courses import _get_course_from_id, col_names as courses_cols
 from app.routers.professors import _email_prefix_exists
 from app.routers.students import _get_student_from_roll_num, _roll_num_exists, student
-from app.routers.users import _verify_token
+from app.auth import require_user
+from app.encoding_store import course_cache
 
-conn = connect()
 router = APIRouter(
     prefix="/registrations",
     tags=["registrations"]
@@ -21,24 +20,19 @@ class registration(BaseModel):
     student_roll: str
 
 # toggle registration for a course/student pair
-@router.post("/reg")
+@router.post("/reg", dependencies=[Depends(require_user)])
 def toggle_course_reg(
     data : registration,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token) == USER_TYPE.INVALID):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     # try:
     response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
     cur.execute("SELECT course_id FROM courses WHERE course_id = %s",
                 (data.course_id, ))
     matches = cur.fetchall()
-    if len(matches) > 0 and _roll_num_exists(data.student_roll):
+    if len(matches) > 0 and _roll_num_exists(data.student_roll, conn):
         # try to find given pair
         cur.execute("""
                     SELECT registration_id FROM course_registrations
@@ -63,6 +57,7 @@ def toggle_course_reg(
                         (data.course_id, data.student_roll))
             conn.commit()
             resp_dict = {'message' : 'Registration successful!'}
+        course_cache.invalidate_course(data.course_id)
         response.status_code = status.HTTP_200_OK
     else:
         resp_dict = {"message": "Given course or student was not found!"}
@@ -72,21 +67,15 @@ def toggle_course_reg(
     #     response.status_code = status.HTTP_400_BAD_REQUEST
     # finally:
     cur.close()
-    conn.close()
     return resp_dict
 
 # get number of registered students
-@router.get("/numreg/{course_id}")
+@router.get("/numreg/{course_id}", dependencies=[Depends(require_user)])
 def get_num_reg_students(
     course_id: str,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token) == USER_TYPE.INVALID):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     cur.execute("SELECT * FROM course_registrations WHERE course_id = %s",
                 (course_id, ))
@@ -94,21 +83,16 @@ def get_num_reg_students(
     return resp_dict
 
 # retrieve student courses
-@router.get("/stud/{roll_num}")
+@router.get("/stud/{roll_num}", dependencies=[Depends(require_user)])
 def get_stud_courses(
     roll_num: str,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token) == USER_TYPE.INVALID):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     # try:
     response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
-    if _roll_num_exists(roll_num):
+    if _roll_num_exists(roll_num, conn):
         cur.execute("""
                     SELECT course_id FROM course_registrations 
                     WHERE student_roll = %s
@@ -118,7 +102,7 @@ def get_stud_courses(
         if len(course_ids) > 0:
             courses = []
             for course_id in course_ids:
-                courses.append(_get_course_from_id(course_id[0]))
+                courses.append(_get_course_from_id(course_id[0], conn))
             for course in courses:
                 course['is_running'] = (
                     course['end_date'] >= datetime.today().date())
@@ -135,21 +119,15 @@ def get_stud_courses(
     #     response.status_code = status.HTTP_400_BAD_REQUEST
     # finally:
     cur.close()
-    conn.close()
     return resp_dict
 
 # get courses available for registration for a student
-@router.get("/avareg/{student_roll}")
+@router.get("/avareg/{student_roll}", dependencies=[Depends(require_user)])
 def get_ava_courses(
     student_roll: str,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token) == USER_TYPE.INVALID):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     try:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -175,21 +153,15 @@ def get_ava_courses(
         response.status_code = status.HTTP_400_BAD_REQUEST
     finally:
         cur.close()
-        conn.close()
         return resp_dict
 
 # get students registered for a course
-@router.get("/cour/{course_id}")
+@router.get("/cour/{course_id}", dependencies=[Depends(require_user)])
 def get_reg_students(
     course_id: str,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token) == USER_TYPE.INVALID):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message": "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     cur.execute("""
                 SELECT registration_id, s.roll_num, s.name
@@ -213,8 +185,7 @@ def get_reg_students(
     return resp_dict
 
 # returns ((registration_id, roll_num, name),)
-def _get_reg_students_from_course_id(course_id : str):
-    conn = connect()
+def _get_reg_students_from_course_id(course_id : str, conn):
     cur = conn.cursor()
     cur.execute("""
                 SELECT registration_id, s.roll_num, s.name
@@ -226,5 +197,4 @@ def _get_reg_students_from_course_id(course_id : str):
                 (course_id, ))
     rows = cur.fetchall()
     cur.close()
-    conn.close()
     return rows
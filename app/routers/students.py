@@ -1,11 +1,11 @@
-from fastapi import APIRouter, Header, Response, status
+from fastapi import APIRouter, Depends, Response, status
 from pydantic import BaseModel
-from app.database import connect
-from app.common import conv_to_dict, USER_TYPE
-from typing import Annotated, Union
-from app.routers.users import _verify_token
+from app.database import db_conn
+from app.common import conv_to_dict
+from app.auth import require_staff, any_user
+from app.encoding_store import course_cache
+from app.face_index import campus_index
 
-conn = connect()
 router = APIRouter(
     prefix="/students",
     tags=["students"]
@@ -17,17 +17,12 @@ class student(BaseModel):
     name: str
 
 # create one
-@router.post("/create")
+@router.post("/create", dependencies=[Depends(require_staff)])
 def add_student(
     data: student, 
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token).value < USER_TYPE.SEPARATOR.value):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message" : "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     try:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -46,11 +41,9 @@ def add_student(
         response.status_code = status.HTTP_400_BAD_REQUEST
     finally:
         cur.close()
-        conn.close()
         return resp_dict
 
-def _roll_num_exists(roll_num: str):
-    conn = connect()
+def _roll_num_exists(roll_num: str, conn):
     cur = conn.cursor()
     exists = False
     try:
@@ -62,7 +55,6 @@ def _roll_num_exists(roll_num: str):
             exists = False
     finally:
         cur.close()
-        conn.close()
         return exists
 
 # retrieve one/all
@@ -70,15 +62,13 @@ def _roll_num_exists(roll_num: str):
 def get_student(
     roll_num: str, 
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn,
+    user: any_user
 ):
-    user_type = _verify_token(token)
-    if ((token is None or _verify_token(token) == USER_TYPE.INVALID) or
-        (roll_num == 'all' and user_type.value < USER_TYPE.SEPARATOR)):
+    if (roll_num == 'all' and not user.is_staff()):
         response.status_code = status.HTTP_401_UNAUTHORIZED
         resp_dict = {"message" : "Invalid token, please login again"}
         return resp_dict
-    conn = connect()
     cur = conn.cursor()
     try:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -99,35 +89,27 @@ def get_student(
         response.status_code = status.HTTP_400_BAD_REQUEST
     finally:
         cur.close()
-        conn.close()
         return resp_dict
 
-def _get_student_from_roll_num(roll_num: str):
-    if not _roll_num_exists(roll_num):
+def _get_student_from_roll_num(roll_num: str, conn):
+    if not _roll_num_exists(roll_num, conn):
         return None
     else:
-        conn = connect()
         cur = conn.cursor()
         cur.execute("SELECT roll_num, name FROM students WHERE roll_num = %s",
                     (roll_num, ))
         student_dict = conv_to_dict('student', cur.fetchall(), col_names)
         student = student_dict['student'][0]
         cur.close()
-        conn.close()
         return student
 
 # update one
-@router.post("/update/{roll_num}")
+@router.post("/update/{roll_num}", dependencies=[Depends(require_staff)])
 def update_student(
     data: student, 
     roll_num: str, response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token).value < USER_TYPE.SEPARATOR.value):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message" : "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     try:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -157,22 +139,16 @@ def update_student(
         response.status_code = status.HTTP_400_BAD_REQUEST
     finally:
         cur.close()
-        conn.close()
         return resp_dict
 
 
 # delete one/all
-@router.delete("/delete/{roll_num}")
+@router.delete("/delete/{roll_num}", dependencies=[Depends(require_staff)])
 def delete_student(
     roll_num: str, 
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token).value < USER_TYPE.SEPARATOR.value):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message" : "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     try:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -201,10 +177,15 @@ def delete_student(
             resp_dict = rows
             response.status_code = status.HTTP_200_OK
         conn.commit()
+        if roll_num != 'all':
+            course_cache.invalidate_students([roll_num])
+            campus_index.remove_students([roll_num])
+        else:
+            course_cache.clear()
+            campus_index.clear()
     except:
         resp_dict = {}
         response.status_code = status.HTTP_400_BAD_REQUEST
     finally:
         cur.close()
-        conn.close()
         return resp_dict
@@ -1,19 +1,19 @@
-from typing import Annotated, Union
 import cv2
-from fastapi import APIRouter, Header, Response, UploadFile, status
+from fastapi import APIRouter, Depends, Response, UploadFile, status
 import numpy
 from pydantic import BaseModel
-from app.database import connect
-from app.send_email import send_email_otp
-from app.common import user_type_to_str, is_email_valid, conv_to_dict, USER_TYPE
+from app.auth import _lookup_token, _revoke_tokens, _tokens_revoked, issue_token, require_admin, require_user, any_user
+from app.database import db_conn
+from app.send_email import otp_message
+from app import outbox
+from app.uploads import read_upload_sync
+from app.common import user_type_to_str, is_email_valid, conv_to_dict
 import pandas as pd
 
 import random
-import uuid
 from time import time
-from datetime import datetime, timezone
+from datetime import datetime
 
-token_validity = 15 # generated tokens valid for days
 router = APIRouter(
     prefix="/users",
     tags=["users"]
@@ -24,17 +24,12 @@ class user(BaseModel):
     user_type: int = 0
 
 # create one
-@router.post("/create")
+@router.post("/create", dependencies=[Depends(require_admin)])
 def create_user(
     data: user, 
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token) != USER_TYPE.ADMIN):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message" : "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     try:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -53,7 +48,6 @@ def create_user(
         response.status_code = status.HTTP_400_BAD_REQUEST
     finally:
         cur.close()
-        conn.close()
         return resp_dict
 
 class student(BaseModel):
@@ -64,8 +58,8 @@ class student(BaseModel):
 def create_student_user(
     data: student,
     response: Response,
+    conn: db_conn,
 ):
-    conn = connect()
     cur = conn.cursor()
     cur.execute("INSERT INTO user_accounts (email,user_type) VALUES (%s, %s)", 
                 (f"{data.roll_num}@iiitr.ac.in", 0))
@@ -75,21 +69,15 @@ def create_student_user(
     resp_dict = data
     response.status_code = status.HTTP_201_CREATED
     cur.close()
-    conn.close()
     return resp_dict
 
 # retrieve one/all
-@router.get("/get/{email}")
+@router.get("/get/{email}", dependencies=[Depends(require_admin)])
 def get_users(
     email: str, 
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token) != USER_TYPE.ADMIN):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message" : "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     try:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -111,22 +99,16 @@ def get_users(
         response.status_code = status.HTTP_400_BAD_REQUEST
     finally:
         cur.close()
-        conn.close()
         return resp_dict
 
 # update one
-@router.post("/update/{email}")
+@router.post("/update/{email}", dependencies=[Depends(require_admin)])
 def update_user(
     data: user, 
     email: str, 
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token) != USER_TYPE.ADMIN):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message" : "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     try:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -138,7 +120,9 @@ def update_user(
             if valid:
                 cur.execute("UPDATE user_accounts SET email = %s, user_type = %s WHERE email = %s",
                             (data.email, data.user_type, email))
+                revoked = _revoke_tokens(email, conn)
                 conn.commit()
+                _tokens_revoked(revoked)
                 resp_dict = data
                 response.status_code = status.HTTP_200_OK
             else:
@@ -152,23 +136,18 @@ def update_user(
         response.status_code = status.HTTP_400_BAD_REQUEST
     finally:
         cur.close()
-        conn.close()
         return resp_dict
 
 
 # delete one/all
-@router.delete("/delete/{email}")
+@router.delete("/delete/{email}", dependencies=[Depends(require_admin)])
 def delete_user(
     email: str, 
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token) != USER_TYPE.ADMIN):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message" : "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
+    revoked = []
     try:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         col_names = ['email', 'user_type']
@@ -181,6 +160,7 @@ def delete_user(
                 if len(row) > 0:
                     cur.execute("DELETE FROM user_accounts WHERE email = %s", 
                                 (email, ))
+                    revoked.append(_revoke_tokens(email, conn))
                     resp_dict = row
                     response.status_code = status.HTTP_200_OK
                 else:
@@ -191,17 +171,21 @@ def delete_user(
                 response.status_code = status.HTTP_400_BAD_REQUEST
         else:
             cur.execute("SELECT email, user_type FROM user_accounts")
-            rows = conv_to_dict("user_accounts", cur.fetchall(), col_names)
+            user_rows = cur.fetchall()
+            rows = conv_to_dict("user_accounts", user_rows, col_names)
+            for user_row in user_rows:
+                revoked.append(_revoke_tokens(user_row[0], conn))
             cur.execute("DELETE FROM user_accounts")
             resp_dict = rows
             response.status_code = status.HTTP_200_OK
         conn.commit()
+        for user_revoked in revoked:
+            _tokens_revoked(user_revoked)
     except:
         resp_dict = {}
         response.status_code = status.HTTP_400_BAD_REQUEST
     finally:
         cur.close()
-        conn.close()
         return resp_dict
 
 class loginObj(BaseModel):
@@ -209,8 +193,7 @@ class loginObj(BaseModel):
     otp: int
 
 @router.post("/genotp")
-def genotp(data: loginObj, response: Response):
-    conn = connect()
+def genotp(data: loginObj, response: Response, conn: db_conn):
     cur = conn.cursor()
     # try:
     email = data.email.strip()
@@ -221,8 +204,9 @@ def genotp(data: loginObj, response: Response):
         otp = random.randint(1111, 9999)
         cur.execute("UPDATE user_accounts SET otp = %s WHERE email = %s",
                     (otp, email))
-        send_email_otp(otp, email)
+        outbox.enqueue(conn, otp_message(otp, email))
         conn.commit()
+        outbox.wake()
         response.status_code = status.HTTP_200_OK
         resp_dict = {"message" : f"OTP sent to {email}!"}
     else:
@@ -234,12 +218,10 @@ def genotp(data: loginObj, response: Response):
     print(email, data.otp)
     # finally:
     cur.close()
-    conn.close()
     return resp_dict
 
 @router.post("/login")
-def login(data: loginObj, response: Response):
-    conn = connect()
+def login(data: loginObj, response: Response, conn: db_conn):
     cur = conn.cursor()
     try:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -250,7 +232,9 @@ def login(data: loginObj, response: Response):
             saved_otp = row[0][0]
             user_type = row[0][1]
             if saved_otp != None and saved_otp == data.otp:
-                token = ''.join(str(uuid.uuid4()).split('-'))
+                # logging in again rotates the session, tokens handed out before stop working
+                revoked = _revoke_tokens(data.email, conn)
+                token = issue_token(data.email, user_type, not_before=revoked[1])
                 cur.execute("""
                             UPDATE user_accounts 
                             SET otp = NULL, token = %s, token_gen_time = %s 
@@ -258,6 +242,7 @@ def login(data: loginObj, response: Response):
                             """,
                             (token, datetime.utcnow(), data.email))
                 conn.commit()
+                _tokens_revoked(revoked)
                 resp_dict = { 
                     "email" : data.email, 
                     "user_type" : user_type, 
@@ -277,55 +262,23 @@ def login(data: loginObj, response: Response):
         response.status_code = status.HTTP_400_BAD_REQUEST
     finally:
         cur.close()
-        conn.close()
         return resp_dict
 
-def _verify_token(token):
-    conn = connect()
-    cur = conn.cursor()
-    try:
-        verified_type = USER_TYPE(-1)
-        cur.execute("SELECT token_gen_time, user_type FROM user_accounts WHERE token = %s",
-                    (token, ))
-        row = cur.fetchall()
-        if len(row) > 0:
-            gen_time = row[0][0]
-            user_type = int(row[0][1])
-            if (datetime.now(timezone.utc) - gen_time).days < token_validity:
-                verified_type = USER_TYPE(user_type)
-            else:
-                cur.execute("""
-                            UPDATE user_accounts 
-                            SET token = NULL, token_gen_time = NULL 
-                            WHERE token = %s
-                            """,
-                            (token, ))
-                conn.commit()
-    finally:
-        cur.close()
-        conn.close()
-        return verified_type
-
 class verifyObj(BaseModel):
     token: str
 
 @router.post("/verify")
-def verify(data: verifyObj, response: Response):
+def verify(data: verifyObj, response: Response, conn: db_conn):
     try:
         resp_dict = {"message" : "Temporary server error :/"}
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
-        conn = connect()
-        cur = conn.cursor()
-        if _verify_token(data.token) != USER_TYPE.INVALID:
-            cur.execute("SELECT email, user_type FROM user_accounts WHERE token = %s",
-                        (data.token, ))
-            row = cur.fetchall()
-            email = row[0][0]
-            user_type = row[0][1]
+        entry = _lookup_token(data.token, conn)
+        if entry is not None:
+            email, user_type, _ = entry
             resp_dict = { 
                 "email" : email,
-                "user_type" : user_type, 
-                "user_str" : user_type_to_str(user_type), 
+                "user_type" : user_type.value, 
+                "user_str" : user_type_to_str(user_type.value), 
                 "token" : data.token,
                 "message" : "Login successful!" 
             }
@@ -334,46 +287,45 @@ def verify(data: verifyObj, response: Response):
             resp_dict = {"message" : "Token invalid, please login again"}
             response.status_code = status.HTTP_401_UNAUTHORIZED
     finally:
-        cur.close()
-        conn.close()
         return resp_dict
 
-def _get_email_from_token(token: str):
-    conn = connect()
+# invalidates every token of the calling user
+@router.post("/logout")
+def logout(response: Response, conn: db_conn, user: any_user):
     cur = conn.cursor()
-    try:
-        email = None
-        if _verify_token(token) != USER_TYPE.INVALID:
-            cur.execute("SELECT email FROM user_accounts WHERE token = %s",
-                        (token, ))
-            row = cur.fetchall()
-            if len(row) > 0:
-                email = str(row[0][0])
-    finally:
-        cur.close()
-        conn.close()
-        return email
+    cur.execute("""
+                UPDATE user_accounts 
+                SET token = NULL, token_gen_time = NULL 
+                WHERE email = %s
+                """,
+                (user.email, ))
+    revoked = _revoke_tokens(user.email, conn)
+    conn.commit()
+    _tokens_revoked(revoked)
+    cur.close()
+    response.status_code = status.HTTP_200_OK
+    return {"message" : "Logged out successfully!"}
 
 @router.post("/photo/{email}")
 def post_photo(
     email: str,
     file: UploadFile,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn,
+    user: any_user
 ):
-    if (token is None or _verify_token(token) == USER_TYPE.INVALID):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message" : "Invalid token, please login again"}
-        return resp_dict
-    if _get_email_from_token(token) != email:
+    if user.email != email:
         response.status_code = status.HTTP_401_UNAUTHORIZED
         resp_dict = {"message" : "You can only upload photo for your own account"}
         return resp_dict
-    conn = connect()
+    upload = read_upload_sync(file)
+    img = cv2.imdecode(numpy.frombuffer(upload.data, numpy.uint8), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"message" : "Could not read the image"}
     cur = conn.cursor()
     # try:
     response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
-    img = cv2.imdecode(numpy.fromstring(file.file.read(), numpy.uint8), cv2.IMREAD_UNCHANGED)
     from app.routers.encodings import _img_to_base64
     cur.execute("""
                 UPDATE user_accounts 
@@ -389,20 +341,14 @@ def post_photo(
     #    resp_dict = {}
     # finally:
     cur.close()
-    conn.close()
     return resp_dict
 
-@router.get("/photo/{email}")
+@router.get("/photo/{email}", dependencies=[Depends(require_user)])
 def get_photo(
     email: str, 
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token) == USER_TYPE.INVALID):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message" : "Invalid token, please login again"}
-        return resp_dict
-    conn = connect()
     cur = conn.cursor()
     cur.execute("SELECT photo from user_accounts WHERE email = %s",
                 (email, ))
@@ -410,24 +356,18 @@ def get_photo(
         "photo" : cur.fetchone()[0]
     }
     cur.close()
-    conn.close()
     return resp_dict
 
 # add students from excel spreadsheet
-@router.post("/excel/add_students")
+@router.post("/excel/add_students", dependencies=[Depends(require_admin)])
 def add_students_from_xlsx(
     file: UploadFile,
     response: Response,
-    token: Annotated[Union[str, None], Header()] = None
+    conn: db_conn
 ):
-    if (token is None or _verify_token(token) != USER_TYPE.ADMIN):
-        response.status_code = status.HTTP_401_UNAUTHORIZED
-        resp_dict = {"message" : "Invalid token, please login again"}
-        return resp_dict
     df = pd.read_excel(file.file)
     rollnum_colname = df.columns.to_list()[0]
     name_colname = df.columns.to_list()[1]
-    conn = connect()
     cur = conn.cursor()
     isvalid = False
     for index, row in df.iterrows():
@@ -450,5 +390,4 @@ def add_students_from_xlsx(
         resp_dict = {'message' : '''Invalid data provided. 
                      Please make sure that the first column contains the roll numbers and the second column contains the name only'''}
     cur.close()
-    conn.close()
     return resp_dict
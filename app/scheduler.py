@@ -0,0 +1,86 @@
+import threading
+from time import monotonic
+from app.database import borrow
+
+class _job:
+    def __init__(self, name, interval, fn):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.next_run = monotonic()
+        self.runs = 0
+        self.skipped = 0
+        self.last_error = None
+        self.last_duration = None
+
+# runs registered jobs periodically on one background thread
+# every process runs its own scheduler, a run is claimed in scheduled_jobs
+# so only one process executes a job per interval
+class scheduler(threading.Thread):
+    def __init__(self):
+        super().__init__(name="scheduler", daemon=True)
+        self._jobs = []
+        self._lock = threading.Lock()
+        self._halt = threading.Event()
+
+    def every(self, interval, fn, name = None):
+        with self._lock:
+            self._jobs.append(_job(name or fn.__name__, interval, fn))
+
+    def _claim(self, job, conn):
+        cur = conn.cursor()
+        cur.execute("""
+                    INSERT INTO scheduled_jobs (name, last_run) VALUES (%s, now())
+                    ON CONFLICT (name) DO UPDATE SET last_run = now()
+                    WHERE scheduled_jobs.last_run <= now() - %s * interval '1 second'
+                    RETURNING name
+                    """,
+                    (job.name, job.interval * 0.9))
+        claimed = cur.fetchone() is not None
+        conn.commit()
+        cur.close()
+        return claimed
+
+    def _run(self, job):
+        started = monotonic()
+        try:
+            with borrow() as conn:
+                if self._claim(job, conn):
+                    job.fn(conn)
+                    job.runs += 1
+                    job.last_error = None
+                else:
+                    job.skipped += 1
+        except Exception as error:
+            print('scheduled job failed: ', job.name, ' ', error)
+            job.last_error = str(error)
+        job.last_duration = monotonic() - started
+        job.next_run = started + job.interval
+
+    def run(self):
+        while not self._halt.is_set():
+            with self._lock:
+                jobs = list(self._jobs)
+            for job in jobs:
+                if job.next_run <= monotonic() and not self._halt.is_set():
+                    self._run(job)
+            wait = min([job.next_run for job in jobs], default=monotonic() + 60) - monotonic()
+            self._halt.wait(max(wait, 0.5))
+
+    def stop(self):
+        self._halt.set()
+
+    def stats(self):
+        with self._lock:
+            jobs = list(self._jobs)
+        return {
+            job.name : {
+                "interval" : job.interval,
+                "runs" : job.runs,
+                "skipped" : job.skipped,
+                "last_error" : job.last_error,
+                "last_duration" : job.last_duration,
+            } for job in jobs
+        }
+
+jobs = scheduler()
\ No newline at end of file
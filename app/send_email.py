@@ -2,16 +2,166 @@ from email.mime.application import MIMEApplication
 from email.mime.base import MIMEBase
 from posixpath import basename
 import smtplib, ssl
+import threading
+from time import monotonic
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from app.config import MAIL_PORT, MAIL_HOST, MAIL_USERNAME, MAIL_PASSWORD
+from app.config import MAIL_PORT, MAIL_HOST, MAIL_USERNAME, MAIL_PASSWORD, MAIL_FROM, MAIL_STARTTLS
+from app.config import MAIL_POOL_SIZE, MAIL_SESSION_IDLE, MAIL_SESSION_MAX_MESSAGES, MAIL_TIMEOUT
 
 port = MAIL_PORT
 smtp_server = MAIL_HOST
-sender_email = MAIL_USERNAME
+sender_email = MAIL_FROM
+username = MAIL_USERNAME
 password = MAIL_PASSWORD
 
-def send_email_otp( otp = 0, send_to = "cs20b1014@iiitr.ac.in" ):
+# errors after which the session is dead and the message is worth one more try: the server hanging up
+# and anything at the socket level, timeouts and failed name lookups included
+# other SMTPExceptions (also OSErrors) are the server refusing a message
+def _is_reconnect_error(err):
+    if isinstance(err, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    return not isinstance(err, smtplib.SMTPException)
+
+class _session:
+    def __init__(self):
+        self.server = smtplib.SMTP(smtp_server, port, timeout=MAIL_TIMEOUT)
+        if MAIL_STARTTLS:
+            context = ssl.create_default_context()
+            self.server.starttls(context=context)
+        if username:
+            self.server.login(username, password)
+        self.sent = 0
+        self.last_used = monotonic()
+
+    def send(self, message):
+        self.server.sendmail(sender_email, message["To"], message.as_string())
+        self.sent += 1
+        self.last_used = monotonic()
+
+    def close(self):
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+
+# keeps up to `size` authenticated SMTP sessions alive between sends
+# sessions idle for longer than max_idle or used for max_messages are recycled
+class mailer:
+    def __init__(self, size, max_idle, max_messages):
+        self.size = size
+        self.max_idle = max_idle
+        self.max_messages = max_messages
+        self._idle = []
+        self._lock = threading.Lock()
+        self._counters = {
+            "connects" : 0,
+            "reconnects" : 0,
+            "sent" : 0,
+            "failed" : 0,
+        }
+
+    def _connect(self):
+        session = _session()
+        with self._lock:
+            self._counters["connects"] += 1
+        return session
+
+    def _checkout(self):
+        stale = []
+        session = None
+        with self._lock:
+            while len(self._idle) > 0:
+                candidate = self._idle.pop()
+                if monotonic() - candidate.last_used < self.max_idle:
+                    session = candidate
+                    break
+                stale.append(candidate)
+        for old in stale:
+            old.close()
+        if session is None:
+            session = self._connect()
+        return session
+
+    def _checkin(self, session):
+        if session.sent >= self.max_messages:
+            session.close()
+            return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(session)
+                return
+        session.close()
+
+    # sends every message over one session, reconnecting if the server drops it
+    # returns a list with None for each delivered message and the exception otherwise
+    def send_many(self, messages):
+        results = []
+        session = None
+        down = None # set when the server cannot be reached at all
+        for message in messages:
+            error = down
+            for attempt in range(0 if down else 2):
+                connected = session is not None
+                try:
+                    if session is None:
+                        session = self._checkout()
+                    elif session.sent >= self.max_messages:
+                        session.close()
+                        session = self._connect()
+                    session.send(message)
+                    error = None
+                    break
+                except OSError as err:
+                    error = err
+                    if not _is_reconnect_error(err):
+                        # rejected by the server, the session itself is still usable,
+                        # unless there is none because logging in was refused
+                        if session is None:
+                            down = err
+                        break
+                    if session is not None:
+                        session.close()
+                        session = None
+                    if not connected and attempt > 0:
+                        down = err
+                    with self._lock:
+                        self._counters["reconnects"] += 1
+            with self._lock:
+                self._counters["failed" if error else "sent"] += 1
+            results.append(error)
+        if session is not None:
+            self._checkin(session)
+        return results
+
+    def send(self, message):
+        error = self.send_many([message])[0]
+        if error is not None:
+            raise error
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session in idle:
+            session.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["idle"] = len(self._idle)
+        stats["size"] = self.size
+        return stats
+
+smtp_mailer = mailer(MAIL_POOL_SIZE, MAIL_SESSION_IDLE, MAIL_SESSION_MAX_MESSAGES)
+
+# sends an already built message over a pooled session
+def send_message( message ):
+    smtp_mailer.send(message)
+
+def send_messages( messages ):
+    return smtp_mailer.send_many(messages)
+
+def otp_message( otp = 0, send_to = "cs20b1014@iiitr.ac.in" ):
     otp_text = f'{otp:04}'
 
     message = MIMEMultipart("alternative")
@@ -39,14 +189,9 @@ def send_email_otp( otp = 0, send_to = "cs20b1014@iiitr.ac.in" ):
     part2 = MIMEText(html, "html")
     message.attach(part1)
     message.attach(part2)
+    return message
 
-    context = ssl.create_default_context()
-    with smtplib.SMTP(smtp_server, port) as server:
-        server.starttls(context=context)
-        server.login(sender_email, password)
-        server.sendmail(sender_email, send_to, message.as_string())
-
-def send_encoding_reminder_email( roll_num : str ):
+def encoding_reminder_message( roll_num : str ):
     message = MIMEMultipart("alternative")
     message["Subject"] = f"Face recognition data expired | IIITR Connect"
     message["From"] = sender_email
@@ -72,14 +217,9 @@ def send_encoding_reminder_email( roll_num : str ):
     part2 = MIMEText(html, "html")
     message.attach(part1)
     message.attach(part2)
+    return message
 
-    context = ssl.create_default_context()
-    with smtplib.SMTP(smtp_server, port) as server:
-        server.starttls(context=context)
-        server.login(sender_email, password)
-        server.sendmail(sender_email, f"{roll_num}@iiitr.ac.in", message.as_string())
-
-def send_attendance_sheet_email( email : str, course_name : str, path : str ):
+def attendance_sheet_message( email : str, course_name : str, path : str ):
     message = MIMEMultipart("alternative")
     message["Subject"] = f"Attendance Sheet for {course_name} | IIITR Connect"
     message["From"] = sender_email
@@ -109,9 +249,13 @@ def send_attendance_sheet_email( email : str, course_name : str, path : str ):
         )
     part3['Content-Disposition'] = 'attachment; filename="%s"' % basename(path)
     message.attach(part3)
+    return message
+
+def send_email_otp( otp = 0, send_to = "cs20b1014@iiitr.ac.in" ):
+    send_message(otp_message(otp, send_to))
 
-    context = ssl.create_default_context()
-    with smtplib.SMTP(smtp_server, port) as server:
-        server.starttls(context=context)
-        server.login(sender_email, password)
-        server.sendmail(sender_email, email, message.as_string())
+def send_encoding_reminder_email( roll_num : str ):
+    send_message(encoding_reminder_message(roll_num))
+
+def send_attendance_sheet_email( email : str, course_name : str, path : str ):
+    send_message(attendance_sheet_message(email, course_name, path))
@@ -0,0 +1,149 @@
+import hashlib
+import os
+import tempfile
+from fastapi import UploadFile, status
+from app.config import UPLOAD_MAX_BYTES, UPLOAD_CHUNK_SIZE, VIDEO_MAX_BYTES
+
+# bounded ingestion of uploaded images
+# starlette spools multipart files to disk past 1MB, they are read back here in chunks of
+# UPLOAD_CHUNK_SIZE into one buffer, hashed on the way, and refused as soon as they pass
+# UPLOAD_MAX_BYTES or the first bytes are not a known image format, before anything decodes them
+
+# status codes as numbers, starlette renamed the 413 constant between versions
+PAYLOAD_TOO_LARGE = 413
+UNSUPPORTED_MEDIA_TYPE = 415
+
+class upload_error(Exception):
+    def __init__(self, message, status_code = status.HTTP_400_BAD_REQUEST):
+        self.message = message
+        self.status_code = status_code
+
+# leading bytes of the formats cv2.imdecode is used for
+IMAGE_SIGNATURES = [
+    ("jpeg", 0, b"\xff\xd8\xff"),
+    ("png", 0, b"\x89PNG\r\n\x1a\n"),
+    ("webp", 8, b"WEBP"),
+    ("bmp", 0, b"BM"),
+]
+IMAGE_FORMATS = "a jpeg, png, webp or bmp image"
+
+# leading bytes of the containers cv2.VideoCapture is used for
+VIDEO_SIGNATURES = [
+    ("mp4", 4, b"ftyp"), # mp4, mov and 3gp
+    ("webm", 0, b"\x1a\x45\xdf\xa3"), # webm and mkv
+    ("avi", 8, b"AVI "),
+]
+VIDEO_FORMATS = "an mp4, mov, webm or avi video"
+
+def _readable(size):
+    if size >= 1024 * 1024:
+        return f"{size / (1024 * 1024):.0f}MB"
+    return f"{size / 1024:.0f}KB"
+
+def image_kind(head, signatures = IMAGE_SIGNATURES):
+    for kind, offset, signature in signatures:
+        if head[offset:offset + len(signature)] == signature:
+            return kind
+    return None
+
+# an uploaded image held in one buffer, data can go straight to np.frombuffer
+# uploads saved with save_upload have no data, they are at path instead
+class upload:
+    def __init__(self, filename, data, sha256, kind, size = None, path = None):
+        self.filename = filename
+        self.data = data
+        self.sha256 = sha256
+        self.kind = kind
+        self.size = len(data) if size is None else size
+        self.path = path
+
+# chunks go to sink when there is one, else they are kept in data
+class _reader:
+    def __init__(self, filename, max_bytes, signatures = IMAGE_SIGNATURES, formats = IMAGE_FORMATS, sink = None):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.signatures = signatures
+        self.formats = formats
+        self.sink = sink
+        self.data = bytearray() if sink is None else None
+        self.head = b""
+        self.size = 0
+        self.digest = hashlib.sha256()
+        self.kind = None
+
+    def feed(self, chunk):
+        if self.size + len(chunk) > self.max_bytes:
+            raise upload_error(f"{self.filename or 'Upload'} is larger than {_readable(self.max_bytes)}",
+                               PAYLOAD_TOO_LARGE)
+        if self.kind is None and len(self.head) < 12:
+            self.head += bytes(chunk[:12 - len(self.head)])
+            if len(self.head) >= 12 or len(chunk) == 0:
+                self.kind = image_kind(self.head, self.signatures)
+                if self.kind is None:
+                    raise upload_error(f"{self.filename or 'Upload'} is not {self.formats}",
+                                       UNSUPPORTED_MEDIA_TYPE)
+        if self.sink is None:
+            self.data += chunk
+        else:
+            self.sink.write(chunk)
+        self.size += len(chunk)
+        self.digest.update(chunk)
+
+    def finish(self):
+        if self.size == 0:
+            raise upload_error(f"{self.filename or 'Upload'} is empty")
+        if self.kind is None:
+            self.feed(b"")
+        return upload(self.filename, self.data, self.digest.hexdigest(), self.kind, self.size)
+
+def _check_size(file, max_bytes):
+    # starlette knows the size of parts it already spooled
+    if getattr(file, "size", None) is not None and file.size > max_bytes:
+        raise upload_error(f"{file.filename or 'Upload'} is larger than {_readable(max_bytes)}",
+                           PAYLOAD_TOO_LARGE)
+
+# for async endpoints
+async def read_upload(file: UploadFile, max_bytes = UPLOAD_MAX_BYTES):
+    _check_size(file, max_bytes)
+    reader = _reader(file.filename, max_bytes)
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        reader.feed(chunk)
+    return reader.finish()
+
+# for sync endpoints, already running on the threadpool
+def read_upload_sync(file: UploadFile, max_bytes = UPLOAD_MAX_BYTES):
+    _check_size(file, max_bytes)
+    reader = _reader(file.filename, max_bytes)
+    while True:
+        chunk = file.file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        reader.feed(chunk)
+    return reader.finish()
+
+async def read_uploads(files, max_bytes = UPLOAD_MAX_BYTES):
+    return [await read_upload(file, max_bytes) for file in files]
+
+# for videos, streamed into a new file under directory instead of memory, the caller removes upload.path
+async def save_upload(file: UploadFile, directory, max_bytes = VIDEO_MAX_BYTES,
+                      signatures = VIDEO_SIGNATURES, formats = VIDEO_FORMATS):
+    _check_size(file, max_bytes)
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, suffix=".upload")
+    try:
+        with os.fdopen(fd, "wb") as sink:
+            reader = _reader(file.filename, max_bytes, signatures, formats, sink)
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                reader.feed(chunk)
+            saved = reader.finish()
+    except BaseException:
+        os.remove(path)
+        raise
+    saved.path = path
+    return saved
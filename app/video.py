@@ -0,0 +1,184 @@
+import math
+import cv2
+import numpy as np
+from app.config import VIDEO_MAX_SECONDS, VIDEO_MAX_SIDE, VIDEO_SAMPLE_MIN, VIDEO_SAMPLE_MAX, VIDEO_SAMPLE_SHIFT
+from app.config import VIDEO_TRACK_ENCODINGS, VIDEO_TRACK_PATIENCE
+from app.recognition import stage_timer, detect_scaled, encode_faces
+
+# attendance from a clip of the camera panned across the room
+# frames are decoded one at a time on a pool worker and only sampled ones are detected on: often while
+# the camera moves fast, rarely while it is still; a face is followed from sample to sample as a track
+# and only encoded a few times, so memory holds one frame and the tracks whatever the clip's length
+
+THUMB_SIZE = (160, 90)
+ENCODE_GAP = 3 # samples between encodings of the same track
+
+# greyscale thumbnail the camera motion between two samples is measured on
+def _thumb(frame):
+    grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    return cv2.resize(grey, THUMB_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+def _area(box):
+    top, right, bottom, left = box
+    return max(bottom - top, 0) * max(right - left, 0)
+
+class face_track:
+    def __init__(self, box, sample, frame, seconds):
+        self.box = box # where the face was last seen
+        self.last = sample
+        self.ended = False
+        self.first = seconds
+        self.seconds = seconds
+        self.sightings = 0
+        self.encodings = []
+        self.encoded_at = None
+        self.best = None # (area, frame, box) of the largest sighting
+        self.see(box, sample, frame, seconds)
+
+    def see(self, box, sample, frame, seconds):
+        self._previous = (self.box, self.last, self.seconds, self.best)
+        self.box = box
+        self.last = sample
+        self.seconds = seconds
+        self.sightings += 1
+        if self.best is None or _area(box) > self.best[0]:
+            self.best = (_area(box), frame, box)
+
+    # take back the last see(), its face turned out to be someone else's
+    def unsee(self):
+        self.box, self.last, self.seconds, self.best = self._previous
+        self.sightings -= 1
+
+    def wants_encoding(self, sample):
+        if len(self.encodings) == 0:
+            return True
+        return len(self.encodings) < VIDEO_TRACK_ENCODINGS and sample - self.encoded_at >= ENCODE_GAP
+
+    # how far box is from where this track's face should be after the camera moved by shift, in face widths
+    def distance(self, box, shift):
+        top, right, bottom, left = self.box
+        size = max(right - left, bottom - top, 1)
+        other = max(box[1] - box[3], box[2] - box[0], 1)
+        if not 0.5 <= other / size <= 2:
+            return math.inf
+        dx = (box[1] + box[3]) / 2 - (right + left) / 2 - shift[0]
+        dy = (box[0] + box[2]) / 2 - (top + bottom) / 2 - shift[1]
+        return math.hypot(dx, dy) / size
+
+    def as_dict(self):
+        _, frame, box = self.best
+        return {
+            "encoding" : np.mean(self.encodings, axis=0),
+            "encodings" : len(self.encodings),
+            "sightings" : self.sightings,
+            "seconds" : [round(self.first, 2), round(self.seconds, 2)],
+            "frame" : frame,
+            "box" : box,
+        }
+
+# continue live tracks with the boxes of a sample, closest pairs first, a box less than a face width
+# from a track's predicted position is that track's face, the rest start new tracks
+# returns the (track, box) pairs to encode
+def follow(tracks, boxes, shift, sample, frame, seconds):
+    live = [track for track in tracks if not track.ended and sample - track.last <= VIDEO_TRACK_PATIENCE]
+    for track in tracks:
+        if not track.ended and sample - track.last > VIDEO_TRACK_PATIENCE:
+            track.ended = True
+    pairs = sorted((track.distance(box, shift), t, b) for t, track in enumerate(live) for b, box in enumerate(boxes))
+    taken_tracks = set()
+    taken_boxes = set()
+    encode = []
+    for distance, t, b in pairs:
+        if distance >= 1 or t in taken_tracks or b in taken_boxes:
+            continue
+        taken_tracks.add(t)
+        taken_boxes.add(b)
+        live[t].see(boxes[b], sample, frame, seconds)
+        if live[t].wants_encoding(sample):
+            encode.append((live[t], boxes[b]))
+    for b, box in enumerate(boxes):
+        if b not in taken_boxes:
+            track = face_track(box, sample, frame, seconds)
+            tracks.append(track)
+            encode.append((track, box))
+    return encode
+
+# pool job for a lecture video saved at path, dimensions is None when it can not be read
+# frames keep _decode's BGR channel order so encodings compare with enrolled ones
+def video_job(path, profile):
+    # the smaller of the two limits, 0 is none
+    max_side = min([side for side in (profile.max_side_lecture, VIDEO_MAX_SIDE) if side > 0], default=0)
+    timer = stage_timer(None)
+    capture = cv2.VideoCapture(path)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    if not fps or math.isnan(fps) or fps <= 0:
+        fps = 30.0
+    last_frame = int(VIDEO_MAX_SECONDS * fps)
+    tracks = []
+    dimensions = None
+    previous = None # (thumb, seconds) of the last sample
+    interval = VIDEO_SAMPLE_MIN
+    frame_no = 0
+    next_sample = 0
+    sample = 0
+    truncated = False
+    try:
+        while capture.isOpened():
+            if frame_no > last_frame:
+                truncated = capture.grab()
+                break
+            with timer.stage("decode"):
+                if frame_no < next_sample:
+                    # skipped frames are demuxed and decoded but never converted or copied out
+                    if not capture.grab():
+                        break
+                    frame_no += 1
+                    continue
+                ok, frame = capture.read()
+            if not ok:
+                break
+            seconds = frame_no / fps
+            height, width = frame.shape[:2]
+            dimensions = (height, width)
+            with timer.stage("track"):
+                thumb = _thumb(frame)
+                shift = (0.0, 0.0)
+                if previous is not None:
+                    (dx, dy), _ = cv2.phaseCorrelate(previous[0], thumb)
+                    moved = math.hypot(dx / THUMB_SIZE[0], dy / THUMB_SIZE[1]) # fraction of the frame
+                    speed = moved / max(seconds - previous[1], 1e-3)
+                    interval = VIDEO_SAMPLE_MAX if speed == 0 else VIDEO_SAMPLE_SHIFT / speed
+                    interval = min(max(interval, VIDEO_SAMPLE_MIN), VIDEO_SAMPLE_MAX)
+                    shift = (dx * width / THUMB_SIZE[0], dy * height / THUMB_SIZE[1])
+                previous = (thumb, seconds)
+            with timer.stage("detect"):
+                boxes = detect_scaled(frame, max_side, profile.upsample, profile.model)
+            with timer.stage("track"):
+                encode = follow(tracks, boxes, shift, sample, frame_no, seconds)
+            if len(encode) > 0:
+                with timer.stage("encode"):
+                    encodings = encode_faces(frame, [box for _, box in encode], profile.jitters, profile.landmarks)
+                for (track, box), encoding in zip(encode, encodings):
+                    # a different face took the track's place, it continues as a track of its own
+                    if len(track.encodings) > 0 and np.linalg.norm(track.encodings[0] - encoding) > profile.match_tolerance:
+                        track.unsee()
+                        track.ended = True
+                        track = face_track(box, sample, frame_no, seconds)
+                        tracks.append(track)
+                    track.encodings.append(encoding)
+                    track.encoded_at = sample
+            sample += 1
+            next_sample = frame_no + max(int(round(interval * fps)), 1)
+            frame_no += 1
+    finally:
+        capture.release()
+    return {
+        "tracks" : [track.as_dict() for track in tracks if len(track.encodings) > 0],
+        "dimensions" : dimensions,
+        "fps" : round(fps, 2),
+        "frames" : frame_no,
+        "sampled" : sample,
+        "seconds" : round(frame_no / fps, 2),
+        "truncated" : truncated,
+        "stages" : timer.stages,
+    }
@@ -0,0 +1,44 @@
+from time import time
+from app.cache import ttl_cache
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ttl_cache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1 # b is now the least recently used
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    stats = cache.stats()
+    assert stats["evicted"] == 1
+    assert stats["size"] == 2
+
+def test_entries_expire():
+    cache = ttl_cache(10, ttl=60)
+    cache.put("default", 1)
+    cache.put("past", 2, expires=time() - 1)
+    cache.ttl = None
+    cache.put("forever", 4)
+    assert cache.get("default") == 1
+    assert cache.get("past") is None
+    assert cache.get("forever") == 4
+    assert cache.stats()["expired"] == 1
+
+
+def test_pop_and_evict():
+    cache = ttl_cache(10)
+    for k in range(5):
+        cache.put(k, k * 10)
+    assert cache.pop(0) == 0
+    assert cache.pop(0) is None
+    assert cache.evict_where(lambda key, value: key % 2 == 1) == 2
+    assert cache.get(1) is None and cache.get(2) == 20
+    cache.clear()
+    assert cache.get(2) is None
+
+def test_replace_where_keeps_unchanged_values():
+    cache = ttl_cache(10)
+    cache.put("a", [1])
+    cache.put("b", [2])
+    assert cache.replace_where(lambda key, value: value + [0] if key == "a" else value) == 1
+    assert cache.get("a") == [1, 0] and cache.get("b") == [2]
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+import app.encoding_store
+from app.encoding_store import course_encodings, encoding_cache, quantize, ENCODING_SIZE
+
+def _matrix(rows, seed = 0):
+    return np.random.default_rng(seed).normal(0, 0.1, (rows, ENCODING_SIZE)).astype(np.float32)
+
+@pytest.mark.parametrize("mode, dtype", [("none", np.float32), ("float16", np.float16), ("int8", np.int8)])
+def test_quantize_error_bounds_the_quantized_distance(mode, dtype):
+    matrix = _matrix(50)
+    codes, scales, errors = quantize(matrix, mode)
+    assert codes.dtype == dtype
+    assert (scales is not None) == (mode == "int8")
+    approx = codes.astype(np.float32) * (1 if scales is None else scales[:, None])
+    assert np.allclose(np.linalg.norm(matrix - approx, axis=1), errors, atol=1e-6)
+    if mode == "none":
+        assert not errors.any()
+
+def test_quantize_all_zero_rows():
+    codes, scales, errors = quantize(np.zeros((2, ENCODING_SIZE)), "int8")
+    assert not codes.any()
+    assert np.isfinite(scales).all()
+    assert not errors.any()
+
+def _course(mode, students = 20, per_student = 3):
+    rolls = np.array(sorted(f"cs{k:07d}" for k in range(students) for _ in range(per_student)))
+    codes, scales, errors = quantize(_matrix(len(rolls)), mode)
+    ids = np.array([str(k) for k in range(len(rolls))], dtype=object)
+    return course_encodings("course", rolls, codes, [], set(rolls), ids, scales=scales, errors=errors)
+
+@pytest.mark.parametrize("mode", ["none", "float16", "int8"])
+def test_dot_matches_the_dense_product(mode, monkeypatch):
+    monkeypatch.setattr(app.encoding_store, "DENSE_BLOCK", 7)
+    entry = _course(mode)
+    faces = _matrix(4, seed=1)
+    assert np.allclose(entry.dot(faces), faces @ entry.dense().T, atol=1e-6)
+
+@pytest.mark.parametrize("mode", ["none", "int8"])
+def test_subset_matches_a_fresh_build(mode):
+    entry = _course(mode)
+    keep = np.zeros(len(entry.students), dtype=bool)
+    keep[[1, 4, 5, 19]] = True
+    subset = entry.subset(keep)
+    rows = np.repeat(keep, entry.counts)
+    fresh = course_encodings("course", entry.rolls[rows], entry.matrix[rows], [], entry.registered, entry.ids[rows],
+                             scales=None if entry.scales is None else entry.scales[rows], errors=entry.errors[rows])
+    assert list(subset.students) == list(fresh.students)
+    for name in ("offsets", "counts", "sq_norms", "centroids", "radii", "slack", "centroid_sq"):
+        assert np.allclose(getattr(subset, name), getattr(fresh, name), atol=1e-6), name
+    assert subset.serial != entry.serial
+    assert len(entry.subset(np.zeros(len(entry.students), dtype=bool))) == 0
+
+# stands in for snapshot_store, touch() makes the mapped snapshot stale like a change in another process
+class snapshots:
+    def __init__(self, entry):
+        self.entry = entry
+        self.stale = False
+
+    def touch(self):
+        self.stale = True
+
+    def current(self):
+        return None if self.stale else self
+
+    @property
+    def version(self):
+        return self.entry.version
+
+    def __contains__(self, course_id):
+        return course_id == self.entry.course_id
+
+    def course(self, course_id):
+        return self.entry
+
+# connection returning the rows of encoding_cache._build for one registered student
+class connection:
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, args = None):
+        self.queries += 1
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+def test_stale_snapshot_entries_are_reloaded():
+    mapped = _course("none")
+    mapped.version = "1"
+    store = snapshots(mapped)
+    cache = encoding_cache(10, None)
+    cache.use_snapshots(store)
+    conn = connection([("cs0000099", _matrix(1)[0].astype(np.float64).tobytes(), None, "99")])
+    assert cache.get("course", conn) is mapped
+    assert cache.get("course", conn) is mapped
+    assert conn.queries == 0
+    store.touch()
+    reloaded = cache.get("course", conn)
+    assert reloaded is not mapped and reloaded.version is None
+    assert list(reloaded.students) == ["cs0000099"]
+    assert cache.get("course", conn) is reloaded
+    assert conn.queries == 1
@@ -0,0 +1,143 @@
+import asyncio
+import threading
+import cv2
+import numpy as np
+import pytest
+import app.recognition
+from app.recognition import assign, suppress, tile_windows, recognition_pool, recognition_error
+from app.recognition import verify_enrollment, fuse_matches, tiled_lectures, recognition_profile
+
+def test_assign_takes_closest_pairs_first():
+    # both faces are closest to student 0, face 1 is closer so face 0 gets its second choice
+    dist = np.array([[0.30, 0.40, 0.9],
+                     [0.20, 0.90, 0.9]])
+    assert list(assign(dist, 0.5)) == [1, 0]
+
+def test_assign_leaves_faces_beyond_tolerance_unassigned():
+    dist = np.array([[0.30, 0.9],
+                     [0.35, 0.9],
+                     [0.9, 0.9]])
+    assert list(assign(dist, 0.5)) == [0, -1, -1]
+    assert list(assign(np.empty((2, 0)), 0.5)) == [-1, -1]
+
+
+def test_suppress_drops_overlapping_and_contained_boxes():
+    whole = (100, 200, 200, 100)
+    shifted = (105, 205, 205, 105) # iou above 0.8
+    cut = (100, 150, 200, 100) # half of the face, as cut by a tile edge
+    other = (300, 400, 400, 300)
+    kept = suppress([(cut, 0.9), (whole, 1.5), (shifted, 1.0), (other, 0.1)], iou=0.3)
+    assert kept == [whole, other]
+    assert suppress([]) == []
+
+def test_tile_windows_cover_the_image():
+    windows = tile_windows(1000, 1500, size=600, overlap=100)
+    covered = np.zeros((1000, 1500), dtype=bool)
+    for top, left, bottom, right in windows:
+        assert bottom - top <= 600 and right - left <= 600
+        covered[top:bottom, left:right] = True
+    assert covered.all()
+    # the last window of a row or column ends on the edge instead of running past it
+    assert max(bottom for _, _, bottom, _ in windows) == 1000
+    assert max(right for _, _, _, right in windows) == 1500
+
+def test_tile_windows_of_a_small_image_is_the_image():
+    assert tile_windows(400, 300, size=600, overlap=100) == [(0, 0, 400, 300)]
+
+def _square(x):
+    return x * x
+
+def test_fan_out_larger_than_the_pool_is_queued():
+    pool = recognition_pool(0, 1, 10)
+    results = asyncio.run(pool.run_many(_square, [(k, ) for k in range(6)]))
+    assert results == [k * k for k in range(6)]
+    assert pool.stats()["pending"] == 0
+    assert pool.stats()["rejected"] == 0
+
+def test_full_queue_is_rejected():
+    pool = recognition_pool(0, 1, 10)
+    started, finish = threading.Event(), threading.Event()
+    def blocking():
+        started.set()
+        finish.wait(10)
+        return "done"
+    async def main():
+        first = asyncio.create_task(pool.run_many(blocking, [()]))
+        await asyncio.to_thread(started.wait, 10)
+        with pytest.raises(recognition_error) as error:
+            await pool.run_many(_square, [(2, )])
+        finish.set()
+        return await first, error.value.status_code
+    assert asyncio.run(main()) == (["done"], 503)
+    assert pool.stats()["rejected"] == 1
+
+def _encoding(seed):
+    encoding = np.zeros(128)
+    encoding[seed] = 1.0
+    return encoding
+
+def _result(student, distance):
+    return {"student" : student, "distance" : distance, "confidence" : 0.0, "matches" : {}}
+
+def test_fuse_matches_keeps_the_best_photo_of_each_student():
+    photo_results = [
+        [_result("a", 0.40), _result("b", 0.20)],
+        [_result("a", 0.30)],
+    ]
+    photo_encodings = [[_encoding(0), _encoding(1)], [_encoding(0)]]
+    best, seen, unknown = fuse_matches(photo_results, photo_encodings, 0.5)
+    assert best == {"a" : (1, 0), "b" : (0, 1)}
+    assert seen == {"a" : [0, 1], "b" : [0]}
+    assert unknown == []
+
+def test_fuse_matches_groups_unknown_faces_across_photos():
+    photo_results = [
+        [_result("a", 0.30), _result(None, None), _result(None, None)],
+        [_result(None, None), _result(None, None)],
+    ]
+    # photo 1 face 0 is the same stranger as photo 0 face 1, photo 1 face 1 is student a unmatched
+    photo_encodings = [
+        [_encoding(0), _encoding(5), _encoding(6)],
+        [_encoding(5) + 0.01, _encoding(0) + 0.01],
+    ]
+    best, seen, unknown = fuse_matches(photo_results, photo_encodings, 0.5)
+    assert best == {"a" : (0, 0)}
+    assert seen == {"a" : [0, 1]}
+    assert unknown == [[(0, 1), (1, 0)], [(0, 2)]]
+
+def test_verify_enrollment_against_stored_encodings():
+    stored = [_encoding(0), _encoding(0) + 0.02, _encoding(0) - 0.02]
+    new = [_encoding(0) + 0.01, _encoding(3)]
+    accepted, conflicting = verify_enrollment(new, stored, 0.5)
+    assert list(accepted) == [True, False]
+    assert list(conflicting) == [False, False, False]
+
+def test_verify_enrollment_flags_stored_encodings_no_new_one_matches():
+    stored = [_encoding(0), _encoding(0) + 0.02, _encoding(7)]
+    accepted, conflicting = verify_enrollment([_encoding(0)], stored, 0.5)
+    assert list(accepted) == [True]
+    assert list(conflicting) == [False, False, True]
+
+def test_verify_enrollment_without_stored_encodings():
+    accepted, conflicting = verify_enrollment([_encoding(0)], np.empty((0, 128)), 0.5)
+    assert list(accepted) == [True]
+    assert len(conflicting) == 0
+    # the odd one out of three new photos is refused
+    accepted, _ = verify_enrollment([_encoding(0), _encoding(0) + 0.01, _encoding(4)], [], 0.5)
+    assert list(accepted) == [True, True, False]
+
+def _photo(height, width, seed):
+    img = np.random.default_rng(seed).integers(0, 255, (height, width, 3), dtype=np.uint8)
+    return cv2.imencode(".jpg", img)[1].tobytes()
+
+def test_tiled_batch_fits_a_small_pool(monkeypatch):
+    # every photo fans out to more tile jobs than the pool has workers and queue slots together
+    pool = recognition_pool(0, 2, 60)
+    monkeypatch.setattr(app.recognition, "recognition_workers", pool)
+    monkeypatch.setattr(app.recognition, "tile_windows", lambda height, width: tile_windows(height, width, 160, 32))
+    profile = recognition_profile("tiled", upsample=0, tiled=True, tile_upsample=0)
+    jobs = asyncio.run(tiled_lectures([_photo(320, 480, seed) for seed in range(3)], profile))
+    assert [job["dimensions"] for job in jobs] == [(320, 480)] * 3
+    assert all(job["tiles"] > 2 for job in jobs)
+    assert pool.stats()["rejected"] == 0
+    assert pool.stats()["pending"] == 0
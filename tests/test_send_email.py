@@ -0,0 +1,102 @@
+import smtplib
+import socket
+import pytest
+from email.mime.text import MIMEText
+from aiosmtpd.controller import Controller
+from app import send_email
+from app.send_email import mailer
+
+# local SMTP server that records every delivered message and refuses recipients starting with "reject"
+class recorder:
+    def __init__(self):
+        self.delivered = []
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.startswith("reject"):
+            return "550 no such user"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        self.delivered.append(envelope.rcpt_tos[0])
+        return "250 OK"
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+@pytest.fixture
+def smtp(monkeypatch):
+    handler = recorder()
+    controller = Controller(handler, hostname="127.0.0.1", port=_free_port())
+    controller.start()
+    monkeypatch.setattr(send_email, "smtp_server", "127.0.0.1")
+    monkeypatch.setattr(send_email, "port", controller.port)
+    monkeypatch.setattr(send_email, "username", None)
+    monkeypatch.setattr(send_email, "sender_email", "noreply@iiitr.ac.in")
+    monkeypatch.setattr(send_email, "MAIL_STARTTLS", False)
+    yield handler
+    controller.stop()
+
+def _messages(*send_to):
+    messages = []
+    for to in send_to:
+        message = MIMEText("hello")
+        message["To"] = to
+        messages.append(message)
+    return messages
+
+def test_batch_uses_one_session(smtp):
+    m = mailer(2, 60, 100)
+    results = m.send_many(_messages("a@iiitr.ac.in", "b@iiitr.ac.in", "c@iiitr.ac.in"))
+    assert results == [None, None, None]
+    assert smtp.delivered == ["a@iiitr.ac.in", "b@iiitr.ac.in", "c@iiitr.ac.in"]
+    assert m.send_many(_messages("d@iiitr.ac.in")) == [None]
+    stats = m.stats()
+    assert stats["connects"] == 1
+    assert stats["sent"] == 4
+    assert stats["idle"] == 1
+    m.closeall()
+
+def test_reconnects_after_server_hangs_up(smtp):
+    m = mailer(2, 60, 100)
+    m.send_many(_messages("a@iiitr.ac.in"))
+    m._idle[0].server.close() # the pooled session is dead
+    assert m.send_many(_messages("b@iiitr.ac.in", "c@iiitr.ac.in")) == [None, None]
+    stats = m.stats()
+    assert stats["reconnects"] == 1
+    assert stats["connects"] == 2
+    assert smtp.delivered == ["a@iiitr.ac.in", "b@iiitr.ac.in", "c@iiitr.ac.in"]
+    m.closeall()
+
+def test_sessions_are_recycled_after_max_messages(smtp):
+    m = mailer(2, 60, 2)
+    results = m.send_many(_messages(*[f"{k}@iiitr.ac.in" for k in range(5)]))
+    assert results == [None] * 5
+    assert m.stats()["connects"] == 3
+    m.closeall()
+
+def test_refused_recipient_does_not_fail_the_batch(smtp):
+    m = mailer(2, 60, 100)
+    results = m.send_many(_messages("a@iiitr.ac.in", "reject@iiitr.ac.in", "b@iiitr.ac.in"))
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], smtplib.SMTPRecipientsRefused)
+    assert smtp.delivered == ["a@iiitr.ac.in", "b@iiitr.ac.in"]
+    stats = m.stats()
+    assert stats["connects"] == 1
+    assert stats["failed"] == 1
+    m.closeall()
+
+def test_unreachable_server_fails_every_message(monkeypatch):
+    monkeypatch.setattr(send_email, "smtp_server", "127.0.0.1")
+    monkeypatch.setattr(send_email, "port", _free_port())
+    monkeypatch.setattr(send_email, "MAIL_STARTTLS", False)
+    m = mailer(2, 60, 100)
+    results = m.send_many(_messages("a@iiitr.ac.in", "b@iiitr.ac.in", "c@iiitr.ac.in"))
+    assert all(isinstance(error, ConnectionRefusedError) for error in results)
+    # the server is given up on after the first message, the rest fail with the same error
+    assert results[1] is results[2]
+    assert m.stats()["reconnects"] == 2
+    with pytest.raises(ConnectionRefusedError):
+        m.send(_messages("d@iiitr.ac.in")[0])
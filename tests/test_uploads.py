@@ -0,0 +1,52 @@
+import hashlib
+import io
+import pytest
+from app.uploads import _reader, upload_error, PAYLOAD_TOO_LARGE, UNSUPPORTED_MEDIA_TYPE
+from app.uploads import VIDEO_SIGNATURES, VIDEO_FORMATS
+
+JPEG = b"\xff\xd8\xff\xe0" + b"\0" * 100
+PNG = b"\x89PNG\r\n\x1a\n" + b"\0" * 100
+
+def _read(data, chunk = 5, max_bytes = 1000, **kwargs):
+    reader = _reader("photo.jpg", max_bytes, **kwargs)
+    for start in range(0, len(data), chunk):
+        reader.feed(data[start:start + chunk])
+    return reader.finish()
+
+def test_reader_buffers_and_hashes_in_chunks():
+    result = _read(JPEG)
+    assert result.kind == "jpeg"
+    assert bytes(result.data) == JPEG
+    assert result.size == len(JPEG)
+    assert result.sha256 == hashlib.sha256(JPEG).hexdigest()
+    assert _read(PNG, chunk=3).kind == "png"
+
+def test_reader_refuses_oversized_uploads():
+    with pytest.raises(upload_error) as error:
+        _read(JPEG, max_bytes=50)
+    assert error.value.status_code == PAYLOAD_TOO_LARGE
+
+def test_reader_refuses_unknown_formats():
+    with pytest.raises(upload_error) as error:
+        _read(b"GIF89a" + b"\0" * 100)
+    assert error.value.status_code == UNSUPPORTED_MEDIA_TYPE
+    # shorter than the 12 bytes the signatures are matched on
+    with pytest.raises(upload_error) as error:
+        _read(b"hello")
+    assert error.value.status_code == UNSUPPORTED_MEDIA_TYPE
+
+def test_reader_refuses_empty_uploads():
+    with pytest.raises(upload_error) as error:
+        _read(b"")
+    assert error.value.status_code == 400
+
+def test_reader_streams_to_a_sink():
+    video = b"\0\0\0\x18ftypmp42" + b"\1" * 64
+    sink = io.BytesIO()
+    result = _read(video, signatures=VIDEO_SIGNATURES, formats=VIDEO_FORMATS, sink=sink)
+    assert result.kind == "mp4"
+    assert result.data is None
+    assert result.size == len(video)
+    assert sink.getvalue() == video
+    with pytest.raises(upload_error):
+        _read(JPEG, signatures=VIDEO_SIGNATURES, formats=VIDEO_FORMATS, sink=io.BytesIO())